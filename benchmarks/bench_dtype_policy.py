@@ -0,0 +1,80 @@
+"""Benchmark of the dtype policy of the preprocessing tools.
+
+Applies a typical sequence of tools (sliding_minima, sharpen,
+global_threshold, rescale_intensity_tanh) on a synthetic 16-bit camera image
+with `params.preproc.tools.dtype` set to None (each tool promotes to
+float64), to float32, and to float32 with the results cast back to uint16.
+Reports the time per image, the peak allocated memory during a call
+(measured with tracemalloc) and the size of the result, for
+`PreprocTools.__call__` and for the compiled pipeline.
+
+Usage: python benchmarks/bench_dtype_policy.py [size] [nb_repeats]
+
+"""
+from __future__ import print_function, division
+import sys
+import tracemalloc
+import warnings
+from time import time
+
+import numpy as np
+from tomokth.preprocess.base import PreprocBase
+from tomokth.preprocess.toolbox import PreprocTools
+
+
+def make_params(dtype, output_dtype):
+    params = PreprocBase.create_default_params()
+    params.preproc.stats.enable = False
+    tools = params.preproc.tools
+    tools.sequence = ['sliding_minima', 'sharpen', 'global_threshold',
+                      'rescale_intensity_tanh']
+    for tool in tools.sequence:
+        tools.__dict__[tool].enable = True
+    tools.sliding_minima.window_size = 15
+    tools.global_threshold.maxima = 1e4
+    tools.dtype = dtype
+    tools.output_dtype = output_dtype
+    return params
+
+
+def measure(func, img, nb_repeats):
+    func(img)
+    t_start = time()
+    for _ in range(nb_repeats):
+        func(img)
+    elapsed = (time() - t_start) / nb_repeats
+
+    tracemalloc.start()
+    result = func(img)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result.nbytes
+
+
+def main(size=2048, nb_repeats=3):
+    rng = np.random.RandomState(0)
+    img = (rng.poisson(200, (size, size)) +
+           (rng.rand(size, size) > 0.99) * 2000).astype(np.uint16)
+    print('Image {0}x{0} uint16 ({1:.1f} MB)'.format(size, img.nbytes / 2**20))
+    print('{:>10} {:>8} {:>10} {:>10} {:>10} {:>12} {:>12}'.format(
+        'dtype', 'output', 'mode', 'time (s)', 'speedup', 'peak (MB)',
+        'result (MB)'))
+
+    t_ref = None
+    for dtype, output_dtype in [(None, None), ('float32', None),
+                                ('float32', 'native')]:
+        tools = PreprocTools(make_params(dtype, output_dtype))
+        for mode, func in [('call', tools), ('compiled', tools.compile())]:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                elapsed, peak, nbytes = measure(func, img, nb_repeats)
+            if t_ref is None:
+                t_ref = elapsed
+            print('{:>10} {:>8} {:>10} {:>10.3f} {:>10.2f} {:>12.1f} '
+                  '{:>12.1f}'.format(str(dtype), str(output_dtype), mode,
+                                     elapsed, t_ref / elapsed, peak / 2**20,
+                                     nbytes / 2**20))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,91 @@
+"""Benchmark of the storage options of the particle database.
+
+Writes synthetic 16-bit particle images (a dark noisy background with a few
+percent of bright particles) as tif files, and ingests them with
+`ParticleData.create_h5` for several storage options given to
+`ParticleData.config`. Reports the ingest throughput, the mean latency of
+`get_dset` on a fresh instance, and the size of the HDF5 file.
+
+Usage: python benchmarks/bench_h5_storage.py [size] [nb_times] [nb_workers]
+
+"""
+from __future__ import print_function, division
+import os
+import sys
+import shutil
+import tempfile
+from time import time
+
+import numpy as np
+from skimage import io
+from tomokth.dataset import ParticleData
+
+
+SETTINGS = [
+    ('contiguous', {}),
+    ('chunked', dict(chunks=(256, 256))),
+    ('lzf', dict(chunks=(256, 256), compression='lzf')),
+    ('lzf+shuffle', dict(chunks=(256, 256), compression='lzf',
+                         shuffle=True)),
+    ('gzip-1+shuffle', dict(chunks=(256, 256), compression='gzip',
+                            compression_opts=1, shuffle=True)),
+    ('gzip-4+shuffle', dict(chunks=(256, 256), compression='gzip',
+                            compression_opts=4, shuffle=True)),
+]
+
+
+def make_images(path, size, nb_times):
+    rng = np.random.RandomState(0)
+    for camera in range(1, 5):
+        for ab in 'ab':
+            for t in range(nb_times):
+                img = rng.poisson(20, (size, size))
+                particles = rng.rand(size, size) > 0.98
+                img[particles] += rng.randint(500, 4000, particles.sum())
+                io.imsave(os.path.join(path, 'img_cam{}_{}{:04d}.tif'.format(
+                    camera, ab, t)), img.astype(np.uint16),
+                    check_contrast=False)
+
+
+def main(size=1024, nb_times=8, nb_workers=1):
+    tmp = tempfile.mkdtemp()
+    try:
+        make_images(tmp, size, nb_times)
+        nb_images = 8 * nb_times
+        raw = nb_images * size ** 2 * 2 / 2 ** 20
+        print('{} images {}x{} uint16 ({:.1f} MB)'.format(
+            nb_images, size, size, raw))
+        print('{:>16} {:>14} {:>14} {:>12} {:>8}'.format(
+            'storage', 'ingest (MB/s)', 'read (ms)', 'size (MB)', 'ratio'))
+
+        for name, storage in SETTINGS:
+            h5file = os.path.join(tmp, 'particle.h5')
+            if os.path.exists(h5file):
+                os.remove(h5file)
+
+            with ParticleData(tmp) as data:
+                data.config(**storage)
+                t_start = time()
+                data.create_h5(nb_workers=nb_workers)
+                t_ingest = time() - t_start
+
+            with ParticleData(tmp) as data:
+                data.config()
+                data.get_dset(1, 'a', 0)
+                t_start = time()
+                for camera in range(1, 5):
+                    for ab in 'ab':
+                        for t in range(nb_times):
+                            data.get_dset(camera, ab, t)
+                t_read = (time() - t_start) / nb_images
+
+            file_size = os.path.getsize(h5file) / 2 ** 20
+            print('{:>16} {:>14.1f} {:>14.2f} {:>12.1f} {:>8.2f}'.format(
+                name, raw / t_ingest, 1e3 * t_read, file_size,
+                raw / file_size))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,67 @@
+"""Benchmark of the methods computing the background of the sliding filters.
+
+For `sliding_median`, `sliding_percentile` and `sliding_minima`, reports the
+time per image and the error with respect to `method='exact'`, on a synthetic
+particle image with a smooth background, whose intensities span 12 bits or
+the full 16 bits. The cost of the 'histogram' method grows with the number
+of bins (the maximum of the image): on 16-bit data, it falls back to
+'exact'. The maximum error is given away from the borders (by one window),
+where the 'histogram' method is exact.
+
+Usage: python benchmarks/bench_sliding_background.py [size] [window_size]
+
+"""
+from __future__ import print_function, division
+import sys
+from time import time
+
+import numpy as np
+from tomokth.preprocess.toolbox import (
+    sliding_median, sliding_percentile, sliding_minima)
+
+
+def make_image(size=1024, gain=1, seed=0):
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:size, 0:size]
+    background = 200 + 100 * np.sin(xx / 80.) * np.cos(yy / 60.)
+    particles = (rng.rand(size, size) > 0.99) * 2000
+    img = background + rng.poisson(5, background.shape) + particles
+    return (gain * img).astype(np.uint16)
+
+
+def main(size=1024, window_size=30):
+    for gain in (1, 16):
+        img = make_image(size, gain)
+        print('Image {0}x{0} uint16 of maximum {1}, window_size={2}'.format(
+            size, img.max(), window_size))
+        bench(img, window_size)
+
+
+def bench(img, window_size):
+    inner = (slice(window_size, -window_size),) * 2
+    print('{:>20} {:>12} {:>10} {:>10} {:>14} {:>14}'.format(
+        'tool', 'method', 'time (s)', 'speedup', 'max err inner',
+        'mean err'))
+
+    cases = [(sliding_median, {}, ['exact', 'histogram', 'downsample']),
+             (sliding_percentile, {'percentile': 10.},
+              ['exact', 'histogram', 'downsample']),
+             (sliding_minima, {}, ['exact', 'downsample'])]
+    for tool, kwargs, methods in cases:
+        for method in methods:
+            t_start = time()
+            result = tool(img, window_size=window_size, method=method,
+                          **kwargs)
+            elapsed = time() - t_start
+
+            if method == 'exact':
+                reference, t_ref = result, elapsed
+
+            error = np.abs(result - reference)
+            print('{:>20} {:>12} {:>10.4f} {:>10.1f} {:>14.3g} {:>14.3g}'.format(
+                tool.__name__, method, elapsed, t_ref / elapsed,
+                error[inner].max(), error.mean()))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,65 @@
+"""Benchmark of the multithreaded SMART reconstruction.
+
+Reports the time per iteration and the speedup as a function of the number of
+threads, for a synthetic volume seen by four cameras.
+
+Usage: python benchmarks/bench_smart.py [nz ny nx] [nb_iterations]
+
+"""
+from __future__ import print_function, division
+import sys
+from time import time
+from multiprocessing import cpu_count
+
+import numpy as np
+from tomokth.operators.weights import VoxelGrid, build_weight_matrix
+from tomokth.reconstruct import SMART
+
+
+def make_problem(shape, rpix=0.5, rvox=0.5, seed=0):
+    grid = VoxelGrid(shape)
+    nz, ny, nx = shape
+    yy, xx = np.mgrid[0:ny, 0:nx].astype(float)
+    vec_pix = np.column_stack([xx.ravel(), yy.ravel(), np.full(xx.size, -10.)])
+    weights = [build_weight_matrix(grid, vec_pix, d, rpix, rvox)
+               for d in [(0.3, 0., 1.), (-0.3, 0., 1.),
+                         (0., 0.3, 1.), (0., -0.3, 1.)]]
+
+    rng = np.random.RandomState(seed)
+    volume = np.zeros(grid.size, dtype=np.float32)
+    volume[rng.randint(0, grid.size, grid.size // 1000)] = 1.
+    images = [(w * volume).reshape(ny, nx) for w in weights]
+    return grid, weights, images
+
+
+def main(shape=(64, 256, 256), nb_iterations=5):
+    print('Building weight matrices for a volume of shape', shape)
+    grid, weights, images = make_problem(shape)
+    print('Non-zeros per camera:', weights[0].nnz)
+
+    nb_threads_list = sorted(set([1, 2, 4, 8, 16, 32, cpu_count()]))
+    nb_threads_list = [n for n in nb_threads_list if n <= cpu_count()]
+    print('{:>10} {:>16} {:>10}'.format('threads', 'time/iter (s)', 'speedup'))
+    t_ref = None
+    for nb_threads in nb_threads_list:
+        params = SMART.create_default_params()
+        params.reconstruct.nb_threads = nb_threads
+        params.reconstruct.nb_iterations = nb_iterations
+        solver = SMART(weights, grid, params)
+        t_start = time()
+        solver(images)
+        t_iter = (time() - t_start) / nb_iterations
+        if t_ref is None:
+            t_ref = t_iter
+        print('{:>10} {:>16.4f} {:>10.2f}'.format(nb_threads, t_iter,
+                                                  t_ref / t_iter))
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:]]
+    kwargs = {}
+    if len(args) >= 3:
+        kwargs['shape'] = tuple(args[:3])
+    if len(args) == 4:
+        kwargs['nb_iterations'] = args[3]
+    main(**kwargs)
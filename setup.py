@@ -43,5 +43,5 @@ setup(name='tomokth',
       author_email='avmo@kth.se',
       license='GPL',
       install_requires=['scipy', 'matplotlib', 'h5py', 'scikit-image',
-                        'sympy', 'fluiddyn', 'pymatbridge']
+                        'fluiddyn', 'pymatbridge']
       )
@@ -0,0 +1,303 @@
+import os
+import shutil
+import tempfile
+import unittest
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import h5py
+import numpy as np
+from skimage import io
+
+from tomokth.dataset import CalibrationData, ParticleData
+
+
+class Test_CalibrationData(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.imgs = {}
+        for camera in (1, 2):
+            for z_loc in (0, 5, 10):
+                img = np.full((8, 6), 10 * camera + z_loc, dtype=np.uint16)
+                self.imgs[camera, z_loc] = img
+                io.imsave(os.path.join(
+                    self.tmp, '{}mm_cam{}.tif'.format(z_loc, camera)), img,
+                    check_contrast=False)
+
+        self.data = CalibrationData(self.tmp)
+        self.data.config()
+        self.data.create_h5()
+
+    def tearDown(self):
+        self.data.close()
+        shutil.rmtree(self.tmp)
+
+    def test_index(self):
+        with h5py.File(self.data.h5file, 'r') as f:
+            table = f['_index/datasets'][...]
+        self.assertEqual(len(table), 6)
+        self.assertEqual(sorted(self.data.h5dict), ['cam1', 'cam2'])
+
+        # Loaded from the file by a new instance
+        data = CalibrationData(self.tmp)
+        data.config()
+        for (camera, z_loc), img in self.imgs.items():
+            np.testing.assert_array_equal(data.get_dset(camera, z_loc), img)
+        self.assertEqual(data.get_camera_grp(2).name, '/cam2')
+        self.assertRaises(ValueError, data.get_dset, 3, 0)
+        data.close()
+
+    def test_calibration(self):
+        calib = np.arange(12.).reshape(3, 4)
+        self.data.save_camera_calibration(1, calib)
+        np.testing.assert_array_equal(self.data.get_camera_calibration(1),
+                                      calib)
+
+    def test_external_modification(self):
+        self.data.close()
+        with h5py.File(self.data.h5file, 'a') as f:
+            dset = f['cam1'].create_dataset('20mm_cam1.tif',
+                                            data=np.ones((8, 6)))
+            dset.attrs['cam'] = 1
+            dset.attrs['z'] = 20
+            del f['cam2/5mm_cam2.tif']
+
+        np.testing.assert_array_equal(self.data.get_dset(1, 20), 1.)
+        self.assertRaises(ValueError, self.data.get_dset, 2, 5)
+        self.data.close()
+        # The getters only rescan in memory, rebuild_index writes the index
+        with h5py.File(self.data.h5file, 'r') as f:
+            paths = set(f['_index/datasets']['path'])
+        self.assertIn(b'/cam2/5mm_cam2.tif', paths)
+        self.assertNotIn(b'/cam1/20mm_cam1.tif', paths)
+        self.data.rebuild_index()
+        self.data.close()
+        with h5py.File(self.data.h5file, 'r') as f:
+            paths = set(f['_index/datasets']['path'])
+        self.assertNotIn(b'/cam2/5mm_cam2.tif', paths)
+        self.assertIn(b'/cam1/20mm_cam1.tif', paths)
+
+    def test_miss(self):
+        self.data.close()
+        data = CalibrationData(self.tmp)
+        data.config()
+        mtime = os.path.getmtime(data.h5file)
+        with mock.patch.object(CalibrationData, '_scan') as scan:
+            for i in range(3):
+                self.assertRaises(ValueError, data.get_dset, 3, 0)
+                self.assertRaises(ValueError, data.get_camera_grp, 3)
+            self.assertEqual(scan.call_count, 0)
+        self.assertRaises(ValueError, data.get_grp, z=5)
+        self.assertEqual(data.open_h5().mode, 'r')
+        data.close()
+        self.assertEqual(os.path.getmtime(data.h5file), mtime)
+
+    def test_handles(self):
+        f = self.data.open_h5()
+        self.assertIs(self.data.open_h5(), f)
+        self.data.close()
+        self.assertFalse(f)
+
+        with CalibrationData(self.tmp) as data:
+            data.config()
+            f = data.open_h5()
+            self.assertEqual(f.mode, 'r')
+            data.get_dset(1, 5)
+            # Upgrade to writing, then writing handle reused for reading
+            f = data.open_h5('a')
+            self.assertEqual(f.mode, 'r+')
+            self.assertIs(data.open_h5(), f)
+            self.assertIs(data.open_h5('a'), f)
+            np.testing.assert_array_equal(data.get_dset(2, 10),
+                                          self.imgs[2, 10])
+        self.assertFalse(f)
+
+    def test_concurrent_readers(self):
+        keys = list(self.imgs) * 10
+        self.data.nb_read_handles = 2
+        self.data.close()
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(
+                lambda key: self.data.get_dset(*key), keys))
+        for key, result in zip(keys, results):
+            np.testing.assert_array_equal(result, self.imgs[key])
+        self.assertLessEqual(self.data._get_pool()._nb_open, 2)
+
+        # A writer waits for the readers and closes their handles
+        self.data.save_camera_calibration(2, np.ones(3))
+        self.assertEqual(self.data._pool._nb_open, 0)
+        np.testing.assert_array_equal(self.data.get_dset(1, 0),
+                                      self.imgs[1, 0])
+
+    def test_storage(self):
+        self.data.close()
+        os.remove(self.data.h5file)
+        with CalibrationData(self.tmp) as data:
+            data.config(chunks=(4, 100), compression='gzip',
+                        compression_opts=0, shuffle=True)
+            data.create_h5(nb_workers=2)
+            with h5py.File(data.h5file, 'r') as f:
+                dset = f['cam1/5mm_cam1.tif']
+                self.assertEqual(dset.chunks, (4, 6))
+                self.assertEqual(dset.compression, 'gzip')
+                self.assertEqual(dset.compression_opts, 0)
+                self.assertTrue(dset.shuffle)
+            for key, img in self.imgs.items():
+                np.testing.assert_array_equal(data.get_dset(*key), img)
+
+        data = CalibrationData(self.tmp)
+        data.config(shuffle=True)
+        self.assertEqual(data._storage_kwargs((8, 6)),
+                         {'chunks': (8, 6), 'shuffle': True})
+        data.config()
+        self.assertEqual(data._storage_kwargs((8, 6)), {})
+        self.assertRaises(ValueError, data.config, compression='unknown')
+        self.assertRaises(ValueError, data.config, compression=65000)
+        self.assertRaises(ValueError, data.config, compression='lzf',
+                          compression_opts=1)
+        self.assertRaises(ValueError, data.config, chunks=(0, 4))
+        self.assertRaises(ValueError, data.config, chunks=(4, 4, 4))
+        self.assertEqual(data.storage['compression'], None)
+
+    def test_create_twice(self):
+        self.data.close()
+        with mock.patch('tomokth.dataset.base.print') as warn:
+            self.data.create_h5()
+        self.assertEqual(warn.call_count, len(self.imgs))
+        for key, img in self.imgs.items():
+            np.testing.assert_array_equal(self.data.get_dset(*key), img)
+
+
+class Test_ParticleData(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        for camera in (1, 2):
+            for ab in 'ab':
+                for time in range(3):
+                    img = np.full((6, 8), 100 * camera + 10 * time +
+                                  (ab == 'b'), dtype=np.uint16)
+                    io.imsave(os.path.join(self.tmp, 'img_cam{}_{}{:04d}.tif'
+                                           .format(camera, ab, time)), img,
+                              check_contrast=False)
+
+        self.data = ParticleData(self.tmp)
+        self.data.config()
+        self.data.create_h5()
+
+    def tearDown(self):
+        self.data.close()
+        shutil.rmtree(self.tmp)
+
+    def test_get_dset(self):
+        for camera in (1, 2):
+            for ab in 'ab':
+                for time in range(3):
+                    img = self.data.get_dset(camera, ab, time)
+                    self.assertEqual(img[0, 0], 100 * camera + 10 * time +
+                                     (ab == 'b'))
+
+        self.assertEqual(self.data.get_grp(t=2).name, '/t=0002')
+        self.assertRaises(ValueError, self.data.get_camera_grp, 1)
+
+    def test_stacked(self):
+        self.assertRaises(ValueError, self.data.get_series, 1, 'a')
+        size = os.path.getsize(self.data.h5file)
+        self.data.stack_images()
+        self.assertEqual(self.data.stack_file,
+                         os.path.join(self.tmp, 'particle_stack.h5'))
+        with h5py.File(self.data.stack_file, 'r') as f:
+            images = f['images']
+            self.assertEqual(images.shape, (3, 2, 2, 6, 8))
+            self.assertEqual(images.chunks, (1, 1, 1, 6, 8))
+            self.assertTrue(f['present'][...].all())
+        # The original layout is not modified
+        self.assertEqual(os.path.getsize(self.data.h5file), size)
+        # The coordinates are cached per instance
+        self.assertIsNotNone(self.data._stack_coords)
+        self.assertIsNone(ParticleData(self.tmp)._stack_coords)
+
+        with ParticleData(self.tmp) as data:
+            data.config()
+            self.assertEqual(data.get_stack_coords(),
+                             {'t': [0, 1, 2], 'cam': [1, 2], 'ab': ['a', 'b']})
+            series = data.get_series(2, 'b')
+            self.assertEqual(series.shape, (3, 6, 8))
+            for time in range(3):
+                np.testing.assert_array_equal(series[time],
+                                              data.get_dset(2, 'b', time))
+            np.testing.assert_array_equal(data.get_series(1, 'a', slice(1, 3)),
+                                          series[1:] - 101)
+            self.assertRaises(ValueError, data.get_series, 3, 'a')
+            data.rebuild_index()
+            self.assertEqual(len(data._index['datasets']), 12)
+
+        # The stacked file is self-contained
+        self.data.close()
+        os.remove(self.data.h5file)
+        with ParticleData(self.tmp) as data:
+            data.config()
+            np.testing.assert_array_equal(data.get_series(2, 'b'), series)
+
+    def test_stacked_changes(self):
+        self.data.stack_images()
+        self.data.close()
+        reader = ParticleData(self.tmp)
+        reader.config()
+        self.assertEqual(reader.get_stack_coords()['t'], [0, 1, 2])
+
+        img = np.full((6, 8), 7, dtype=np.uint16)
+        io.imsave(os.path.join(self.tmp, 'img_cam1_a0003.tif'), img,
+                  check_contrast=False)
+        with ParticleData(self.tmp) as data:
+            data.config()
+            data.create_h5()
+            data.stack_images()
+
+        self.assertEqual(reader.get_stack_coords()['t'], [0, 1, 2, 3])
+        series = reader.get_series(1, 'a')
+        np.testing.assert_array_equal(series[3], img)
+        reader.close()
+
+    def _layout(self, path):
+        layout = {}
+
+        def visit(name, obj):
+            attrs = {key: obj.attrs[key] for key in obj.attrs}
+            layout[name] = (attrs, obj[...].tolist()
+                            if isinstance(obj, h5py.Dataset) else None)
+
+        with h5py.File(path, 'r') as f:
+            f.visititems(visit)
+        return layout
+
+    def test_parallel_ingestion(self):
+        self.data.close()
+        layout = self._layout(self.data.h5file)
+        for processes in (False, True):
+            os.remove(self.data.h5file)
+            with ParticleData(self.tmp) as data:
+                data.config()
+                data.create_h5(nb_workers=3, queue_size=2,
+                               processes=processes)
+                self.assertEqual(data.get_dset(2, 'b', 1)[0, 0], 211)
+            self.assertEqual(self._layout(self.data.h5file), layout)
+
+    def test_ingest_errors(self):
+        paths = sorted(glob(os.path.join(self.tmp, '*.tif')))
+        written = []
+
+        def write(path, arr):
+            if len(written) == 2:
+                raise KeyError(path)
+            written.append(path)
+
+        self.assertRaises(KeyError, ParticleData._ingest, paths, write,
+                          nb_workers=2, queue_size=1)
+        self.assertEqual(written, paths[:2])
+        self.assertRaises(IOError, ParticleData._ingest,
+                          paths[:1] + [paths[0] + '.missing'],
+                          lambda path, arr: None, nb_workers=2)
@@ -1,5 +1,13 @@
 import unittest
-from tomokth.operators.math import vintersect_sphcyl
+import numpy as np
+from tomokth.operators.math import (
+    vintersect_sphcyl, ellippi, _elliprf, _elliprj, WeightTable,
+    distance_los_voxel, iter_distances_los_voxel, calc_weight, iter_weights)
+
+try:
+    import sympy
+except ImportError:
+    sympy = None
 
 
 class Test_VIntersect_SphCyl(unittest.TestCase):
@@ -38,3 +46,90 @@ class Test_VIntersect_SphCyl(unittest.TestCase):
     def test9(self):
         """ b > R; r < b + R """
         self.assertAlmostEqual(vintersect_sphcyl(1., 1.0, 1.2), 1.15367, places=4)
+
+    def test_vectorized(self):
+        """ Array input matches the scalar cases above """
+        rs = np.array([1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1.])
+        rc = np.array([0.2, 0.2, 0.2, 0.8, 0.5, 0.2, 1.0, 1.2, 1.0, 0.5, 2.])
+        b = np.array([0.3, 0.2, 0.1, 0.2, 0.5, 0.8, 0.2, 1.2, 1.2, 2., 0.])
+        expected = [0.23696, 0.24361, 0.24752, 3.13728, 1.20550, 0.14128,
+                    3.90657, 1.76216, 1.15367, 0., 4. * np.pi / 3]
+        vi = vintersect_sphcyl(rs, rc, b)
+        self.assertEqual(vi.shape, rs.shape)
+        for value, ref in zip(vi, expected):
+            self.assertAlmostEqual(value, ref, places=4)
+
+    def test_broadcast(self):
+        """ Broadcasting of a scalar sphere radius against arrays """
+        b = np.linspace(0., 1.5, 7)
+        vi = vintersect_sphcyl(1., 0.5, b[:, np.newaxis] * np.ones((1, 3)))
+        self.assertEqual(vi.shape, (7, 3))
+        for i, b_i in enumerate(b):
+            self.assertAlmostEqual(vi[i, 1], vintersect_sphcyl(1., 0.5, b_i))
+
+
+@unittest.skipIf(sympy is None, 'sympy is required to compute reference values')
+class Test_EllipPi(unittest.TestCase):
+    def setUp(self):
+        n = np.array([-20., -3.5, -1., -0.25, 0., 0.3, 0.9])
+        m = np.array([0.9, 0.05, 0.5, 0.99, 0.7, 0.0, 0.4])
+        self.n, self.m = n, m
+        self.expected = np.array([float(sympy.elliptic_pi(n_i, m_i))
+                                  for n_i, m_i in zip(n, m)])
+
+    def test_ellippi(self):
+        np.testing.assert_allclose(ellippi(self.n, self.m), self.expected,
+                                   rtol=1e-13)
+
+    def test_carlson_numpy(self):
+        """ NumPy fallbacks for scipy < 1.8 """
+        y = 1. - self.m
+        pi = _elliprf(0., y, 1.) + self.n / 3 * _elliprj(0., y, 1., 1. - self.n)
+        np.testing.assert_allclose(pi, self.expected, rtol=1e-13)
+
+    def test_scalar(self):
+        self.assertAlmostEqual(ellippi(0.3, 0.), np.pi / 2 / np.sqrt(0.7))
+
+
+class Test_WeightTable(unittest.TestCase):
+    def test_interpolation_error(self):
+        rpix, rvox = 0.5, 0.8
+        table = WeightTable(rpix, rvox, atol=1e-6)
+        b = np.linspace(0., 1.5, 1001)
+        expected = (vintersect_sphcyl(rvox, rpix, b) /
+                    vintersect_sphcyl(rvox, rvox, 0.))
+        self.assertLessEqual(table.error, 1e-6)
+        np.testing.assert_allclose(table(b), expected, rtol=0., atol=2e-6)
+        self.assertTrue(np.all(table(b[b >= rpix + rvox]) == 0.))
+
+
+class Test_BatchedWeights(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.vec_pix = rng.uniform(-1., 1., (7, 3))
+        self.vec_vox = rng.uniform(-1., 1., (11, 3))
+        self.vec_normal = rng.uniform(0.5, 1., (7, 3))
+
+    def test_distances_all_pairs(self):
+        ipix, ivox, b = [np.concatenate(arrays) for arrays in zip(
+            *iter_distances_los_voxel(self.vec_pix, self.vec_vox,
+                                      self.vec_normal, chunk_size=10))]
+        self.assertEqual(b.size, 7 * 11)
+        for i, j, b_ij in zip(ipix, ivox, b):
+            self.assertAlmostEqual(b_ij, distance_los_voxel(
+                self.vec_pix[i], self.vec_vox[j], self.vec_normal[i]))
+
+    def test_weights_pairs(self):
+        ipix = np.array([0, 3, 3, 6])
+        ivox = np.array([10, 2, 5, 0])
+        chunks = list(iter_weights(0.5, self.vec_pix, 0.7, self.vec_vox,
+                                   self.vec_normal, ipix, ivox, chunk_size=3))
+        self.assertEqual(len(chunks), 2)
+        w = np.concatenate([chunk[2] for chunk in chunks])
+        expected = calc_weight(0.5, self.vec_pix[ipix], 0.7,
+                               self.vec_vox[ivox], self.vec_normal[ipix])
+        for w_i, i, j in zip(expected, ipix, ivox):
+            self.assertAlmostEqual(w_i, calc_weight(
+                0.5, self.vec_pix[i], 0.7, self.vec_vox[j],
+                self.vec_normal[i]))
+        np.testing.assert_allclose(w, expected)
@@ -0,0 +1,652 @@
+import csv
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import tracemalloc
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import h5py
+import numpy as np
+import scipy.ndimage as nd
+from skimage import io
+from tomokth.preprocess import tiling, toolbox
+from tomokth.preprocess import base
+from tomokth.preprocess.base import PreprocBase
+from tomokth.preprocess.cache import PreprocCache
+from tomokth.preprocess.stats import ToolStats
+from tomokth.preprocess.toolbox import PreprocTools
+
+
+class Test_StreamingTemporal(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.imgs = (rng.rand(11, 16, 12) * 1000).astype(np.uint16)
+
+    def check(self, expected, streamed):
+        streamed = np.array(list(streamed))
+        np.testing.assert_array_equal(streamed, expected)
+
+    def test_median(self):
+        for window_shape in [(2, 1, 1), (5, 1, 1), (4, 3, 3)]:
+            self.check(toolbox.temporal_median(self.imgs.copy(), 0.8,
+                                               window_shape),
+                       toolbox.iter_temporal_median(iter(self.imgs), 0.8,
+                                                    window_shape))
+
+    def test_percentile(self):
+        for window_shape in [(3, 1, 1), (6, 1, 1), (20, 1, 1), (5, 2, 4)]:
+            self.check(toolbox.temporal_percentile(self.imgs.copy(), 20., 1.,
+                                                   window_shape),
+                       toolbox.iter_temporal_percentile(iter(self.imgs), 20.,
+                                                        1., window_shape))
+
+    def test_minima(self):
+        for window_size in [2, 7, 11]:
+            self.check(toolbox.temporal_minima(self.imgs.copy(), 1.,
+                                               window_size),
+                       toolbox.iter_temporal_minima(iter(self.imgs), 1.,
+                                                    window_size))
+
+    def test_centre_rank(self):
+        window = self.imgs[:5]
+        for shape, max_elements in [((3, 3), 2 ** 24), ((2, 5), 100)]:
+            rank = 5 * shape[0] * shape[1] // 3
+            expected = nd.rank_filter(window, rank, size=(5,) + shape,
+                                      mode='reflect')[2]
+            np.testing.assert_array_equal(
+                toolbox._centre_rank(window, rank, shape, max_elements),
+                expected)
+
+
+class Test_SlidingBackground(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        yy, xx = np.mgrid[0:96, 0:80]
+        background = 200 + 50 * np.sin(xx / 40.) * np.cos(yy / 30.)
+        particles = (rng.rand(96, 80) > 0.98) * 1000
+        self.img = (background + rng.poisson(5, background.shape) +
+                    particles).astype(np.uint16)
+        self.inner = (slice(10, -10), slice(10, -10))
+
+    def test_histogram(self):
+        for tool, kwargs in [(toolbox.sliding_median, {}),
+                             (toolbox.sliding_percentile,
+                              {'percentile': 20.})]:
+            exact = tool(self.img, window_size=9, **kwargs)
+            fast = tool(self.img, window_size=9, method='histogram', **kwargs)
+            np.testing.assert_array_equal(fast[self.inner], exact[self.inner])
+
+        # Floating point images are accepted if their values are integers
+        np.testing.assert_array_equal(
+            toolbox.sliding_median(self.img.astype(np.float32),
+                                   method='histogram'),
+            toolbox.sliding_median(self.img, method='histogram'))
+        self.assertRaises(ValueError, toolbox.sliding_median,
+                          self.img + 0.5, method='histogram')
+
+        # Too many bins for the sliding histogram: falls back to 'exact'
+        img = self.img * np.uint16(60)
+        for tool in (toolbox.sliding_median, toolbox.sliding_percentile):
+            with mock.patch.object(toolbox, '_rank_filter_background',
+                                   _fail):
+                fast = tool(img, window_size=9, method='histogram')
+            np.testing.assert_array_equal(fast, tool(img, window_size=9))
+
+    def test_downsample(self):
+        for tool in [toolbox.sliding_median, toolbox.sliding_percentile,
+                     toolbox.sliding_minima]:
+            exact = tool(self.img, window_size=16)
+            fast = tool(self.img, window_size=16, method='downsample',
+                        downsample=4)
+            self.assertEqual(fast.shape, self.img.shape)
+            self.assertLess(np.abs(fast - exact).mean(), 5.)
+
+    def test_unknown_method(self):
+        self.assertRaises(ValueError, toolbox.sliding_minima, self.img,
+                          method='histogram')
+
+
+class Test_Stack(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.imgs = (rng.rand(4, 24, 20) * 1000).astype(np.uint16)
+
+    def test_stack_equals_frames(self):
+        for tool, kwargs in [
+                (toolbox.sliding_median, {'window_size': 5}),
+                (toolbox.sliding_percentile, {'window_size': (3, 7)}),
+                (toolbox.sliding_minima, {'window_size': 4, 'weight': 0.5}),
+                (toolbox.sliding_median, {'window_size': 6,
+                                          'method': 'downsample',
+                                          'downsample': 2}),
+                (toolbox.sharpen, {}),
+                (toolbox.global_threshold, {'minima': 100, 'maxima': 800})]:
+            expected = np.array([tool(img, **kwargs) for img in self.imgs])
+            result = tool(self.imgs, **kwargs)
+            self.assertEqual(result.dtype, expected.dtype)
+            np.testing.assert_allclose(result, expected)
+
+    def test_dtype(self):
+        result = toolbox.sliding_minima(self.imgs, window_size=5)
+        self.assertEqual(result.dtype, np.float64)
+        self.assertTrue((result >= 0).all())
+
+        result = toolbox.rescale_intensity_tanh(self.imgs)
+        self.assertEqual(result.dtype, np.float64)
+        # The input is not modified in place
+        self.assertFalse(np.shares_memory(result, self.imgs))
+
+    def test_list(self):
+        imgs = list(self.imgs)
+        result = toolbox.sliding_median(imgs, window_size=5)
+        self.assertIs(result, imgs)
+        np.testing.assert_allclose(
+            result[1], toolbox.sliding_median(self.imgs[1], window_size=5))
+
+
+class Test_CompiledTools(unittest.TestCase):
+    def setUp(self):
+        self.params = params = PreprocBase.create_default_params()
+        tools = params.preproc.tools
+        tools.sliding_minima.enable = True
+        tools.sliding_minima.window_size = 9
+        tools.sharpen.enable = True
+        tools.global_threshold.enable = True
+        tools.global_threshold.maxima = 1e4
+        self.tools = PreprocTools(params)
+        rng = np.random.RandomState(0)
+        self.imgs = (rng.rand(3, 40, 32) * 1000).astype(np.uint16)
+
+    def test_compile(self):
+        compiled = self.tools.compile()
+        self.assertEqual([tool[0] for tool in compiled.tools],
+                         self.tools.get_enabled_tools())
+        for img in self.imgs:
+            expected = self.tools(img)
+            result = compiled(img)
+            self.assertEqual(result.dtype, np.float32)
+            np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-2)
+
+    def test_buffers(self):
+        compiled = self.tools.compile()
+        result = compiled(self.imgs[0], copy=False)
+        buffers = compiled._buffers
+        self.assertTrue(any(result is buf for buf in buffers))
+        result = compiled(self.imgs[1], copy=False)
+        self.assertTrue(all(a is b for a, b in zip(buffers,
+                                                   compiled._buffers)))
+        np.testing.assert_allclose(result, self.tools(self.imgs[1]),
+                                   rtol=1e-4, atol=1e-2)
+        # The next call overwrites the returned buffer
+        expected = result.copy()
+        compiled(self.imgs[2], copy=False)
+        self.assertFalse(np.allclose(result, expected))
+
+    def test_preproc_base_dtype(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            for i, img in enumerate(self.imgs):
+                io.imsave(os.path.join(tmp, 'im{:02d}.tif'.format(i)), img,
+                          check_contrast=False)
+            self.params.preproc.series.path = tmp
+            preproc = PreprocBase(self.params)
+            preproc()
+            for i, img in enumerate(self.imgs):
+                result = preproc.results['im{:02d}.tif'.format(i)]
+                self.assertEqual(result.dtype, np.float32)
+                np.testing.assert_allclose(result, self.tools(img),
+                                           rtol=1e-4, atol=1e-2)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_tools_without_out(self):
+        compiled = self.tools.compile(['rescale_intensity_tanh'])
+        result = compiled(self.imgs[0])
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_allclose(
+            result,
+            toolbox.rescale_intensity_tanh(self.imgs[0].astype(np.float32)))
+
+
+class Test_PreprocBase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.params = params = PreprocBase.create_default_params()
+        params.preproc.series.path = self.tmp
+        tools = params.preproc.tools
+        tools.sliding_minima.enable = True
+        tools.sliding_minima.window_size = 5
+        tools.sharpen.enable = True
+        rng = np.random.RandomState(0)
+        self.imgs = (rng.rand(5, 24, 20) * 1000).astype(np.uint16)
+        self.names = ['im{:02d}.tif'.format(i) for i in range(5)]
+        for name, img in zip(self.names, self.imgs):
+            io.imsave(os.path.join(self.tmp, name), img, check_contrast=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_all(self):
+        """Results in memory, with 2 workers and saved in a HDF5 file."""
+        outputs = []
+        for n_workers, path in ((1, None), (2, None),
+                                (1, os.path.join(self.tmp, 'seq.h5')),
+                                (2, os.path.join(self.tmp, 'pool.h5'))):
+            self.params.preproc.n_workers = n_workers
+            self.params.preproc.saving.path = path
+            preproc = PreprocBase(self.params)
+            preproc()
+            if path is None:
+                self.assertEqual(sorted(preproc.results), self.names)
+                outputs.append(np.array([preproc.results[name]
+                                         for name in self.names]))
+            else:
+                self.assertEqual(preproc.results, {})
+                with h5py.File(path, 'r') as f:
+                    self.assertEqual([name.decode() for name in f['names']],
+                                     self.names)
+                    outputs.append(f['images'][...])
+
+        for output in outputs[1:]:
+            self.assertEqual(output.dtype, outputs[0].dtype)
+            np.testing.assert_array_equal(output, outputs[0])
+        return outputs[0]
+
+    def test_spatial(self):
+        results = self.run_all()
+        tools = PreprocTools(self.params)
+        for img, result in zip(self.imgs, results):
+            np.testing.assert_array_equal(result, tools(img))
+
+    def test_temporal(self):
+        tools = self.params.preproc.tools
+        tools.temporal_minima.enable = True
+        tools.sequence = ['sliding_minima', 'temporal_minima', 'sharpen']
+        results = self.run_all()
+
+        ref = PreprocTools(self.params)
+        spatial = np.array([ref(img, ['sliding_minima'])
+                            for img in self.imgs])
+        temporal = ref(spatial, ['temporal_minima'])
+        for img, result in zip(temporal, results):
+            np.testing.assert_allclose(result, ref(img, ['sharpen']),
+                                       rtol=1e-5, atol=1e-3)
+
+    def test_streamed(self):
+        tools = self.params.preproc.tools
+        tools.temporal_median.enable = True
+        tools.temporal_median.window_shape = (3, 1, 1)
+        self.params.preproc.tools.output_dtype = 'native'
+        results = self.run_all()
+        self.assertEqual(results.dtype, np.uint16)
+
+
+def _fail(*args, **kwargs):
+    raise AssertionError('The tool should not be called.')
+
+
+class Test_PreprocCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.params = PreprocBase.create_default_params()
+        self.params.preproc.cache.path = self.tmp
+        tools = self.params.preproc.tools
+        tools.sliding_minima.enable = True
+        tools.sliding_minima.window_size = 5
+        tools.sharpen.enable = True
+        rng = np.random.RandomState(0)
+        self.imgs = (rng.rand(3, 40, 32) * 1000).astype(np.uint16)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_hit(self):
+        tools = PreprocTools(self.params)
+        expected = tools(self.imgs[0])
+        self.assertEqual(len(os.listdir(self.tmp)), 1)
+        with mock.patch.object(toolbox, 'sharpen', _fail):
+            np.testing.assert_array_equal(tools(self.imgs[0]), expected)
+            # Same tools and dtype policy as PreprocTools.__call__
+            compiled = tools.compile()
+            np.testing.assert_array_equal(compiled(self.imgs[0]), expected)
+            compiled = tools.compile(dtype=np.float64)
+            self.assertRaises(AssertionError, compiled, self.imgs[0])
+
+        compiled = tools.compile(dtype=np.float64)
+        expected = compiled(self.imgs[0])
+        with mock.patch.object(toolbox, 'sharpen', _fail):
+            compiled = tools.compile(dtype=np.float64)
+            np.testing.assert_array_equal(
+                compiled(self.imgs[0], copy=False), expected)
+            # A different image or different parameters are not cached
+            self.assertRaises(AssertionError, compiled, self.imgs[1])
+            self.params.preproc.tools.sliding_minima.window_size = 7
+            self.assertRaises(AssertionError, PreprocTools(self.params),
+                              self.imgs[0])
+
+    def test_eviction(self):
+        cache = PreprocCache(self.tmp, max_size=2.5 * self.imgs[0].nbytes /
+                             2 ** 20)
+        keys = [cache.make_key(img, 'tools') for img in self.imgs]
+        self.assertEqual(len(set(keys)), 3)
+        for i in range(2):
+            cache.save(keys[i], self.imgs[i])
+            os.utime(cache._entry(keys[i]), (i, i))
+        # Accessed more recently than keys[1]
+        cache.load(keys[0])
+        cache.save(keys[2], self.imgs[2])
+        self.assertIn(keys[0], cache)
+        self.assertNotIn(keys[1], cache)
+        self.assertIn(keys[2], cache)
+        np.testing.assert_array_equal(cache.load(keys[2]), self.imgs[2])
+
+    def test_running_size(self):
+        cache = PreprocCache(self.tmp, max_size=2.5 * self.imgs[0].nbytes /
+                             2 ** 20)
+        with mock.patch.object(PreprocCache, '_entries',
+                               wraps=cache._entries) as entries:
+            cache.save('a', self.imgs[0])
+            cache.save('a', self.imgs[0])
+            cache.save('b', self.imgs[1])
+            # Scanned once on the first save, then tracked
+            self.assertEqual(entries.call_count, 1)
+            self.assertEqual(cache._size, cache.size())
+            cache.save('c', self.imgs[2])
+            self.assertEqual(entries.call_count, 3)
+        self.assertEqual(cache._size, cache.size())
+        self.assertEqual(len(os.listdir(self.tmp)), 2)
+
+    def test_worker_tools(self):
+        src = os.path.join(self.tmp, 'src.npy')
+        dst = os.path.join(self.tmp, 'dst.npy')
+        np.save(src, self.imgs)
+        np.save(dst, np.zeros(self.imgs.shape, dtype=np.float32))
+        base._init_worker(self.params, {1: ['sliding_minima', 'sharpen']})
+        cache = PreprocCache(self.tmp)
+        with mock.patch.object(PreprocCache, '_entries',
+                               wraps=cache._entries) as entries:
+            for index in range(len(self.imgs)):
+                stats = base._preproc_image((1, src, index, dst))
+                self.assertEqual(stats.records['sharpen']['calls'], 1)
+            # The tools and their cache are built once per worker
+            self.assertEqual(entries.call_count, 1)
+
+        expected = PreprocTools(self.params)
+        for img, result in zip(self.imgs, np.load(dst)):
+            np.testing.assert_array_equal(result, expected(img))
+
+    def test_stages(self):
+        for i, img in enumerate(self.imgs):
+            io.imsave(os.path.join(self.tmp, 'im{:02d}.tif'.format(i)), img,
+                      check_contrast=False)
+        self.params.preproc.series.path = self.tmp
+        self.params.preproc.cache.path = os.path.join(self.tmp, 'cache')
+        self.params.preproc.tools.temporal_median.enable = True
+        preproc = PreprocBase(self.params)
+        with mock.patch.object(PreprocCache, '_entries',
+                               wraps=preproc.tools.cache._entries) as entries:
+            preproc()
+            self.assertEqual(entries.call_count, 1)
+        self.assertEqual(len(preproc.results), 3)
+
+    def test_hash(self):
+        key = PreprocCache.make_key(self.imgs[0], 'tools')
+        with mock.patch('tomokth.preprocess.cache.xxhash', None):
+            sha_key = PreprocCache.make_key(self.imgs[0], 'tools')
+            self.assertNotEqual(sha_key, PreprocCache.make_key(
+                self.imgs[0].astype(np.int16), 'tools'))
+        self.assertEqual(key, PreprocCache.make_key(self.imgs[0].copy(),
+                                                    'tools'))
+        self.assertNotEqual(key, PreprocCache.make_key(self.imgs[0], 'other'))
+
+
+class Test_ToolStats(unittest.TestCase):
+    def setUp(self):
+        self.params = PreprocBase.create_default_params()
+        tools = self.params.preproc.tools
+        tools.sliding_minima.enable = True
+        tools.sliding_minima.window_size = 5
+        tools.sharpen.enable = True
+        self.imgs = np.zeros((3, 40, 32), dtype=np.uint16)
+
+    def test_records(self):
+        tools = PreprocTools(self.params)
+        for img in self.imgs:
+            tools(img)
+        compiled = tools.compile()
+        compiled(self.imgs[0])
+
+        records = tools.stats.records
+        self.assertEqual(sorted(records), ['sharpen', 'sliding_minima'])
+        record = records['sliding_minima']
+        self.assertEqual(record['calls'], 4)
+        self.assertGreater(record['time'], 0.)
+        self.assertIsNone(record['peak_bytes'])
+        self.assertEqual(record['in_shape'], [40, 32])
+        # Cast by the dtype policy
+        self.assertEqual(record['in_dtype'], 'float32')
+        self.assertEqual(records['sharpen']['out_dtype'], 'float32')
+
+        other = ToolStats()
+        other.record('sharpen', 1., self.imgs[0], self.imgs[0])
+        tools.stats.merge(other)
+        self.assertEqual(records['sharpen']['calls'], 5)
+        self.assertEqual(records['sharpen']['out_dtype'], 'uint16')
+        self.assertEqual(tools.stats.as_rows()[0]['tool'], 'sharpen')
+
+    def test_memory(self):
+        self.params.preproc.stats.memory = True
+        tools = PreprocTools(self.params)
+        try:
+            tools(self.imgs[0])
+            # Tracing is stopped after each measured call
+            self.assertFalse(tracemalloc.is_tracing())
+        finally:
+            tracemalloc.stop()
+        # sharpen allocates its output and a second blurred image
+        self.assertGreaterEqual(tools.stats.records['sharpen']['peak_bytes'],
+                                2 * self.imgs[0].size * 4)
+
+    def test_threads(self):
+        stats = ToolStats()
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda i: stats.record('tool', 1e-3),
+                              range(2000)))
+        self.assertEqual(stats.records['tool']['calls'], 2000)
+        self.assertAlmostEqual(stats.records['tool']['time'], 2.)
+
+        # Picklable, for the statistics of worker processes
+        stats = pickle.loads(pickle.dumps(stats))
+        stats.record('tool', 1.)
+        self.assertEqual(stats.records['tool']['calls'], 2001)
+
+    def test_stream(self):
+        self.params.preproc.tools.temporal_median.window_shape = (3, 1, 1)
+        tools = PreprocTools(self.params)
+        imgs = np.random.RandomState(0).rand(5, 8, 6)
+        streamed = list(tools.iter_temporal(iter(imgs), ['temporal_median']))
+        self.assertEqual(len(streamed), 5)
+        record = tools.stats.records['temporal_median']
+        self.assertEqual(record['calls'], 5)
+        self.assertEqual(record['out_shape'], [8, 6])
+
+        # The time spent reading the input is excluded
+        def slow_reader():
+            for img in imgs:
+                time.sleep(0.02)
+                yield img
+
+        stats = ToolStats()
+        list(stats.measure_stream('stream', lambda imgs: (img for img in imgs),
+                                  slow_reader()))
+        self.assertEqual(stats.records['stream']['calls'], 5)
+        self.assertLess(stats.records['stream']['time'], 0.05)
+
+    def test_dump(self):
+        self.params.preproc.stats.enable = False
+        self.assertIsNone(PreprocTools(self.params).stats)
+
+        stats = ToolStats()
+        stats.record('sharpen', 0.5, self.imgs[0], self.imgs[0])
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'stats.json')
+            stats.to_json(path)
+            with open(path) as f:
+                rows = json.load(f)
+            self.assertEqual(rows[0]['tool'], 'sharpen')
+            self.assertEqual(rows[0]['in_shape'], [40, 32])
+
+            path = os.path.join(tmp, 'stats.csv')
+            stats.to_csv(path)
+            with open(path) as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual(rows[0]['in_shape'], '40x32')
+            self.assertEqual(float(rows[0]['time_per_call']), 0.5)
+        finally:
+            shutil.rmtree(tmp)
+
+
+class Test_Tiling(unittest.TestCase):
+    def setUp(self):
+        self.params = PreprocBase.create_default_params()
+        rng = np.random.RandomState(0)
+        self.img = (rng.rand(70, 53) * 1000).astype(np.uint16)
+
+    def check(self, sequence, **kwargs):
+        tools = self.params.preproc.tools
+        for tool in sequence:
+            tools.__dict__[tool].enable = True
+            for key, value in kwargs.get(tool, {}).items():
+                tools.__dict__[tool].__dict__[key] = value
+
+        expected = PreprocTools(self.params)(self.img)
+        self.params.preproc.tiling.tile_size = (16, 20)
+        for nb_threads in (1, 3):
+            self.params.preproc.tiling.nb_threads = nb_threads
+            tools = PreprocTools(self.params)
+            np.testing.assert_array_equal(tools(self.img), expected)
+            np.testing.assert_array_equal(tools.compile()(self.img), expected)
+
+    def test_filters(self):
+        self.check(['sliding_median', 'sharpen'],
+                   sliding_median={'window_size': 6},
+                   sharpen={'sigma1': 1.5, 'sigma2': 0.7})
+
+    def test_histogram(self):
+        self.check(['sliding_percentile', 'global_threshold'],
+                   sliding_percentile={'window_size': (5, 7),
+                                       'method': 'histogram'})
+
+    def test_wrap(self):
+        self.check(['sliding_median', 'sliding_minima'],
+                   sliding_median={'window_size': 7,
+                                   'boundary_condition': 'wrap'},
+                   sliding_minima={'window_size': 5,
+                                   'boundary_condition': 'wrap'})
+
+    def test_global_tools(self):
+        self.check(['sliding_minima', 'rescale_intensity', 'sharpen'],
+                   sliding_minima={'window_size': 9})
+
+    def test_tile_slices(self):
+        covered = np.zeros((70, 53), dtype=int)
+        for interior, extended, local in tiling.tile_slices((70, 53), 16,
+                                                            (3, 5)):
+            covered[interior] += 1
+            for sl_int, sl_ext, sl_loc in zip(interior, extended, local):
+                self.assertEqual(sl_ext.start + sl_loc.start, sl_int.start)
+                self.assertEqual(sl_ext.start + sl_loc.stop, sl_int.stop)
+        np.testing.assert_array_equal(covered, 1)
+
+
+class Test_DtypePolicy(unittest.TestCase):
+    def setUp(self):
+        self.params = PreprocBase.create_default_params()
+        tools = self.params.preproc.tools
+        tools.sliding_median.enable = True
+        tools.sliding_median.window_size = 5
+        tools.sliding_median.weight = 0.5
+        tools.equalize_hist_adapt.enable = True
+        rng = np.random.RandomState(0)
+        self.img = (rng.rand(40, 32) * 1000 + 10).astype(np.uint16)
+
+    def test_dtype(self):
+        self.params.preproc.tools.dtype = None
+        legacy = PreprocTools(self.params)(self.img)
+        self.assertEqual(legacy.dtype, np.float64)
+
+        self.params.preproc.tools.dtype = 'float32'
+        tools = PreprocTools(self.params)
+        result = tools(self.img)
+        self.assertEqual(result.dtype, np.float32)
+        np.testing.assert_allclose(result, legacy, rtol=1e-4, atol=1e-3)
+        self.assertEqual(tools.compile()(self.img).dtype, np.float32)
+
+    def test_native_output(self):
+        self.params.preproc.tools.output_dtype = 'native'
+        tools = PreprocTools(self.params)
+        result = tools(self.img)
+        self.assertEqual(result.dtype, np.uint16)
+        self.params.preproc.tools.output_dtype = None
+        expected = PreprocTools(self.params)(self.img)
+        np.testing.assert_array_equal(
+            result, np.clip(np.rint(expected), 0, 65535))
+        np.testing.assert_array_equal(tools.compile()(self.img, copy=False),
+                                      result)
+
+    def test_native_stages(self):
+        tools = self.params.preproc.tools
+        tools.sliding_median.enable = False
+        tools.equalize_hist_adapt.enable = False
+        tools.sequence = ['sliding_minima', 'temporal_median',
+                          'global_threshold']
+        tools.sliding_minima.enable = True
+        tools.sliding_minima.window_size = 5
+        tools.sliding_minima.weight = 0.7
+        tools.temporal_median.enable = True
+        tools.temporal_median.window_shape = (3, 1, 1)
+        tools.global_threshold.enable = True
+        tools.global_threshold.minima = -1e4
+        rng = np.random.RandomState(1)
+        imgs = (rng.rand(5, 20, 16) * 1000).astype(np.uint16)
+
+        # The output type is applied once, after the last stage
+        ref = PreprocTools(self.params)
+        spatial = np.array([ref(img, ['sliding_minima'], cast=False)
+                            for img in imgs])
+        temporal = ref(spatial, ['temporal_median'], cast=False)
+        expected = [toolbox.cast_output(
+            ref(img, ['global_threshold'], cast=False), np.uint16)
+            for img in temporal]
+
+        tools.output_dtype = 'native'
+        tmp = tempfile.mkdtemp()
+        try:
+            for i, img in enumerate(imgs):
+                io.imsave(os.path.join(tmp, 'im{:02d}.tif'.format(i)), img,
+                          check_contrast=False)
+            self.params.preproc.series.path = tmp
+            preproc = PreprocBase(self.params)
+            preproc()
+            for i, img in enumerate(expected):
+                result = preproc.results['im{:02d}.tif'.format(i)]
+                self.assertEqual(result.dtype, np.uint16)
+                np.testing.assert_array_equal(result, img)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_cast_output(self):
+        img = np.array([-3.2, 0.5, 1.5, 300.7])
+        np.testing.assert_array_equal(toolbox.cast_output(img, np.uint8),
+                                      [0, 0, 2, 255])
+        self.assertEqual(toolbox.cast_output(img, 'float32').dtype,
+                         np.float32)
@@ -0,0 +1,162 @@
+import unittest
+import numpy as np
+from scipy import sparse
+from tomokth.operators.weights import VoxelGrid, build_weight_matrix
+from tomokth.reconstruct import MART, SMART, SlabReconstruction, mlos
+from tomokth.reconstruct.mlos import compact_columns
+
+
+def make_cameras(grid, directions, rpix=0.5, rvox=0.5):
+    """Pixel grids looking through the volume from several directions."""
+    yy, xx = np.mgrid[-2:9, -2:9].astype(float)
+    weights = []
+    for d in directions:
+        vec_pix = np.column_stack([xx.ravel(), yy.ravel(),
+                                   np.full(xx.size, -5.)])
+        weights.append(build_weight_matrix(grid, vec_pix, d, rpix, rvox))
+    return weights
+
+
+class Test_MART(unittest.TestCase):
+    Solver = MART
+
+    def setUp(self):
+        self.grid = VoxelGrid((4, 7, 7))
+        self.weights = make_cameras(self.grid, [(0.3, 0., 1.), (-0.3, 0., 1.),
+                                                (0., 0.3, 1.), (0., -0.3, 1.)])
+        volume = np.zeros(self.grid.shape, dtype=np.float32)
+        volume[1, 2, 3] = 1.
+        volume[2, 5, 1] = 2.
+        volume[3, 4, 4] = 1.5
+        self.volume = volume
+        self.images = [(w * volume.ravel()).reshape(11, 11)
+                       for w in self.weights]
+
+    def residual(self, volume):
+        return sum(np.abs(w * volume.ravel() - img.ravel()).sum()
+                   for w, img in zip(self.weights, self.images))
+
+    def test_reconstruct(self):
+        params = MART.create_default_params()
+        params.reconstruct.nb_iterations = 20
+        mart = MART(self.weights, self.grid, params)
+        volume = mart(self.images)
+        self.assertEqual(volume.shape, self.grid.shape)
+        self.assertTrue(np.all(volume >= 0.))
+        initial = np.ones(self.grid.shape, dtype=np.float32)
+        self.assertLess(self.residual(volume), 0.05 * self.residual(initial))
+        self.assertEqual(np.unravel_index(volume.argmax(), volume.shape),
+                         (2, 5, 1))
+
+    def test_mlos(self):
+        """ Compacted weight matrices give the same result as the full ones """
+        intensities = [img.ravel() for img in self.images]
+        guess = mlos(self.weights, intensities)
+        self.assertTrue(np.all(guess[self.volume.ravel() > 0] > 0))
+        self.assertLess(np.count_nonzero(guess), guess.size // 4)
+
+        params = self.Solver.create_default_params()
+        volume = self.Solver(self.weights, self.grid, params)(self.images)
+        params.reconstruct.mlos = False
+        volume_full = self.Solver(self.weights, self.grid, params)(
+            self.images, guess.reshape(self.grid.shape))
+        np.testing.assert_allclose(volume, volume_full, rtol=1e-5, atol=1e-6)
+
+    def test_mlos_negative(self):
+        weights = [sparse.csr_matrix(np.ones((1, 1)))] * 2
+        intensities = [np.array([-2.]), np.array([-3.])]
+        np.testing.assert_array_equal(mlos(weights, intensities), [0.])
+        intensities = [np.array([-2.]), np.array([3.])]
+        np.testing.assert_array_equal(mlos(weights, intensities), [0.])
+
+    def test_wrong_nb_images(self):
+        solver = self.Solver(self.weights, self.grid)
+        self.assertRaises(ValueError, solver, self.images[:2])
+
+
+class Test_CompactColumns(unittest.TestCase):
+    def test_compact_columns(self):
+        rng = np.random.RandomState(1)
+        matrix = (rng.rand(20, 30) > 0.8) * rng.rand(20, 30)
+        matrix[5] = 0.
+        matrix[-1] = 0.
+        active = np.flatnonzero(rng.rand(30) > 0.5)
+        compact = compact_columns(sparse.csr_matrix(matrix), active)
+        np.testing.assert_array_equal(compact.toarray(), matrix[:, active])
+
+
+class Test_SMART(Test_MART):
+    Solver = SMART
+
+    def test_reconstruct(self):
+        params = SMART.create_default_params()
+        params.reconstruct.nb_iterations = 50
+        volume = SMART(self.weights, self.grid, params)(self.images)
+        self.assertEqual(volume.shape, self.grid.shape)
+        initial = np.ones(self.grid.shape, dtype=np.float32)
+        self.assertLess(self.residual(volume), 0.05 * self.residual(initial))
+
+    def test_threads(self):
+        """ Result does not depend on the number of threads """
+        volumes = []
+        for nb_threads in (1, 3):
+            params = SMART.create_default_params()
+            params.reconstruct.nb_threads = nb_threads
+            volumes.append(SMART(self.weights, self.grid, params)(self.images))
+        np.testing.assert_allclose(volumes[0], volumes[1], rtol=1e-5)
+
+
+class Test_SlabReconstruction(unittest.TestCase):
+    def setUp(self):
+        self.grid = VoxelGrid((6, 40, 8))
+        yy, xx = np.mgrid[-3:44, -3:12].astype(float)
+        vec_pix = np.column_stack([xx.ravel(), yy.ravel(),
+                                   np.full(xx.size, -5.)])
+        self.cameras = [(vec_pix, d) for d in [(0.3, 0., 1.), (-0.3, 0., 1.),
+                                               (0., 0.3, 1.), (0., -0.3, 1.)]]
+        self.weights = [build_weight_matrix(self.grid, p, d, 0.5, 0.5)
+                        for p, d in self.cameras]
+        rng = np.random.RandomState(2)
+        volume = np.zeros(self.grid.size, dtype=np.float32)
+        volume[rng.randint(0, self.grid.size, 400)] = 1.
+        self.images = [w * volume for w in self.weights]
+
+        params = SlabReconstruction.create_default_params()
+        params.reconstruct.nb_iterations = 2
+        params.reconstruct.slabs.nb_slabs = 3
+        params.reconstruct.slabs.nb_workers = 2
+        self.params = params
+
+    def test_matches_smart(self):
+        slabs = SlabReconstruction(self.cameras, self.grid, 0.5, 0.5,
+                                   self.params)
+        self.assertEqual(len(slabs.bounds), 4)
+        self.assertLess(slabs.halo, 14)
+
+        expected = SMART(self.weights, self.grid, self.params)(self.images)
+        np.testing.assert_allclose(slabs(self.images), expected,
+                                   rtol=1e-5, atol=1e-6)
+
+        # Without halo, the slabs do not see the whole lines of sight
+        self.params.reconstruct.slabs.halo_footprints = 0
+        slabs = SlabReconstruction(self.cameras, self.grid, 0.5, 0.5,
+                                   self.params)
+        self.assertGreater(np.abs(slabs(self.images) - expected).max(), 1e-2)
+
+    def test_halo_fits_memory(self):
+        self.params.reconstruct.nb_iterations = 50
+        self.params.reconstruct.slabs.nb_slabs = None
+        self.params.reconstruct.slabs.max_memory = 1e3
+        slabs = SlabReconstruction(self.cameras, self.grid, 0.5, 0.5,
+                                   self.params)
+        self.assertEqual(slabs.halo, self.grid.shape[1])
+        self.assertEqual(len(slabs.bounds), 2)
+
+        rows = 12
+        self.params.reconstruct.slabs.max_memory = (
+            rows * slabs._estimate_bytes_per_row() / 2 ** 20)
+        with self.assertLogs('tomokth', 'WARNING'):
+            slabs = SlabReconstruction(self.cameras, self.grid, 0.5, 0.5,
+                                       self.params)
+        self.assertLessEqual(2 * slabs.halo + 1, rows)
+        self.assertGreater(len(slabs.bounds), 2)
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import numpy as np
+from scipy import sparse
+from tomokth.operators.math import calc_weight
+from tomokth.operators.weights import VoxelGrid, build_weight_matrix
+from tomokth.operators.cache import WeightCache
+
+
+class Test_WeightMatrix(unittest.TestCase):
+    def setUp(self):
+        self.grid = VoxelGrid((5, 6, 7), spacing=(1., 1.2, 0.8),
+                              origin=(-3., -3., 0.))
+        rng = np.random.RandomState(0)
+        self.vec_pix = np.column_stack([rng.uniform(-4., 4., 40),
+                                        rng.uniform(-4., 4., 40),
+                                        np.full(40, -10.)])
+        self.vec_normal = np.column_stack([rng.uniform(-0.4, 0.4, 40),
+                                           rng.uniform(-0.4, 0.4, 40),
+                                           np.ones(40)])
+        self.rpix, self.rvox = 0.6, 0.7
+
+    def test_matches_calc_weight(self):
+        weights = build_weight_matrix(self.grid, self.vec_pix, self.vec_normal,
+                                      self.rpix, self.rvox, chunk_size=16,
+                                      dtype=np.float64)
+        self.assertEqual(weights.shape, (40, self.grid.size))
+
+        centers = self.grid.centers()
+        expected = np.array([[calc_weight(self.rpix, p, self.rvox, v, n)
+                              for v in centers]
+                             for p, n in zip(self.vec_pix, self.vec_normal)])
+        np.testing.assert_allclose(weights.toarray(), expected, atol=1e-5)
+        self.assertEqual(weights.nnz, np.count_nonzero(expected))
+
+    def test_grid_centers(self):
+        centers = self.grid.centers([0, self.grid.size - 1])
+        np.testing.assert_allclose(centers, [[-3., -3., 0.], [3., 3., 3.2]])
+
+
+class Test_WeightCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.grid = VoxelGrid((3, 4, 5))
+        self.calib = np.arange(12.).reshape(3, 4)
+        rng = np.random.RandomState(0)
+        self.matrix = sparse.random(30, self.grid.size, density=0.1,
+                                    format='csr', random_state=rng)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_key(self):
+        key = WeightCache.make_key(self.calib, self.grid, 0.5, 0.5)
+        self.assertEqual(key, WeightCache.make_key(self.calib.copy(),
+                                                   VoxelGrid((3, 4, 5)),
+                                                   0.5, 0.5))
+        self.assertNotEqual(key, WeightCache.make_key(self.calib, self.grid,
+                                                      0.5, 0.6))
+        self.assertNotEqual(key, WeightCache.make_key(self.calib + 1e-9,
+                                                      self.grid, 0.5, 0.5))
+
+    def test_get(self):
+        cache = WeightCache(self.path)
+        key = WeightCache.make_key(self.calib, self.grid, 0.5, 0.5)
+        calls = []
+
+        def build():
+            calls.append(1)
+            return self.matrix
+
+        for i in range(2):
+            matrix = cache.get(key, build)
+            np.testing.assert_array_equal(matrix.toarray(),
+                                          self.matrix.toarray())
+        self.assertEqual(len(calls), 1)
+        # Arrays are memory-mapped, not read into memory
+        self.assertFalse(matrix.data.flags.writeable)
+
+    def test_evict(self):
+        cache = WeightCache(self.path)
+        keys = ['a', 'b', 'c']
+        for t, key in enumerate(keys):
+            cache.save(key, self.matrix)
+            os.utime(os.path.join(self.path, key), (t, t))
+
+        cache.load('a')
+        entry_size = cache.size() // 3
+        cache.max_size = 2.5 * entry_size / 2 ** 20
+        cache.evict()
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+    def test_running_size(self):
+        cache = WeightCache(self.path)
+        cache.save('a', self.matrix)
+        entry_size = cache.size()
+        self.assertEqual(cache._size, entry_size)
+        cache.max_size = 2.5 * entry_size / 2 ** 20
+        with mock.patch.object(WeightCache, '_entries',
+                               wraps=cache._entries) as entries:
+            cache.save('b', self.matrix)
+            cache.save('b', self.matrix)
+            self.assertEqual(entries.call_count, 0)
+            self.assertEqual(cache._size, 2 * entry_size)
+            os.utime(os.path.join(self.path, 'a'), (0, 0))
+            cache.save('c', self.matrix)
+            self.assertEqual(entries.call_count, 1)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache._size, cache.size())
@@ -1,9 +1,127 @@
+from __future__ import print_function
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+from glob import glob
+
 import h5py
+import numpy as np
+from six.moves import queue
+
+from tomokth.operators.io import imread
+from tomokth.util.util import logger
+
+
+def _normalize_attr(value):
+    """Converts an HDF5 attribute to a hashable Python scalar."""
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.generic):
+        value = value.item()
+        if isinstance(value, bytes):
+            return value.decode()
+    return value
+
+
+def _make_table(entries, keys):
+    """
+    Packs `(path, attributes)` entries into a structured array with a column
+    `path` and one column per key, which is stored compactly in HDF5.
+
+    """
+    columns = [np.array([path.encode() for path, attrs in entries] or [b''])]
+    for key in keys:
+        values = [attrs[key] for path, attrs in entries]
+        if values and isinstance(values[0], str):
+            values = [value.encode() for value in values]
+        columns.append(np.array(values or [0]))
+
+    dtype = [('path', columns[0].dtype)]
+    dtype += [(key, column.dtype) for key, column in zip(keys, columns[1:])]
+    table = np.empty(len(entries), dtype=dtype)
+    for name, column in zip(table.dtype.names, columns):
+        table[name] = column[:len(entries)]
+    return table
+
+
+def _read_table(table):
+    """Inverse of `_make_table`: returns a dict {attribute values: path}."""
+    keys = table.dtype.names[1:]
+    index = {}
+    for row in table:
+        values = tuple(_normalize_attr(row[key]) for key in keys)
+        index[values] = _normalize_attr(row['path'])
+    return index
+
+
+class _HandlePool(object):
+    """
+    Pool of at most `size` read-only handles of an HDF5 file, opened lazily
+    and kept open, so that concurrent readers do not share a handle.
+
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._idle = []
+        self._nb_open = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def handle(self):
+        """Context manager lending a read-only h5py.File."""
+        with self._cond:
+            while not self._idle and self._nb_open >= self.size:
+                self._cond.wait()
+            f = self._idle.pop() if self._idle else None
+            if f is None:
+                self._nb_open += 1
+
+        if f is None:
+            try:
+                f = h5py.File(self.path, 'r')
+            except Exception:
+                with self._cond:
+                    self._nb_open -= 1
+                    self._cond.notify()
+                raise
+
+        try:
+            yield f
+        finally:
+            with self._cond:
+                self._idle.append(f)
+                self._cond.notify()
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Waits until no handle is lent, closes all the handles, and prevents
+        new ones from being opened until the end of the context, during
+        which the file can be reopened for writing.
+
+        """
+        with self._cond:
+            while len(self._idle) < self._nb_open:
+                self._cond.wait()
+            for f in self._idle:
+                f.close()
+            self._idle = []
+            self._nb_open = 0
+            yield
 
 
 class DataBase(object):
-    def __init__(self, path=None):
+    # Attributes identifying the top-level groups and the datasets, which
+    # are indexed in the group `_index_name` of the HDF5 file. Top-level
+    # names starting with an underscore are reserved for such internal data
+    _grp_keys = ()
+    _dset_keys = ()
+    _index_name = '_index'
+
+    def __init__(self, path=None, nb_read_handles=4):
         """Initialize attributes"""
 
         self.path = path
@@ -11,9 +129,44 @@ class DataBase(object):
         self.h5file = None
         self.h5dict = dict()
         self.image_type = None
+        self.nb_read_handles = nb_read_handles
+        self.storage = dict()
+        self._index = None
+        # Modification time of the file when the index was loaded
+        self._index_mtime = None
+        self._pool = None
+        self._lock = threading.RLock()
+
+    def config(self, filename, chunks=None, compression=None,
+               compression_opts=None, shuffle=False):
+        """Configure defaults and initialize paths
+
+        The other parameters set how the images are stored by `create_h5`.
+        By default the datasets are contiguous and uncompressed. Reading
+        compressed datasets is transparent.
+
+        Parameters
+        ----------
+        filename : str
+            Name of the HDF5 file
+
+        chunks : tuple of int or bool, optional
+            Shape of the chunks of the image datasets, clipped to the shape
+            of the images. True lets h5py guess the chunks. Compression and
+            shuffle require chunked datasets: if `chunks` is None, each image
+            is then stored as a single chunk.
 
-    def config(self, filename):
-        """Configure defaults and initialize paths"""
+        compression : str or int, optional
+            Compression filter: 'gzip', 'lzf', or the identifier of any
+            filter available in HDF5, e.g. loaded from a plugin.
+
+        compression_opts : optional
+            Options of the filter, e.g. the level of gzip (0-9).
+
+        shuffle : bool
+            Applies the byte shuffle filter before compression.
+
+        """
 
         if self.path is None:
             self.path = os.getcwd()
@@ -27,55 +180,390 @@ class DataBase(object):
         if self.image_type is None:
             self.image_type = 'tif'
 
+        if compression is not None and not self._filter_avail(compression):
+            raise ValueError(
+                'Compression filter {} is not available'.format(compression))
+        storage = dict(chunks=chunks, compression=compression,
+                       compression_opts=compression_opts, shuffle=shuffle)
+        self._check_storage(storage)
+        self.storage = storage
+
+    def _check_storage(self, storage):
+        """
+        Checks the storage options by creating a dataset in an HDF5 file in
+        memory, so that invalid options raise a ValueError in `config`
+        instead of failing for each image in `create_h5`.
+
+        """
+        chunks = storage['chunks']
+        if chunks is not None and chunks is not True and len(chunks) != 2:
+            raise ValueError('chunks must be a tuple (ny, nx) or True.')
+
+        shape = (64, 64)
+        try:
+            with h5py.File('storage_check', 'w', driver='core',
+                           backing_store=False) as f:
+                f.create_dataset('img', shape=shape, dtype=np.uint16,
+                                 **self._storage_kwargs(shape, storage))
+        except (ValueError, TypeError) as error:
+            raise ValueError('Invalid storage options {}: {}'.format(
+                storage, error))
+
+    @staticmethod
+    def _filter_avail(compression):
+        """Checks if a compression filter is available in HDF5."""
+        if compression in ('gzip', 'lzf', 'szip'):
+            return compression in h5py.filters.encode
+        try:
+            return bool(h5py.h5z.filter_avail(int(compression)))
+        except (TypeError, ValueError):
+            return False
+
+    def _storage_kwargs(self, shape, storage=None):
+        """Keyword arguments of `create_dataset` storing an array of shape
+        `shape` with the options given to `config`, or `storage`."""
+        if storage is None:
+            storage = self.storage
+        kwargs = {key: value for key, value in storage.items()
+                  if value is not None and value is not False}
+        chunks = kwargs.get('chunks')
+        if kwargs and chunks is None:
+            kwargs['chunks'] = tuple(shape)
+        elif chunks is not None and chunks is not True:
+            kwargs['chunks'] = tuple(
+                min(chunk, n) for chunk, n in zip(chunks, shape))
+
+        return kwargs
+
     def _parse_image_path(self, path):
         filename = os.path.basename(path)
         filename, ext = os.path.splitext(filename)
         return filename
 
     def open_h5(self, mode='r'):
-        """Returns a h5py.File object"""
-        if self.f is not None:
-            self.f.close()
+        """
+        Returns the long-lived h5py.File handle of the database, which stays
+        open until `close` is called. The handle is reused if it is already
+        open in a compatible mode: a handle open for writing also serves
+        reads. When writing is requested ('a' or 'r+') on a handle open for
+        reading, the handle is reopened once the read-only handles of the
+        pool are returned, since HDF5 cannot open a file for writing while
+        it is open for reading.
 
-        self.f = h5py.File(self.h5file, mode)
-        return self.f
+        """
+        with self._lock:
+            if self.f and (mode == 'r' or (mode in ('a', 'r+') and
+                                           self.f.mode == 'r+')):
+                return self.f
 
-    def create_h5(self):
-        """Creates a HDF5 file with all data in it"""
-        pass
+            with self._get_pool().exclusive():
+                if self.f:
+                    self.f.close()
+                self.f = h5py.File(self.h5file, mode)
 
-    def refresh_h5dict(self):
-        with self.open_h5() as f:
-            for key in f['/'].keys():
-                self.h5dict[key] = f[key].keys()
+            return self.f
 
-    def get_grp(self, **kwargs):
-        """Returns a HDF5 group containing datasets of a particular camera.
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = _HandlePool(self.h5file, self.nb_read_handles)
+            return self._pool
+
+    @contextmanager
+    def read_handle(self):
+        """
+        Context manager lending one of the pooled read-only handles, for
+        concurrent readers in several threads.
+
+        """
+        with self._get_pool().handle() as f:
+            yield f
+
+    def close(self):
+        """Closes the handle of the database and the pooled handles."""
+        with self._lock:
+            if self._pool is not None:
+                with self._pool.exclusive():
+                    self._pool = None
+            if self.f:
+                self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def create_h5(self, nb_workers=1, queue_size=16, processes=False):
+        """Creates a HDF5 file with all data in it
 
         Parameters
         ----------
-        kwargs : dict
-            All attributes to be matched.
+        nb_workers : int
+            Number of workers decoding the images. With more than one worker,
+            the images are decoded in a pool and written by a single thread.
+
+        queue_size : int
+            Maximum number of decoded images waiting to be written, which
+            bounds the memory used by the ingestion.
+
+        processes : bool
+            Decodes in a process pool instead of a thread pool, for decoders
+            holding the GIL.
 
         """
+        list_of_images = glob(self.path + '/*.' + self.image_type)
 
+        f = self.open_h5('a')
+        self._ingest(list_of_images,
+                     lambda path, arr: self._write_image(f, path, arr),
+                     nb_workers, queue_size, processes)
+
+        self.build_index(f)
+        f.flush()
+
+        self.refresh_h5dict()
+
+    def _write_image(self, f, path, arr):
+        """Writes the image `arr` read from `path` into the HDF5 file `f`."""
+        raise NotImplementedError
+
+    def _warn_exists(self, fname):
+        print('WARNING: Image dataset ' + fname + ' already exists in ' +
+              self.h5file)
+
+    @staticmethod
+    def _ingest(paths, write, nb_workers=1, queue_size=16, processes=False):
+        """
+        Reads the images `paths` and calls `write(path, arr)` for each of
+        them, in the order of `paths`.
+
+        With several workers, the images are decoded by a pool, and the
+        pending decodings are put in a queue of at most `queue_size` items.
+        A single writer thread drains the queue, so that the HDF5 file is
+        only written by one thread and the layout of the file is the same as
+        with a sequential ingestion.
+
+        """
+        if nb_workers <= 1:
+            for path in paths:
+                write(path, imread(path))
+            return
+
+        tasks = queue.Queue(queue_size)
+        errors = []
+
+        def writer():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                path, future = task
+                if errors:
+                    # Drains the queue so that the producer does not block
+                    continue
+                try:
+                    write(path, future.result())
+                except BaseException as error:
+                    errors.append(error)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        Executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        try:
+            with Executor(nb_workers) as executor:
+                for path in paths:
+                    if errors:
+                        break
+                    tasks.put((path, executor.submit(imread, path)))
+        finally:
+            tasks.put(None)
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+    def refresh_h5dict(self):
         f = self.open_h5()
+        for key in f['/'].keys():
+            if not key.startswith('_'):
+                self.h5dict[key] = list(f[key].keys())
+
+    def _scan(self, f):
+        """
+        Reads the attributes `_grp_keys` of the top-level groups and
+        `_dset_keys` of the datasets of the open HDF5 file `f`. Returns the
+        tables of the index.
+
+        """
+        groups = []
+        for name, grp in f.items():
+            if name.startswith('_') or not isinstance(grp, h5py.Group):
+                continue
+            attrs = {key: _normalize_attr(grp.attrs[key])
+                     for key in self._grp_keys if key in grp.attrs}
+            if len(attrs) == len(self._grp_keys):
+                groups.append((grp.name, attrs))
+
+        datasets = []
+
+        def visit(name, obj):
+            if isinstance(obj, h5py.Dataset) and all(
+                    key in obj.attrs for key in self._dset_keys):
+                datasets.append((obj.name, {
+                    key: _normalize_attr(obj.attrs[key])
+                    for key in self._dset_keys}))
+
+        for name, obj in f.items():
+            if not name.startswith('_') and isinstance(obj, h5py.Group):
+                obj.visititems(visit)
+
+        return {'groups': _make_table(groups, self._grp_keys),
+                'datasets': _make_table(datasets, self._dset_keys)}
+
+    def build_index(self, f):
+        """
+        Indexes the top-level groups by the attributes `_grp_keys` and the
+        datasets by the attributes `_dset_keys`, and stores the index as two
+        tables `groups` and `datasets` of the group `_index` of the HDF5
+        file `f`, open for writing. Called by `create_h5`, and by
+        `rebuild_index` if the file was modified externally.
+
+        """
+        tables = self._scan(f)
+        if self._index_name in f:
+            del f[self._index_name]
+        grp = f.create_group(self._index_name)
+        for kind, table in tables.items():
+            grp.create_dataset(kind, data=table)
+
+        self._index = {kind: _read_table(table)
+                       for kind, table in tables.items()}
+        self._index_mtime = self._file_mtime()
+        return self._index
+
+    def rebuild_index(self):
+        """Rebuilds the index stored in the HDF5 file from the attributes of
+        all groups and datasets, for instance after the file was modified
+        externally. If the file cannot be written, the index is only built
+        in memory."""
+        try:
+            f = self.open_h5('a')
+        except (IOError, OSError):
+            self._scan_index()
+            return self._index
 
-        for grp in f.values():
-            match = True
-            for attr_key, attr_value in kwargs.items():
-                if grp.attrs[attr_key] != attr_value:
-                    match = False
+        return self.build_index(f)
 
-            if match:
+    def _file_mtime(self):
+        try:
+            return os.path.getmtime(self.h5file)
+        except OSError:
+            return None
+
+    def _scan_index(self):
+        """Builds the index in memory only, without writing the file."""
+        mtime = self._file_mtime()
+        with self.read_handle() as f:
+            self._index = {kind: _read_table(table)
+                           for kind, table in self._scan(f).items()}
+        self._index_mtime = mtime
+
+    def _refresh_index(self):
+        """
+        Called when a query is not found in the index: rescans the file in
+        memory if it was modified since the index was loaded, e.g. by
+        another program, and returns whether it was rescanned. The index
+        stored in the file is only rewritten by `rebuild_index`.
+
+        """
+        if self._index is not None and self._file_mtime() == self._index_mtime:
+            return False
+
+        logger.debug('Rescanning the index of ' + self.h5file)
+        self._scan_index()
+        return True
+
+    def _read_index(self, f):
+        """Loads the index stored in `f` into dictionaries, if any."""
+        grp = f.get(self._index_name)
+        if grp is None:
+            return None
+
+        self._index_mtime = self._file_mtime()
+        self._index = {kind: _read_table(grp[kind][...])
+                       for kind in ('groups', 'datasets')}
+        return self._index
+
+    @staticmethod
+    def _check_keys(kwargs, keys):
+        unknown = set(kwargs) - set(keys)
+        if unknown:
+            raise ValueError('Attributes {} are not indexed, only {}'.format(
+                sorted(unknown), list(keys)))
+
+    def _find(self, f, kind, keys, kwargs):
+        """
+        Returns the object of `f` whose attributes match `kwargs`, through
+        the index, or `None`. Queries on exactly the indexed keys are
+        dictionary lookups, other queries scan the index in memory.
+
+        """
+        if self._index is None and self._read_index(f) is None:
+            return None
+
+        index = self._index[kind]
+        path = None
+        if set(kwargs) == set(keys):
+            path = index.get(tuple(kwargs[key] for key in keys))
+        else:
+            for values, candidate in index.items():
+                attrs = dict(zip(keys, values))
+                if all(attrs.get(key) == value
+                       for key, value in kwargs.items()):
+                    path = candidate
+                    break
+
+        if path is not None and path in f:
+            return f[path]
+
+        return None
+
+    def get_grp(self, f=None, **kwargs):
+        """Returns a HDF5 group containing datasets of a particular camera.
+        If it is not in the index and the file was modified since the index
+        was loaded, the file is rescanned once in memory.
+
+        Parameters
+        ----------
+        f : h5py.File, optional
+            Open HDF5 file, by default the handle of the database.
+
+        kwargs : dict
+            All attributes to be matched.
+
+        """
+        self._check_keys(kwargs, self._grp_keys)
+        for attempt in range(2):
+            if attempt and not self._refresh_index():
+                break
+            grp = self._find(f or self.open_h5(), 'groups', self._grp_keys,
+                             kwargs)
+            if grp is not None:
                 return grp
 
-        if not match:
-            raise ValueError('Cannot locate camera group in ' + self.h5file)
+        raise ValueError('Cannot locate camera group in ' + self.h5file)
+
+    def get_camera_grp(self, camera, f=None):
+        """Returns the top-level HDF5 group of a camera."""
+        return self.get_grp(f, cam=camera)
 
     def get_dset(self, camera, **kwargs):
         """Returns a numpy array corresponding to a calibration image stored as a dataset in the HDF5 file.
-        Array located by matching all attribute keys and values.
+        Array located by matching all attribute keys and values, as
+        `get_grp`. The array is read with one of the pooled read-only
+        handles, so that several threads can read concurrently.
 
         Parameters
         ----------
@@ -86,14 +574,14 @@ class DataBase(object):
             Key & value of attributes to match the dataset
         """
 
-        grp = self.get_camera_grp(camera)
-        for dset in grp.values():
-            match = True
-            for attr_key, attr_value in kwargs.items():
-                if dset.attrs[attr_key] != attr_value:
-                    match = False
-
-            if match:
-                return dset[...]
+        kwargs['cam'] = camera
+        self._check_keys(kwargs, self._dset_keys)
+        for attempt in range(2):
+            if attempt and not self._refresh_index():
+                break
+            with self.read_handle() as f:
+                dset = self._find(f, 'datasets', self._dset_keys, kwargs)
+                if dset is not None:
+                    return dset[...]
 
         raise ValueError('Cannot locate dataset in ' + self.h5file)
@@ -11,19 +11,19 @@ Provides
 
 """
 
-from __future__ import print_function
 import os
-from glob import glob
-from tomokth.operators.io import imread
 from .base import DataBase
 
 
 class CalibrationData(DataBase):
     """Contains the calibration data object and assosciated member functions."""
 
-    def config(self, filename='calibration.h5'):
-        """Configure defaults and initialize paths"""
-        super(CalibrationData, self).config(filename)
+    _grp_keys = ('cam',)
+    _dset_keys = ('cam', 'z')
+
+    def config(self, filename='calibration.h5', **storage):
+        """Configure defaults and initialize paths, see `DataBase.config`"""
+        super(CalibrationData, self).config(filename, **storage)
 
     def _parse_image_path(self, path):
         filename = super(CalibrationData, self)._parse_image_path(path)
@@ -31,30 +31,23 @@ class CalibrationData(DataBase):
         dummy, camera_index = filename.split('mm_cam')
         return int(zloc), camera, int(camera_index)
 
-    def create_h5(self):
-        """Creates a HDF5 file with all calibration data in it"""
-        list_of_images = glob(self.path + '/*.' + self.image_type)
-
-        with self.open_h5('a') as f:
-            for path in list_of_images:
-                arr = imread(path)
-                fname = os.path.basename(path)
-                z_loc, camera, camera_index = self._parse_image_path(path)
-                if camera not in f.keys():
-                    grp = f.create_group(camera)
-                    grp.attrs['cam'] = camera_index
-                else:
-                    grp = f[camera]
-
-                try:
-                    dset = grp.create_dataset(fname, data=arr)
-                    dset.attrs['cam'] = camera_index
-                    dset.attrs['z'] = z_loc
-                except RuntimeError:
-                    print('WARNING: Image dataset ' + fname + ' already exists in ' + self.h5file)
-                    pass
-
-        self.refresh_h5dict()
+    def _write_image(self, f, path, arr):
+        fname = os.path.basename(path)
+        z_loc, camera, camera_index = self._parse_image_path(path)
+        if camera not in f.keys():
+            grp = f.create_group(camera)
+            grp.attrs['cam'] = camera_index
+        else:
+            grp = f[camera]
+
+        if fname in grp:
+            self._warn_exists(fname)
+            return
+
+        dset = grp.create_dataset(
+            fname, data=arr, **self._storage_kwargs(arr.shape))
+        dset.attrs['cam'] = camera_index
+        dset.attrs['z'] = z_loc
 
     def get_dset(self, camera, z_loc):
         """Returns a numpy array corresponding to a calibration image stored as a dataset in the HDF5 file.
@@ -72,11 +65,13 @@ class CalibrationData(DataBase):
                                                      z=z_loc)
 
     def save_camera_calibration(self, camera, calib_arr):
-        with self.open_h5('a') as f:
-            grp = self.get_camera_grp(camera, f)
-            grp['calib'] = calib_arr
+        f = self.open_h5('a')
+        grp = self.get_camera_grp(camera, f)
+        if 'calib' in grp:
+            del grp['calib']
+        grp['calib'] = calib_arr
+        f.flush()
 
     def get_camera_calibration(self, camera):
-        with self.open_h5() as f:
-            grp = self.get_camera_grp(camera, f)
-            return grp['calib'][...]
+        grp = self.get_camera_grp(camera)
+        return grp['calib'][...]
@@ -11,19 +11,63 @@ Provides
 
 """
 
-from __future__ import print_function
 import os
-from glob import glob
-from tomokth.operators.io import imread
-from .base import DataBase
+from contextlib import contextmanager
+
+import h5py
+import numpy as np
+from .base import DataBase, _HandlePool
 
 
 class ParticleData(DataBase):
     """Contains the particle data object and assosciated member functions."""
 
-    def config(self, filename='particle.h5'):
-        """Configure defaults and initialize paths"""
-        super(ParticleData, self).config(filename)
+    _grp_keys = ('t',)
+    _dset_keys = ('cam', 'ab', 't')
+
+    def __init__(self, path=None, nb_read_handles=4):
+        super(ParticleData, self).__init__(path, nb_read_handles)
+        # HDF5 file of the stacked layout, see `stack_images`
+        self.stack_file = None
+        # Coordinates of the stacked layout, with the modification time of
+        # its file when they were read
+        self._stack_coords = None
+        self._stack_mtime = None
+        self._stack_pool = None
+
+    def config(self, filename='particle.h5', stack_filename=None, **storage):
+        """Configure defaults and initialize paths, see `DataBase.config`.
+        The stacked layout is written in `stack_filename`, by default the
+        name of the HDF5 file followed by `_stack`."""
+        super(ParticleData, self).config(filename, **storage)
+        if stack_filename is None:
+            stack_filename = os.path.splitext(
+                os.path.basename(self.h5file))[0] + '_stack.h5'
+        self.stack_file = os.path.join(self.path, stack_filename)
+
+    def close(self):
+        """Closes the handles of the database and of the stacked layout."""
+        super(ParticleData, self).close()
+        self._close_stack_handles()
+
+    def _close_stack_handles(self):
+        with self._lock:
+            if self._stack_pool is not None:
+                with self._stack_pool.exclusive():
+                    self._stack_pool = None
+
+    @contextmanager
+    def _stack_handle(self):
+        """Context manager lending a read-only handle of the stacked
+        layout."""
+        with self._lock:
+            if self._stack_pool is None:
+                self._stack_pool = _HandlePool(self.stack_file,
+                                               self.nb_read_handles)
+            pool = self._stack_pool
+
+        with pool.handle() as f:
+            yield f
 
     def _parse_image_path(self, path):
         filename = super(ParticleData, self)._parse_image_path(path)
@@ -34,38 +78,31 @@ class ParticleData(DataBase):
         time_str = 't=' + snapshot[1:]
         return camera, camera_index, ab, time, time_str
 
-    def create_h5(self):
-        """Creates a HDF5 file with all particle data in it"""
-        list_of_images = glob(self.path + '/*.' + self.image_type)
-
-        with self.open_h5('a') as f:
-            for path in list_of_images:
-                arr = imread(path)
-                fname = os.path.basename(path)
-                camera, camera_index, ab, time, time_str = self._parse_image_path(path)
-                if time_str not in f.keys():
-                    grp = f.create_group(time_str)
-                    grp.attrs['t'] = time
-                else:
-                    grp = f[time_str]
-
-                if camera not in grp.keys():
-                    subgrp = grp.create_group(camera)
-                    subgrp.attrs['t'] = time
-                    subgrp.attrs['cam'] = camera_index
-                else:
-                    subgrp = grp[camera]
-
-                try:
-                    dset = subgrp.create_dataset(fname, data=arr)
-                    dset.attrs['t'] = time
-                    dset.attrs['cam'] = camera_index
-                    dset.attrs['ab'] = ab
-                except RuntimeError:
-                    print('WARNING: Image dataset ' + fname + ' already exists in ' + self.h5file)
-                    pass
-
-        self.refresh_h5dict()
+    def _write_image(self, f, path, arr):
+        fname = os.path.basename(path)
+        camera, camera_index, ab, time, time_str = self._parse_image_path(path)
+        if time_str not in f.keys():
+            grp = f.create_group(time_str)
+            grp.attrs['t'] = time
+        else:
+            grp = f[time_str]
+
+        if camera not in grp.keys():
+            subgrp = grp.create_group(camera)
+            subgrp.attrs['t'] = time
+            subgrp.attrs['cam'] = camera_index
+        else:
+            subgrp = grp[camera]
+
+        if fname in subgrp:
+            self._warn_exists(fname)
+            return
+
+        dset = subgrp.create_dataset(
+            fname, data=arr, **self._storage_kwargs(arr.shape))
+        dset.attrs['t'] = time
+        dset.attrs['cam'] = camera_index
+        dset.attrs['ab'] = ab
 
     def get_dset(self, camera, ab, time):
         """Returns a numpy array corresponding to a particle image stored as a dataset
@@ -86,5 +123,141 @@ class ParticleData(DataBase):
                                                   ab=ab,
                                                   t=time)
 
+    def stack_images(self, chunks=None):
+        """Converts the layout of one dataset per image into a stacked layout,
+        written in the separate file `stack_file` (see `config`): a single
+        dataset `images` of shape (t, cam, ab, y, x) and the coordinate arrays
+        `t`, `cam` and `ab`. The boolean dataset `present` of shape
+        (t, cam, ab) marks the images which exist in the original layout, the
+        others being filled with zeros. The images are copied one at a time.
+        The stacked file is self-contained: `get_stack_coords` and
+        `get_series` do not read the file of the original layout, which can
+        be removed.
+
+        Parameters
+        ----------
+        chunks : tuple of int, optional
+            Chunks of the 5D dataset, by default one image per chunk, so that
+            a time series of one camera is read with one hyperslab selection.
+            The compression options given to `config` are applied.
+
+        """
+        f = self.open_h5('a')
+        if self._read_index(f) is None:
+            self.build_index(f)
+
+        index = self._index['datasets']
+        if not index:
+            raise ValueError('No particle image in ' + self.h5file)
+
+        cams = sorted(set(cam for cam, ab, t in index))
+        frames = sorted(set(ab for cam, ab, t in index))
+        times = sorted(set(t for cam, ab, t in index))
+        first = f[next(iter(index.values()))]
+        shape = (len(times), len(cams), len(frames)) + first.shape
+
+        kwargs = self._storage_kwargs(first.shape)
+        if chunks is None:
+            chunks = kwargs.get('chunks')
+            if chunks in (None, True):
+                chunks = first.shape
+            chunks = (1, 1, 1) + tuple(chunks)
+        kwargs['chunks'] = tuple(min(chunk, n)
+                                 for chunk, n in zip(chunks, shape))
+
+        # Written in a temporary file moved in place at the end, so that
+        # readers never see a partial layout
+        tmp = self.stack_file + '.tmp'
+        try:
+            with h5py.File(tmp, 'w') as stack:
+                stack['t'] = np.array(times)
+                stack['cam'] = np.array(cams)
+                stack['ab'] = np.array([ab.encode() for ab in frames])
+                present = np.zeros(shape[:3], dtype=bool)
+                images = stack.create_dataset('images', shape=shape,
+                                              dtype=first.dtype, fillvalue=0,
+                                              **kwargs)
+                t_pos, cam_pos, ab_pos = (
+                    {value: i for i, value in enumerate(values)}
+                    for values in (times, cams, frames))
+                for (cam, ab, t), path in sorted(index.items()):
+                    dset = f[path]
+                    if dset.shape != first.shape:
+                        raise ValueError('Cannot stack images of different '
+                                         'shapes: ' + path)
+                    loc = t_pos[t], cam_pos[cam], ab_pos[ab]
+                    images[loc] = dset[...]
+                    present[loc] = True
+
+                stack['present'] = present
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        with self._lock:
+            self._close_stack_handles()
+            os.rename(tmp, self.stack_file)
+            self._stack_coords = {'t': times, 'cam': cams, 'ab': frames}
+            self._stack_mtime = self._stack_file_mtime()
+
+    def _stack_file_mtime(self):
+        try:
+            return os.path.getmtime(self.stack_file)
+        except OSError:
+            return None
+
+    def get_stack_coords(self):
+        """Returns the coordinates {'t': times, 'cam': cameras, 'ab': frames}
+        of the stacked layout. They are cached with the modification time of
+        the stacked file and read again if it changes, e.g. when another
+        instance calls `stack_images`."""
+        mtime = self._stack_file_mtime()
+        if mtime is None:
+            raise ValueError('No stacked layout in ' + str(self.stack_file) +
+                             ', see stack_images')
+
+        with self._lock:
+            if self._stack_coords is not None and mtime == self._stack_mtime:
+                return self._stack_coords
+
+            # The pooled handles may be open on a replaced file
+            self._close_stack_handles()
+
+        with self._stack_handle() as f:
+            coords = {'t': f['t'][...].tolist(),
+                      'cam': f['cam'][...].tolist(),
+                      'ab': [ab.decode() for ab in f['ab'][...]]}
+
+        with self._lock:
+            self._stack_coords, self._stack_mtime = coords, mtime
+        return coords
+
+    def get_series(self, camera, ab, t_slice=slice(None)):
+        """Returns a block of images of shape (t, y, x) from the stacked
+        layout, read with a single hyperslab selection.
+
+        Parameters
+        ----------
+        camera : int
+            Index of the camera
+
+        ab : str
+            Acceptable values 'a' or 'b' denoting first or second snapshot
+
+        t_slice : slice or int
+            Positions along the time axis, whose times are
+            `get_stack_coords()['t'][t_slice]`
+        """
+        coords = self.get_stack_coords()
+        try:
+            loc = coords['cam'].index(camera), coords['ab'].index(ab)
+        except ValueError:
+            raise ValueError('Cannot locate camera {} and frame {} in the '
+                             'stacked layout'.format(camera, ab))
+
+        with self._stack_handle() as f:
+            return f['images'][(t_slice,) + loc]
+
     def replace_dset(self, camera, ab, time, arr):
         pass
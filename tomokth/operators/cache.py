@@ -0,0 +1,131 @@
+"""On-disk cache of weight matrices (:mod:`tomokth.operators.cache`)
+==========================================================================
+
+.. currentmodule:: tomokth.operators.cache
+
+Provides
+--------
+WeightCache
+
+"""
+
+from __future__ import division
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+from ..util.cache import DirectoryCache
+from ..util.util import logger
+
+
+class WeightCache(DirectoryCache):
+    """
+    Cache of the sparse weight matrices of cameras, stored on disk as raw
+    index and data arrays (one directory of `.npy` files per matrix) which are
+    loaded memory-mapped. Entries are keyed on a hash of the camera
+    calibration, the voxel grid and the radii of a pixel and a voxel. The
+    least recently used entries are evicted once the cache is larger than
+    `max_size` (see `tomokth.util.cache.DirectoryCache`).
+
+    Parameters
+    ----------
+    path : str
+        Directory of the cache, created if needed.
+
+    max_size : float
+        Size budget of the cache in MB.
+
+    mmap_mode : {None, 'r', 'c'}
+        Mode used to load the arrays with `numpy.load`.
+
+    """
+
+    _arrays = ('data', 'indices', 'indptr')
+    _description = 'weight matrix'
+
+    def __init__(self, path, max_size=4096, mmap_mode='r'):
+        super(WeightCache, self).__init__(path, max_size)
+        self.mmap_mode = mmap_mode
+
+    @staticmethod
+    def make_key(calib, grid, rpix, rvox):
+        """
+        Returns the hash identifying a weight matrix.
+
+        Parameters
+        ----------
+        calib : array_like
+            Calibration of the camera, as returned by
+            `CalibrationData.get_camera_calibration`.
+
+        grid : VoxelGrid
+            Voxel grid of the volume
+
+        rpix, rvox : float
+            Radii of a pixel and a voxel
+
+        """
+        calib = np.ascontiguousarray(calib, dtype=np.float64)
+        sha = hashlib.sha1()
+        sha.update(repr(calib.shape).encode())
+        sha.update(calib.tobytes())
+        sha.update(repr((grid.shape, tuple(grid.spacing), tuple(grid.origin),
+                         float(rpix), float(rvox))).encode())
+        return sha.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def _key(self, name):
+        return name if os.path.isdir(self._entry(name)) else None
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self._entry(key), 'meta.json'))
+
+    def load(self, key):
+        """Returns the cached CSR matrix, or `None` if not in the cache."""
+        if key not in self:
+            return None
+
+        entry = self._entry(key)
+        with open(os.path.join(entry, 'meta.json')) as f:
+            meta = json.load(f)
+
+        data, indices, indptr = [
+            np.load(os.path.join(entry, name + '.npy'), mmap_mode=self.mmap_mode)
+            for name in self._arrays]
+        # Records the access for the LRU eviction
+        os.utime(entry, None)
+        return sparse.csr_matrix((data, indices, indptr),
+                                 shape=tuple(meta['shape']), copy=False)
+
+    def save(self, key, matrix):
+        """Stores a sparse matrix in the cache and evicts old entries."""
+        matrix = matrix.tocsr()
+        tmp = tempfile.mkdtemp(prefix='.tmp_', dir=self.path)
+        for name in self._arrays:
+            np.save(os.path.join(tmp, name + '.npy'), getattr(matrix, name))
+
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'shape': list(matrix.shape)}, f)
+
+        self._store(key, tmp)
+
+    def get(self, key, build, *args, **kwargs):
+        """
+        Returns the cached matrix for `key`, or calls
+        `build(*args, **kwargs)`, stores and returns its result.
+
+        """
+        matrix = self.load(key)
+        if matrix is None:
+            logger.info('Weight matrix {} not in cache, building it'.format(key))
+            matrix = build(*args, **kwargs)
+            self.save(key, matrix)
+            matrix = self.load(key)
+
+        return matrix
@@ -5,42 +5,159 @@
 
 Provides
 --------
-vintersect_sphcyl
+ellippi, vintersect_sphcyl, distance_los_voxel, iter_distances_los_voxel,
+calc_weight, iter_weights, WeightTable
 
 """
 
 from __future__ import division
 import numpy as np
-from scipy.special import ellipkinc, ellipeinc, ellipk, ellipe
+from scipy.special import ellipk, ellipe
 from scipy.integrate import dblquad
-from sympy import elliptic_pi
 
 
-def ellippi(n, m):
+def _elliprf(x, y, z, rtol=1e-15):
     """
-    Complete elliptic integral of third kind (simplified version).
+    Carlson's completely symmetric elliptic integral of the first kind,
+    R_F(x, y, z), evaluated element-wise with the duplication theorem.
 
-    .. FIXME: Incorrect, because of non-standard definitions of elliptic integral in the reference
+    Reference
+    ---------
+    B. C. CARLSON, Numerical computation of real or complex elliptic integrals,
+        Numerical Algorithms 10 (1995) 13-26
+
+    """
+    x, y, z = np.broadcast_arrays(np.asarray(x, dtype=float),
+                                  np.asarray(y, dtype=float),
+                                  np.asarray(z, dtype=float))
+    x0, y0 = x, y
+    a0 = (x + y + z) / 3
+    q = (3. * rtol) ** (-1. / 6) * np.maximum(np.abs(a0 - x),
+                                              np.maximum(np.abs(a0 - y),
+                                                         np.abs(a0 - z)))
+    a = a0.copy()
+    scale = 1.
+    while np.any(scale * q >= np.abs(a)):
+        sx, sy, sz = np.sqrt(x), np.sqrt(y), np.sqrt(z)
+        lam = sx * sy + sx * sz + sy * sz
+        x = (x + lam) / 4
+        y = (y + lam) / 4
+        z = (z + lam) / 4
+        a = (a + lam) / 4
+        scale /= 4
+
+    xm = (a0 - x0) * scale / a
+    ym = (a0 - y0) * scale / a
+    zm = -xm - ym
+    e2 = xm * ym - zm ** 2
+    e3 = xm * ym * zm
+    return (1 - e2 / 10 + e3 / 14 + e2 ** 2 / 24 - 3 * e2 * e3 / 44) / np.sqrt(a)
+
+
+def _elliprc1(e):
+    """Degenerate Carlson integral R_C(1, 1 + e), for e > -1."""
+    e = np.asarray(e, dtype=float)
+    rc = np.ones(e.shape)
+    pos = e > 0
+    neg = e < 0
+    t = np.sqrt(e[pos])
+    rc[pos] = np.arctan(t) / t
+    t = np.sqrt(-e[neg])
+    rc[neg] = np.arctanh(t) / t
+    return rc
+
+
+def _elliprj(x, y, z, p, rtol=1e-15):
+    """
+    Carlson's symmetric elliptic integral of the third kind, R_J(x, y, z, p),
+    evaluated element-wise with the duplication theorem, for p > 0.
 
     Reference
     ---------
-    F. LAMARCHE and C. LEROY, Evaluation of the volume of a sphere with a cylinder by elliptic integrals,
-        Computer Phys. Comm. 59 (1990) pg. 365
+    B. C. CARLSON, Numerical computation of real or complex elliptic integrals,
+        Numerical Algorithms 10 (1995) 13-26
+
     """
-    a2 = n
-    k2 = m
-    k2_a2 = k2 + a2
-    phi = np.arcsin(a2 / k2_a2)
+    x, y, z, p = np.broadcast_arrays(np.asarray(x, dtype=float),
+                                     np.asarray(y, dtype=float),
+                                     np.asarray(z, dtype=float),
+                                     np.asarray(p, dtype=float))
+    x0, y0, z0 = x, y, z
+    a0 = (x + y + z + 2 * p) / 5
+    delta = (p - x) * (p - y) * (p - z)
+    q = (rtol / 4) ** (-1. / 6) * np.maximum(
+        np.maximum(np.abs(a0 - x), np.abs(a0 - y)),
+        np.maximum(np.abs(a0 - z), np.abs(a0 - p)))
+    a = a0.copy()
+    scale = 1.
+    total = np.zeros(a.shape)
+    while np.any(scale * q >= np.abs(a)):
+        sx, sy, sz, sp = np.sqrt(x), np.sqrt(y), np.sqrt(z), np.sqrt(p)
+        lam = sx * sy + sx * sz + sy * sz
+        d = (sp + sx) * (sp + sy) * (sp + sz)
+        e = scale ** 3 * delta / d ** 2
+        total += scale / d * _elliprc1(e)
+        x = (x + lam) / 4
+        y = (y + lam) / 4
+        z = (z + lam) / 4
+        p = (p + lam) / 4
+        a = (a + lam) / 4
+        scale /= 4
+
+    xm = (a0 - x0) * scale / a
+    ym = (a0 - y0) * scale / a
+    zm = (a0 - z0) * scale / a
+    pm = (-xm - ym - zm) / 2
+    e2 = xm * ym + xm * zm + ym * zm - 3 * pm ** 2
+    e3 = xm * ym * zm + 2 * e2 * pm + 4 * pm ** 3
+    e4 = (2 * xm * ym * zm + e2 * pm + 3 * pm ** 3) * pm
+    e5 = xm * ym * zm * pm ** 2
+    series = (1 - 3 * e2 / 14 + e3 / 6 + 9 * e2 ** 2 / 88 - 3 * e4 / 22 -
+              9 * e2 * e3 / 52 + 3 * e5 / 26)
+    return scale * a ** -1.5 * series + 6 * total
+
+
+try:
+    from scipy.special import elliprf, elliprj
+except ImportError:
+    # scipy < 1.8
+    elliprf = _elliprf
+    elliprj = _elliprj
+
+
+def ellippi(n, m):
+    r"""
+    Complete elliptic integral of third kind, evaluated element-wise.
+
+    .. math::
+        \Pi(n, m) = \int_0^{\pi/2} \frac{d\theta}
+                    {(1 - n \sin^2\theta) \sqrt{1 - m \sin^2\theta}}
+                  = R_F(0, 1 - m, 1) + \frac{n}{3} R_J(0, 1 - m, 1, 1 - n)
+
+    Follows the same convention as `sympy.elliptic_pi(n, m)`, where `m` is
+    the parameter (square of the elliptic modulus).
+
+    Parameters
+    ----------
+    n : float or array_like
+        Characteristic, n < 1
+    m : float or array_like
+        Parameter, 0 <= m < 1
 
-    Kc = ellipk(k2)
-    Ec = ellipe(k2)
-    Ki = ellipkinc(phi, (1. - k2) ** 1)
-    Ei = ellipeinc(phi, (1. - k2) ** 1)
+    Reference
+    ---------
+    B. C. CARLSON, Numerical computation of real or complex elliptic integrals,
+        Numerical Algorithms 10 (1995) 13-26
 
-    c1 = k2 / k2_a2
-    c2 = np.sqrt(a2 / (1 + a2) / k2_a2)
+    """
+    n, m = np.broadcast_arrays(np.asarray(n, dtype=float),
+                               np.asarray(m, dtype=float))
+    y = 1. - m
+    pi = elliprf(0., y, 1.) + n / 3 * elliprj(0., y, 1., 1. - n)
+    if pi.ndim == 0:
+        return pi[()]
 
-    return c1 * Kc + c2 * ((Kc - Ec) * Ki + Kc * Ei)
+    return pi
 
 
 def heaviside(x):
@@ -62,35 +179,59 @@ def vintersect_sphcyl(rs, rc, b):
     """
     Returns the volume of intersection of a sphere with a cylinder.
 
+    All arguments are broadcast against each other, so that the volumes for
+    many (rs, rc, b) triples are evaluated in a single call. The different
+    geometrical cases are selected with boolean masks instead of branching.
+
     Parameters
     ----------
-    rs : float
+    rs : float or array_like
         radius of the sphere (r)
-    rc : float
+    rc : float or array_like
         radius of the cylinder (R)
-    b : float
+    b : float or array_like
         impact parameter, the smallest distance of the cylinder axis to the centre of the sphere.
 
+    Returns
+    -------
+    vi : float or nd-array
+        Volume of intersection, with the broadcast shape of the arguments.
+
     Reference
     ---------
     F. LAMARCHE and C. LEROY, Evaluation of the volume of a sphere with a cylinder by elliptic integrals,
         Computer Phys. Comm. 59 (1990) 359-369
 
     """
+    rs, rc, b = np.broadcast_arrays(np.asarray(rs, dtype=float),
+                                    np.asarray(rc, dtype=float),
+                                    np.asarray(b, dtype=float))
     pi = np.pi
     vsph = 4. * pi / 3 * rs ** 3
+    vi = np.zeros(rs.shape)
 
-    if b >= (rs + rc):
-        return 0.
-    elif b == 0.:
-        if rs < rc:
-            vi = vsph
-        else:
-            vi = vsph - 4. / 3 * pi * (rs ** 2 - rc ** 2) ** 1.5
-    elif rc > (rs + b):
-        vi = vsph
-    else:
-        vi = vsph * heaviside(rc - b) + _vintersect_sphcyl_ellip(rs, rc, b)
+    inside = b < (rs + rc)
+    centred = inside & (b == 0.)
+    rest = inside & ~centred
+
+    # Cylinder axis passes through the centre of the sphere
+    mask = centred & (rs < rc)
+    vi[mask] = vsph[mask]
+    mask = centred & (rs >= rc)
+    vi[mask] = (vsph[mask] -
+                4. / 3 * pi * (rs[mask] ** 2 - rc[mask] ** 2) ** 1.5)
+
+    # Sphere completely engulfed by the cylinder
+    mask = rest & (rc > (rs + b))
+    vi[mask] = vsph[mask]
+
+    mask = rest & (rc <= (rs + b))
+    if mask.any():
+        vi[mask] = (vsph[mask] * heaviside(rc[mask] - b[mask]) +
+                    _vintersect_sphcyl_ellip(rs[mask], rc[mask], b[mask]))
+
+    if vi.ndim == 0:
+        return vi[()]
 
     return vi
 
@@ -98,14 +239,14 @@ def vintersect_sphcyl(rs, rc, b):
 def _vintersect_sphcyl_ellip(rs, rc, b):
     """
     The cases for which evaluating the volume of intersection of a sphere with a cylinder
-    makes use of elliptic integrals.
+    makes use of elliptic integrals. Expects 1D arrays of equal length.
 
     """
     rs3 = rs ** 3
     bprc = b + rc
     bmrc = b - rc
-    A = max(rs ** 2, bprc ** 2)
-    B = min(rs ** 2, bprc ** 2)
+    A = np.maximum(rs ** 2, bprc ** 2)
+    B = np.minimum(rs ** 2, bprc ** 2)
     C = bmrc ** 2
     AB = A - B
     AC = A - C
@@ -114,32 +255,58 @@ def _vintersect_sphcyl_ellip(rs, rc, b):
     s = bprc * bmrc
     e1 = ellipk(k2)
     e2 = ellipe(k2)
+    vi = np.empty(rs.shape)
+
+    touch = (rs == bprc)
+    small = (rs < bprc)
+    large = ~(touch | small)
+    axis_on_surface = (bmrc == 0)
+
+    # b = R
+    mask = axis_on_surface & touch
+    vi[mask] = - 4. / 3 * AC[mask] ** 0.5 * (s[mask] + 2. / 3 * AC[mask])
+
+    mask = axis_on_surface & small
+    A_, B_, AB_ = A[mask], B[mask], AB[mask]
+    vi[mask] = 4. / 3 / A_ ** 0.5 * (e1[mask] * AB_ * (3 * B_ - 2 * A_) +
+                                     e2[mask] * A_ * (2 * A_ - 4 * B_)) / 3
+
+    mask = axis_on_surface & large
+    A_, B_, AB_ = A[mask], B[mask], AB[mask]
+    vi[mask] = 4. / 3 / A_ ** 0.5 * (e1[mask] * AB_ * A_ -
+                                     e2[mask] * A_ * (4 * A_ - 2 * B_)) / 3
+
+    # b != R
+    mask = ~axis_on_surface & touch
+    vi[mask] = (4. / 3 * rs3[mask] *
+                np.arctan(2 * (b[mask] * rc[mask]) ** 0.5 / bmrc[mask]) -
+                4. / 3 * AC[mask] ** 0.5 * (s[mask] + 2. / 3 * AC[mask]))
+
+    mask = ~axis_on_surface & ~touch
+    if mask.any():
+        A_, B_, C_ = A[mask], B[mask], C[mask]
+        AB_, AC_, s_ = AB[mask], AC[mask], s[mask]
+        e1_, e2_ = e1[mask], e2[mask]
+        a2 = 1 - B_ / C_
+        e3 = ellippi(a2, k2[mask])
+        vi_ = np.empty(A_.shape)
+
+        m = small[mask]
+        vi_[m] = (4. / 3 / AC_[m] ** 0.5 *
+                  (e3[m] * B_[m] ** 2 * s_[m] / C_[m] +
+                   e1_[m] * (s_[m] * (A_[m] - 2. * B_[m]) +
+                             AB_[m] * (3 * B_[m] - C_[m] - 2 * A_[m]) / 3) +
+                   e2_[m] * AC_[m] * (-s_[m] +
+                                      (2 * A_[m] + 2 * C_[m] - 4 * B_[m]) / 3)))
+
+        m = large[mask]
+        vi_[m] = 4. / 3 / AC_[m] ** 0.5 * (
+            e3[m] * A_[m] ** 2 * s_[m] / C_[m] -
+            e1_[m] * (A_[m] * s_[m] - AB_[m] * AC_[m] / 3.) -
+            e2_[m] * AC_[m] * (s_[m] + (4. * A_[m] - 2 * B_[m] - 2 * C_[m]) / 3))
+
+        vi[mask] = vi_
 
-    if bmrc == 0:
-        if rs == bprc:
-            vi = - 4. / 3 * AC ** 0.5 * (s + 2. / 3 * AC)
-        elif rs < bprc:
-            vi = 4. / 3 / A ** 0.5 * (e1 * AB * (3 * B - 2 * A) +
-                                      e2 * A * (2 * A - 4 * B)) / 3
-        else:
-            vi = 4. / 3 / A ** 0.5 * (e1 * AB * A -
-                                      e2 * A * (4 * A - 2 * B)) / 3
-    else:
-        a2 = 1 - B / C
-        e3 = elliptic_pi(a2, k2)
-
-        if rs == bprc:
-            vi = (4. / 3 * rs3 * np.arctan(2 * (b * rc) ** 0.5 / bmrc) -
-                  4. / 3 * AC ** 0.5 * (s + 2. / 3 * AC))
-        elif rs < bprc:
-            vi = (4. / 3 / AC ** 0.5 *
-                  (e3 * B ** 2 * s / C +
-                   e1 * (s * (A - 2. * B) + AB * (3 * B - C - 2 * A) / 3) +
-                   e2 * AC * (-s + (2 * A + 2 * C - 4 * B) / 3)))
-        else:
-            vi = 4. / 3 / AC ** 0.5 * (e3 * A ** 2 * s / C -
-                                       e1 * (A * s - AB * AC / 3.) -
-                                       e2 * AC * (s + (4. * A - 2 * B - 2 * C) / 3))
     return vi
 
 
@@ -162,29 +329,91 @@ def vintersect_sphcyl_quad(rs, rc, b):
 def distance_los_voxel(vec_pix, vec_vox, vec_normal):
     """
     Determines the distance between the line of sight from a pixel along the normal
-    and the voxel center.
+    and the voxel center. The vectors are stored along the last axis, and the
+    other axes are broadcast against each other.
 
     Parameters
     ----------
     vec_pix : nd-array
-        Position vector of the pixel center
+        Position vector of the pixel center, shape (..., 3)
 
     vec_vox : nd-array
-        Postition vector of the voxel center
+        Postition vector of the voxel center, shape (..., 3)
 
     vec_normal : nd-array
-        Normal vector of the image plane
+        Normal vector of the image plane, shape (..., 3)
 
     """
-    vec_pixvox = vec_vox - vec_pix
+    vec_pixvox = np.asarray(vec_vox) - np.asarray(vec_pix)
     vec_dist = np.cross(vec_pixvox, vec_normal)
-    b = np.linalg.norm(vec_dist) / np.linalg.norm(vec_normal)
+    b = (np.linalg.norm(vec_dist, axis=-1) /
+         np.linalg.norm(vec_normal, axis=-1))
     return b
 
 
+def _iter_pairs(nb_pix, nb_vox, ipix, ivox, chunk_size):
+    """Yields chunks of pixel and voxel indices of candidate pairs."""
+    if ipix is None and ivox is None:
+        nb_pairs = nb_pix * nb_vox
+        for start in range(0, nb_pairs, chunk_size):
+            pairs = np.arange(start, min(start + chunk_size, nb_pairs))
+            yield pairs // nb_vox, pairs % nb_vox
+    elif ipix is not None and ivox is not None:
+        ipix, ivox = np.broadcast_arrays(ipix, ivox)
+        for start in range(0, ipix.size, chunk_size):
+            yield (ipix[start:start + chunk_size],
+                   ivox[start:start + chunk_size])
+    else:
+        raise ValueError('Both ipix and ivox are required to specify pairs.')
+
+
+def iter_distances_los_voxel(vec_pix, vec_vox, vec_normal, ipix=None,
+                             ivox=None, chunk_size=2 ** 20):
+    """
+    Yields the distances between the lines of sight of a set of pixels and a
+    set of voxel centres, for candidate pairs in chunks of `chunk_size`.
+
+    Parameters
+    ----------
+    vec_pix : nd-array
+        Position vectors of the pixel centers, shape (N, 3)
+
+    vec_vox : nd-array
+        Postition vectors of the voxel centers, shape (M, 3)
+
+    vec_normal : nd-array
+        Direction of the line of sight of each pixel, shape (N, 3) or (3,)
+
+    ipix, ivox : array_like of integers, optional
+        Indices of the pixel and the voxel of each candidate pair.
+        All N x M pairs if not specified.
+
+    chunk_size : int
+        Number of pairs per chunk, which bounds the memory usage.
+
+    Yields
+    ------
+    ipix, ivox, b : nd-arrays
+        Indices of the pixels and voxels and the distances, for one chunk
+
+    """
+    vec_pix = np.atleast_2d(np.asarray(vec_pix, dtype=float))
+    vec_vox = np.atleast_2d(np.asarray(vec_vox, dtype=float))
+    vec_normal = np.broadcast_to(np.asarray(vec_normal, dtype=float),
+                                 vec_pix.shape)
+
+    for ipix_chunk, ivox_chunk in _iter_pairs(vec_pix.shape[0],
+                                              vec_vox.shape[0],
+                                              ipix, ivox, chunk_size):
+        b = distance_los_voxel(vec_pix[ipix_chunk], vec_vox[ivox_chunk],
+                               vec_normal[ipix_chunk])
+        yield ipix_chunk, ivox_chunk, b
+
+
 def calc_weight(rpix, vec_pix, rvox, vec_vox, vec_normal):
     """
-    Calculates the weightage of a pixel on voxel.
+    Calculates the weightage of a pixel on voxel. The vectors are stored
+    along the last axis, and the other axes are broadcast against each other.
 
     Parameters
     ---------
@@ -192,18 +421,107 @@ def calc_weight(rpix, vec_pix, rvox, vec_vox, vec_normal):
         Radius of a pixel
 
     vec_pix : nd-array
-        Position vector of the pixel center
+        Position vector of the pixel center, shape (..., 3)
 
     rvox : float
         Radius of a voxel
 
     vec_vox : nd-array
-        Postition vector of the voxel center
+        Postition vector of the voxel center, shape (..., 3)
 
     vec_normal : nd-array
-        Normal vector of the image plane
+        Normal vector of the image plane, shape (..., 3)
 
     """
     b = distance_los_voxel(vec_pix, vec_vox, vec_normal)
     w = vintersect_sphcyl(rvox, rpix, b) / vintersect_sphcyl(rvox, rvox, 0.)
     return w
+
+
+def iter_weights(rpix, vec_pix, rvox, vec_vox, vec_normal, ipix=None,
+                 ivox=None, chunk_size=2 ** 20, table=None):
+    """
+    Yields the weightage of a set of pixels on a set of voxels, for candidate
+    pairs in chunks of `chunk_size`. Arguments are the same as for
+    `iter_distances_los_voxel`, with the radii `rpix` and `rvox`.
+
+    Parameters
+    ----------
+    table : WeightTable, optional
+        Tabulated weights for `rpix` and `rvox`, used instead of the exact
+        volumes of intersection.
+
+    Yields
+    ------
+    ipix, ivox, w : nd-arrays
+        Indices of the pixels and voxels and the weights, for one chunk
+
+    """
+    vvox = vintersect_sphcyl(rvox, rvox, 0.)
+    for ipix_chunk, ivox_chunk, b in iter_distances_los_voxel(
+            vec_pix, vec_vox, vec_normal, ipix, ivox, chunk_size):
+        if table is None:
+            w = vintersect_sphcyl(rvox, rpix, b) / vvox
+        else:
+            w = table(b)
+        yield ipix_chunk, ivox_chunk, w
+
+
+class WeightTable(object):
+    """
+    Tabulated weightage of a pixel on a voxel, as a function of the impact
+    parameter `b` returned by `distance_los_voxel`. For fixed radii of the
+    pixel and the voxel this replaces the elliptic integrals of `calc_weight`
+    by a linear interpolation.
+
+    Parameters
+    ----------
+    rpix : float
+        Radius of a pixel
+
+    rvox : float
+        Radius of a voxel
+
+    nb_samples : int
+        Initial number of samples of b on [0, rpix + rvox]
+
+    atol : float
+        Tolerated absolute interpolation error. The number of samples is
+        doubled until the error at the midpoints of the table is smaller.
+
+    max_samples : int
+        Upper limit of the number of samples
+
+    """
+
+    def __init__(self, rpix, rvox, nb_samples=257, atol=1e-6,
+                 max_samples=2 ** 20 + 1):
+        self.rpix = rpix
+        self.rvox = rvox
+        self.bmax = rpix + rvox
+
+        vvox = vintersect_sphcyl(rvox, rvox, 0.)
+        b = np.linspace(0., self.bmax, nb_samples)
+        w = vintersect_sphcyl(rvox, rpix, b) / vvox
+        while True:
+            b_mid = 0.5 * (b[1:] + b[:-1])
+            w_mid = vintersect_sphcyl(rvox, rpix, b_mid) / vvox
+            error = np.abs(np.interp(b_mid, b, w) - w_mid).max()
+            if error <= atol or b.size >= max_samples:
+                break
+
+            # Refine by inserting the midpoints
+            b = np.insert(b, np.arange(1, b.size), b_mid)
+            w = np.insert(w, np.arange(1, w.size), w_mid)
+
+        self.b = b
+        self.w = w
+        self.error = error
+
+    def __call__(self, b):
+        """
+        Returns the interpolated weights for an array of impact parameters.
+        Weights are zero for b >= rpix + rvox.
+
+        """
+        return np.interp(b, self.b, self.w, right=0.)
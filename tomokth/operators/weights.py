@@ -0,0 +1,188 @@
+"""Pixel-voxel weight matrices (:mod:`tomokth.operators.weights`)
+==========================================================================
+
+.. currentmodule:: tomokth.operators.weights
+
+Provides
+--------
+VoxelGrid, build_weight_matrix
+
+"""
+
+from __future__ import division
+import numpy as np
+from scipy import sparse
+
+from .math import WeightTable, distance_los_voxel
+
+
+class VoxelGrid(object):
+    """
+    Regular grid of voxels. The volume is stored as an array of shape
+    (nz, ny, nx) and voxels are numbered in the same (C) order.
+
+    Parameters
+    ----------
+    shape : tuple of integers
+        Number of voxels (nz, ny, nx)
+
+    spacing : float or tuple of floats
+        Distance between voxel centres (dx, dy, dz)
+
+    origin : tuple of floats
+        Position of the centre of the first voxel (x0, y0, z0)
+
+    """
+
+    def __init__(self, shape, spacing=1., origin=(0., 0., 0.)):
+        self.shape = tuple(int(n) for n in shape)
+        self.spacing = np.broadcast_to(np.asarray(spacing, dtype=float),
+                                       (3,)).copy()
+        self.origin = np.asarray(origin, dtype=float)
+        self.size = int(np.prod(self.shape))
+
+    @property
+    def x(self):
+        return self.origin[0] + self.spacing[0] * np.arange(self.shape[2])
+
+    @property
+    def y(self):
+        return self.origin[1] + self.spacing[1] * np.arange(self.shape[1])
+
+    @property
+    def z(self):
+        return self.origin[2] + self.spacing[2] * np.arange(self.shape[0])
+
+    def centers(self, index=None):
+        """
+        Returns the position vectors of voxel centres as an (M, 3) array.
+
+        Parameters
+        ----------
+        index : array_like of integers, optional
+            Flat indices of the voxels. All voxels if `None`.
+
+        """
+        if index is None:
+            index = np.arange(self.size)
+
+        iz, iy, ix = np.unravel_index(index, self.shape)
+        return self.origin + self.spacing * np.stack([ix, iy, iz], axis=-1)
+
+
+def build_weight_matrix(grid, vec_pix, vec_normal, rpix, rvox, table=None,
+                        chunk_size=65536, dtype=np.float32):
+    """
+    Builds the sparse weight matrix of one camera, of shape (N_pix, N_vox).
+
+    Only the voxels within `rpix + rvox` of the line of sight of each pixel
+    are considered. The lines of sight are marched through the z-planes of
+    the grid; in each plane the candidate voxels are restricted to a window
+    around the point of intersection, before computing the exact distance.
+    The lines of sight must therefore not be parallel to the z-planes.
+
+    Parameters
+    ----------
+    grid : VoxelGrid
+        Voxel grid of the volume
+
+    vec_pix : nd-array
+        Position vectors of the pixel centres, shape (N_pix, 3)
+
+    vec_normal : nd-array
+        Direction of the lines of sight, shape (3,) or (N_pix, 3)
+
+    rpix : float
+        Radius of a pixel
+
+    rvox : float
+        Radius of a voxel
+
+    table : WeightTable, optional
+        Tabulated weights for `rpix` and `rvox`. Built if not provided.
+
+    chunk_size : int
+        Number of pixels processed at once, bounding the memory usage.
+
+    dtype : numpy dtype
+        Data type of the weights
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+
+    """
+    vec_pix = np.atleast_2d(np.asarray(vec_pix, dtype=float))
+    nb_pix = vec_pix.shape[0]
+    vec_normal = np.broadcast_to(np.asarray(vec_normal, dtype=float),
+                                 vec_pix.shape)
+    vec_normal = vec_normal / np.linalg.norm(vec_normal, axis=1)[:, np.newaxis]
+
+    if np.any(vec_normal[:, 2] == 0.):
+        raise ValueError('Lines of sight parallel to the z-planes of the grid.')
+
+    if table is None:
+        table = WeightTable(rpix, rvox)
+
+    rmax = rpix + rvox
+    rows, cols, data = [], [], []
+    for start in range(0, nb_pix, chunk_size):
+        stop = min(start + chunk_size, nb_pix)
+        r, c, w = _weights_chunk(grid, vec_pix[start:stop],
+                                 vec_normal[start:stop], rmax, table)
+        rows.append(r + start)
+        cols.append(c)
+        data.append(w.astype(dtype))
+
+    weights = sparse.coo_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(nb_pix, grid.size))
+    return weights.tocsr()
+
+
+def _weights_chunk(grid, vec_pix, vec_normal, rmax, table):
+    """
+    Row indices (local to the chunk), column indices and weights of the
+    non-zero entries for a chunk of pixels.
+
+    """
+    nz, ny, nx = grid.shape
+    dx, dy, dz = grid.spacing
+    x0, y0, z0 = grid.origin
+
+    # Half-width of the window enclosing the voxels within rmax of a line,
+    # in a plane of constant z
+    half = rmax / np.abs(vec_normal[:, 2])
+    wx = int(np.ceil(half.max() / dx))
+    wy = int(np.ceil(half.max() / dy))
+    off_y, off_x = np.meshgrid(np.arange(-wy, wy + 1), np.arange(-wx, wx + 1),
+                               indexing='ij')
+    off_x = off_x.ravel()
+    off_y = off_y.ravel()
+    pix_index = np.arange(vec_pix.shape[0])
+
+    rows, cols, data = [], [], []
+    for iz, z in enumerate(grid.z):
+        # Point of intersection of the lines of sight with the plane
+        t = (z - vec_pix[:, 2]) / vec_normal[:, 2]
+        xc = vec_pix[:, 0] + t * vec_normal[:, 0]
+        yc = vec_pix[:, 1] + t * vec_normal[:, 1]
+
+        ix = np.rint((xc - x0) / dx).astype(np.intp)[:, np.newaxis] + off_x
+        iy = np.rint((yc - y0) / dy).astype(np.intp)[:, np.newaxis] + off_y
+        inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        ipix = np.broadcast_to(pix_index[:, np.newaxis], ix.shape)[inside]
+        ix = ix[inside]
+        iy = iy[inside]
+
+        vec_vox = np.stack([x0 + dx * ix, y0 + dy * iy,
+                            np.full(ix.shape, z)], axis=-1)
+        b = distance_los_voxel(vec_pix[ipix], vec_vox, vec_normal[ipix])
+        near = b < rmax
+        ipix = ipix[near]
+
+        rows.append(ipix)
+        cols.append((iz * ny + iy[near]) * nx + ix[near])
+        data.append(table(b[near]))
+
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(data)
@@ -11,14 +11,78 @@ Provides:
    :private-members:
 
 """
+import copy
 import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
+import h5py
+import numpy as np
+from fluiddyn.io.image import imread
 from fluiddyn.util.paramcontainer import ParamContainer
 from fluiddyn.util.serieofarrays import SerieOfArraysFromFiles
-from .toolbox import PreprocTools
+from .toolbox import PreprocTools, cast_output, output_dtype
 # TODO: Replace with `from fluidimage.pre_proc import PreprocTools` when PyPi is updated
 
 
+def _load_source(src, index):
+    """Reads an image file, or the image `index` of a `.npy` store."""
+    if src.endswith('.npy'):
+        return np.load(src, mmap_mode='r')[index]
+    else:
+        return imread(src)
+
+
+# Statistics and compiled tools of each spatial stage in a worker process,
+# set once by `_init_worker`
+_worker_tools = None
+
+
+def _init_worker(params, sequences):
+    """Compiles the tools of the spatial stages once per worker process."""
+    global _worker_tools
+    tools = PreprocTools(params)
+    _worker_tools = tools.stats, {
+        stage: tools.compile(sequence, cast=False)
+        for stage, sequence in sequences.items()}
+
+
+def _preproc_image(args):
+    """
+    Applies the tools of a stage on one image and writes the result in a
+    `.npy` store. Runs in a worker process initialized by `_init_worker`.
+    The image is read from `src`, either an image file or a `.npy` store,
+    so that no image is pickled. Returns the statistics of this image.
+
+    """
+    stage, src, index, dst = args
+    stats, compiled = _worker_tools
+    store = np.load(dst, mmap_mode='r+')
+    store[index] = compiled[stage](_load_source(src, index), copy=False)
+    store.flush()
+    if stats is None:
+        return None
+
+    result = copy.copy(stats)
+    stats.reset()
+    return result
+
+
+def _stream_to_store(imgs, nb_imgs, dst):
+    """Writes images from an iterable into a memory-mapped `.npy` store."""
+    store = None
+    for index, img in enumerate(imgs):
+        if store is None:
+            store = np.lib.format.open_memmap(
+                dst, mode='w+', dtype=img.dtype, shape=(nb_imgs,) + img.shape)
+        store[index] = img
+
+    store.flush()
+    del store
+    return np.load(dst, mmap_mode='r')
+
+
 class PreprocBase(object):
     """Preprocess series of images with various tools. """
 
@@ -26,8 +90,46 @@ class PreprocBase(object):
     def create_default_params(cls):
         """Class method returning the default parameters."""
         params = ParamContainer(tag='params')
-        params._set_child('preproc')
+        params._set_child('preproc', attribs={'n_workers': 1})
+        params.preproc._set_doc(
+            'n_workers : int\n'
+            '        Number of worker processes applying the spatial tools\n')
         params.preproc._set_child('series', attribs={'path': ''})
+        params.preproc._set_child('saving', attribs={'path': None})
+        params.preproc.saving._set_doc(
+            'path : str or None\n'
+            '        HDF5 file to which the results are written as soon as they\n'
+            '        are computed. If None, results are kept in memory.\n')
+        params.preproc._set_child('cache', attribs={'path': None,
+                                                    'max_size': 4096})
+        params.preproc.cache._set_doc(
+            'path : str or None\n'
+            '        Directory of the on-disk cache of preprocessed images. If\n'
+            '        set, images already preprocessed with the same tools and\n'
+            '        parameters are loaded instead of recomputed.\n'
+            'max_size : float\n'
+            '        Size budget of the cache in MB, beyond which the least\n'
+            '        recently used images are evicted\n')
+        params.preproc._set_child('tiling', attribs={'tile_size': None,
+                                                     'nb_threads': 1})
+        params.preproc.tiling._set_doc(
+            'tile_size : int, tuple or None\n'
+            '        Shape of the tiles in which the spatial tools are applied\n'
+            '        on large images, with a halo from the window of the tools.\n'
+            '        Tools using global statistics of the image, or wrapping\n'
+            '        around its borders, are applied on the whole image. If\n'
+            '        None, images are not tiled.\n'
+            'nb_threads : int\n'
+            '        Number of threads processing the tiles\n')
+        params.preproc._set_child('stats', attribs={'enable': True,
+                                                    'memory': False})
+        params.preproc.stats._set_doc(
+            'enable : bool\n'
+            '        Collects the number of calls, wall time and shapes of the\n'
+            '        input and output of each tool in `PreprocBase.stats`\n'
+            'memory : bool\n'
+            '        Also measures the peak allocated bytes of each tool with\n'
+            '        tracemalloc, which slows down all allocations\n')
 
         PreprocTools._complete_class_with_tools(params)
 
@@ -38,6 +140,7 @@ class PreprocBase(object):
         if params is None:
             params = self.__class__.create_default_params()
 
+        self._params = params
         self.params = params.preproc
 
         path = params.preproc.series.path
@@ -46,14 +149,167 @@ class PreprocBase(object):
 
         self.serie_arrays = SerieOfArraysFromFiles(path)
         self.tools = PreprocTools(params)
+        # Statistics of the tools, which can be dumped with
+        # `stats.to_json` or `stats.to_csv` after a run (None if disabled)
+        self.stats = self.tools.stats
         self.results = {}
 
+    def iter_results(self, copy=True):
+        """
+        Generator applying all enabled preprocessing tools on the series of
+        arrays, which are loaded lazily. Yields the file name and the
+        preprocessed image, one at a time. The tools are compiled once for
+        the series (see `PreprocTools.compile`). If `copy` is False, the
+        yielded image is a buffer overwritten by the next one.
+
+        """
+        tools = self.tools.compile()
+        name_files = self.serie_arrays.get_name_files()
+        for name, img in zip(name_files, self.serie_arrays.iter_arrays()):
+            yield name, tools(img, copy=copy)
+
     def __call__(self):
         """Apply all enabled preprocessing tools on the series of arrays
-        and saves them in self.results.
+        and saves them in self.results, or in a HDF5 file if
+        `params.preproc.saving.path` is set.
+
+        The results are of type `params.preproc.tools.dtype`, float32 by
+        default, and not of the type of the input images, unless
+        `params.preproc.tools.output_dtype` is set.
+
+        """
+        path = self.params.saving.path
+        stages = self.tools.get_stages()
+        if self.params.n_workers > 1 or any(
+                temporal for temporal, sequence in stages):
+            self._call_stages(stages, path)
+        elif path:
+            self.save_results(os.path.expandvars(path))
+        else:
+            for name, img in self.iter_results():
+                self.results[name] = img
+
+    def _map_images(self, stage, sequence, sources, dst, executor):
+        """
+        Applies the spatial stage `stage` (tools `sequence`) on each source
+        image, in parallel if `executor` is not None, and returns the results
+        as a memory-mapped `.npy` store, in the order of the sources. A source
+        is either the path of an image file or of the `.npy` store of the
+        previous stage.
+
+        """
+        # The first image gives the shape and dtype of the results
+        tools = self.tools.compile(sequence, cast=False)
+        img = tools(_load_source(sources[0], 0))
+        store = np.lib.format.open_memmap(
+            dst, mode='w+', dtype=img.dtype, shape=(len(sources),) + img.shape)
+        store[0] = img
+        if executor is None:
+            for index in range(1, len(sources)):
+                store[index] = tools(_load_source(sources[index], index),
+                                     copy=False)
+        store.flush()
+        del store
+
+        if executor is not None:
+            args = [(stage, src, index, dst)
+                    for index, src in enumerate(sources) if index > 0]
+            chunksize = max(1, len(args) // (4 * self.params.n_workers))
+            for stats in executor.map(_preproc_image, args,
+                                      chunksize=chunksize):
+                if stats is not None:
+                    self.stats.merge(stats)
+
+        return np.load(dst, mmap_mode='r')
+
+    def _call_stages(self, stages, path):
+        """
+        Applies the tools stage by stage. Stages of spatial tools are
+        distributed over `n_workers` processes, which read the images from
+        files and write their results into a shared memory-mapped store.
+        Temporal tools with a finite window stream over the store, otherwise
+        they are applied on the gathered series. The results are cast to
+        `output_dtype` once, after the last stage, so that the intermediate
+        stages keep their floating point values.
+
+        """
+        name_files = self.serie_arrays.get_name_files()
+        sources = list(self.serie_arrays.get_path_files())
+        native_dtype = _load_source(sources[0], 0).dtype
+        if not stages or stages[0][0]:
+            # Gathers the raw images before the first temporal stage
+            stages = [(False, [])] + stages
+
+        tmp_dir = tempfile.mkdtemp(prefix='tomokth_preproc_')
+        executor = None
+        if self.params.n_workers > 1:
+            # The tools are compiled once per worker, for all the stages
+            sequences = {i: sequence
+                         for i, (temporal, sequence) in enumerate(stages)
+                         if not temporal}
+            executor = ProcessPoolExecutor(
+                self.params.n_workers, initializer=_init_worker,
+                initargs=(self._params, sequences))
+
+        store = None
+        try:
+            for i, (temporal, sequence) in enumerate(stages):
+                dst = os.path.join(tmp_dir, 'stage{}.npy'.format(i))
+                if temporal:
+                    imgs = self.tools.iter_temporal(iter(store), sequence)
+                    if imgs is not None:
+                        store = _stream_to_store(imgs, len(store), dst)
+                    else:
+                        results = self.tools(np.asarray(store), sequence,
+                                             cast=False)
+                        np.save(dst, results)
+                        del results
+                        store = np.load(dst, mmap_mode='r')
+                else:
+                    if store is not None:
+                        sources = [store.filename] * len(store)
+                    store = self._map_images(i, sequence, sources, dst,
+                                             executor)
+
+            dtype = store.dtype
+            if self.tools.output_dtype is not None:
+                dtype = output_dtype(self.tools.output_dtype, native_dtype)
+
+            if path:
+                with h5py.File(os.path.expandvars(path), 'w') as f:
+                    f.create_dataset('names',
+                                     data=np.array(name_files, dtype=np.bytes_))
+                    dset = f.create_dataset('images', shape=store.shape,
+                                            dtype=dtype,
+                                            chunks=(1,) + store.shape[1:])
+                    for index in range(len(store)):
+                        dset[index] = cast_output(store[index], dtype)
+            else:
+                for index, name in enumerate(name_files):
+                    self.results[name] = np.array(
+                        cast_output(store[index], dtype))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            del store
+            shutil.rmtree(tmp_dir)
+
+    def save_results(self, path):
+        """
+        Streams the preprocessed images into a HDF5 file, so that only one
+        image is held in memory at a time. The images are stored in the
+        dataset `images` of shape (nb_files, ny, nx), chunked image by image,
+        and the file names in the dataset `names`.
 
         """
         name_files = self.serie_arrays.get_name_files()
-        for i, img in enumerate(self.serie_arrays.iter_arrays()):
-            name = name_files[i]
-            self.results[name] = self.tools(img)
+        with h5py.File(path, 'w') as f:
+            f.create_dataset('names',
+                             data=np.array(name_files, dtype=np.bytes_))
+            dset = None
+            for i, (name, img) in enumerate(self.iter_results(copy=False)):
+                if dset is None:
+                    dset = f.create_dataset(
+                        'images', shape=(len(name_files),) + img.shape,
+                        dtype=img.dtype, chunks=(1,) + img.shape)
+                dset[i] = img
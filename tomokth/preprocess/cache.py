@@ -0,0 +1,121 @@
+"""On-disk cache of preprocessed images (:mod:`tomokth.preprocess.cache`)
+==========================================================================
+
+.. currentmodule:: tomokth.preprocess.cache
+
+Provides
+--------
+PreprocCache
+
+"""
+
+from __future__ import division
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from ..util.cache import DirectoryCache
+
+
+class PreprocCache(DirectoryCache):
+    """
+    Cache of preprocessed images, stored on disk as one `.npy` file per
+    image. Entries are keyed on a hash of the bytes of the raw image and of
+    the canonicalized parameters of the tools applied on it, so that
+    unchanged images are not preprocessed again when the same tools are
+    re-run. The images are hashed with xxhash (XXH3, 128 bits) if it is
+    installed, and with SHA-1 otherwise. The least recently used entries are
+    evicted once the cache is larger than `max_size` (see
+    `tomokth.util.cache.DirectoryCache`).
+
+    Parameters
+    ----------
+    path : str
+        Directory of the cache, created if needed.
+
+    max_size : float
+        Size budget of the cache in MB.
+
+    """
+
+    _description = 'preprocessed image'
+
+    @staticmethod
+    def canonicalize(tools, dtype=None, output_dtype=None):
+        """
+        Returns a canonical string of a sequence of tools and their
+        parameters, independent of the order of the keyword arguments.
+
+        Parameters
+        ----------
+        tools : sequence of tuples
+            Name and keyword arguments of each tool, in order of application
+
+        dtype : numpy dtype, optional
+            Data type in which the images are processed, if imposed
+
+        output_dtype : str, optional
+            Data type of the results, if imposed
+
+        """
+        tools = [[name, kwargs] for name, kwargs in tools]
+        if dtype is not None:
+            dtype = np.dtype(dtype).str
+        if output_dtype not in (None, 'native'):
+            output_dtype = np.dtype(output_dtype).str
+        return json.dumps({'tools': tools, 'dtype': dtype,
+                           'output_dtype': output_dtype}, sort_keys=True,
+                          default=repr)
+
+    @staticmethod
+    def make_key(img, tools):
+        """
+        Returns the hash identifying the result of `tools` (a canonical
+        string, see `canonicalize`) on the image `img`.
+
+        """
+        img = np.ascontiguousarray(img)
+        if xxhash is not None:
+            digest = xxhash.xxh3_128()
+        else:
+            digest = hashlib.sha1()
+        digest.update(tools.encode())
+        digest.update(repr((img.shape, img.dtype.str)).encode())
+        digest.update(img.data if img.size else b'')
+        return digest.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def _key(self, name):
+        return name[:-4] if name.endswith('.npy') else None
+
+    def load(self, key):
+        """Returns the cached image, or `None` if not in the cache."""
+        entry = self._entry(key)
+        try:
+            img = np.load(entry)
+            # Records the access for the LRU eviction
+            os.utime(entry, None)
+        except (IOError, OSError, ValueError):
+            # Missing, or evicted concurrently by another process
+            return None
+
+        return img
+
+    def save(self, key, img):
+        """Stores an image in the cache and evicts old entries."""
+        fd, tmp = tempfile.mkstemp(prefix='.tmp_', suffix='.npy',
+                                   dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, img)
+
+        self._store(key, tmp)
@@ -46,6 +46,32 @@ def _get_array_like_type(array_like, convert_to_ndarray=False):
         return ArrayLike
 
 
+def _iterate_imgs(tool, img_array_in, *args, **kwargs):
+    """
+    Applies `tool` one image at a time. The results of an nd-array of images
+    are gathered in a new array of the dtype returned by `tool`; other
+    array-like objects are modified in place.
+
+    """
+    if not isinstance(img_array_in, np.ndarray):
+        for i, img in enumerate(img_array_in):
+            args, kwargs = _replace_img_arg(img, *args, **kwargs)
+            img_array_in[i] = tool(*args, **kwargs)  # Function call!
+
+        return img_array_in
+
+    img_array_out = None
+    for i, img in enumerate(img_array_in):
+        args, kwargs = _replace_img_arg(img, *args, **kwargs)
+        img_out = tool(*args, **kwargs)  # Function call!
+        if img_array_out is None:
+            img_array_out = np.empty((len(img_array_in),) + img_out.shape,
+                                     dtype=img_out.dtype)
+        img_array_out[i] = img_out
+
+    return img_array_out
+
+
 @decorator
 def iterate_multiple_imgs(tool, *args, **kwargs):
     """
@@ -59,11 +85,36 @@ def iterate_multiple_imgs(tool, *args, **kwargs):
         if img_array_in.ndim == 2:
             return tool(*args, **kwargs)  # Function call!
 
-    for i, img in enumerate(img_array_in):
-        args, kwargs = _replace_img_arg(img, *args, **kwargs)
-        img_array_in[i] = tool(*args, **kwargs)  # Function call!
+    return _iterate_imgs(tool, img_array_in, *args, **kwargs)
+
+
+@decorator
+def stack_multiple_imgs(tool, *args, **kwargs):
+    """
+    Feeds a 3D nd-array of images to the function `tool` in a single call.
+    The tool must filter each image of the stack independently, for instance
+    with a window of shape (1, dy, dx) (see `spatial_size`). Other array-like
+    objects are fed one image at a time, as with `iterate_multiple_imgs`.
+
+    """
+    img_array_in = _get_img_arg(*args, **kwargs)
+
+    if isinstance(img_array_in, np.ndarray) and img_array_in.ndim in (2, 3):
+        return tool(*args, **kwargs)  # Function call!
+
+    return _iterate_imgs(tool, img_array_in, *args, **kwargs)
+
+
+def spatial_size(img, size, fill=1):
+    """
+    Extends the size of a 2D window to a stack of images, with `fill` along
+    the first axis: 1 for a window size, 0 for the sigma of a kernel.
+
+    """
+    if img.ndim == 2:
+        return size
 
-    return img_array_in
+    return (fill,) * (img.ndim - 2) + tuple(np.broadcast_to(size, (2,)))
 
 
 @decorator
@@ -0,0 +1,224 @@
+"""Instrumentation of the preprocessing tools (:mod:`tomokth.preprocess.stats`)
+===============================================================================
+
+.. currentmodule:: tomokth.preprocess.stats
+
+Provides
+--------
+ToolStats
+
+"""
+
+from __future__ import division
+import csv
+import json
+import threading
+from timeit import default_timer
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class ToolStats(object):
+    """
+    Statistics of the calls of each preprocessing tool: number of calls,
+    total wall time, shape and dtype of the last input and output, and peak
+    memory allocated during a call.
+
+    Timing only costs a clock read per call, and can be left on. Measuring
+    the memory relies on `tracemalloc`, which slows down every allocation of
+    the process, and is therefore optional. NumPy reports its allocations to
+    `tracemalloc`, so the peak includes the temporary arrays of the tools.
+    Tracing is started for each measured call, unless it is already on, and
+    stopped after it.
+
+    The statistics can be updated from several threads, e.g. by the tiles
+    of `apply_tiled`. The peak of `tracemalloc` is global to the process,
+    so measured calls are then serialized, and the peaks still include the
+    allocations of the other threads: they are only meaningful when the
+    tools run in a single thread.
+
+    Parameters
+    ----------
+    memory : bool
+        Measures the peak allocated bytes of each call with `tracemalloc`.
+
+    """
+
+    fields = ['tool', 'calls', 'time', 'time_per_call', 'peak_bytes',
+              'in_shape', 'in_dtype', 'out_shape', 'out_dtype']
+
+    def __init__(self, memory=False):
+        if memory and tracemalloc is None:
+            raise ValueError('Measuring memory requires tracemalloc.')
+
+        self.memory = memory
+        self.records = {}
+        self._init_locks()
+
+    def _init_locks(self):
+        # Protects the records, and serializes the calls measuring memory
+        self._lock = threading.Lock()
+        self._memory_lock = threading.Lock()
+
+    def __getstate__(self):
+        # The statistics of worker processes are pickled, without the locks
+        state = dict(self.__dict__)
+        del state['_lock'], state['_memory_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_locks()
+
+    def reset(self):
+        """Forgets all the recorded calls."""
+        with self._lock:
+            self.records = {}
+
+    def measure(self, tool, func, img, **kwargs):
+        """Calls `func(img, **kwargs)`, records its statistics as `tool`
+        and returns its result."""
+        if not self.memory:
+            t_start = default_timer()
+            img_out = func(img, **kwargs)
+            self.record(tool, default_timer() - t_start, img, img_out)
+            return img_out
+
+        with self._memory_lock:
+            started = not tracemalloc.is_tracing()
+            if started:
+                tracemalloc.start()
+            try:
+                start_bytes = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                t_start = default_timer()
+                img_out = func(img, **kwargs)
+                elapsed = default_timer() - t_start
+                peak = tracemalloc.get_traced_memory()[1] - start_bytes
+            finally:
+                if started:
+                    tracemalloc.stop()
+
+        self.record(tool, elapsed, img, img_out, peak)
+        return img_out
+
+    def measure_stream(self, tool, func, imgs, **kwargs):
+        """
+        Generator applying the streaming tool `func(imgs, **kwargs)` and
+        recording each image it yields as one call of `tool`. The time spent
+        reading the input iterable, e.g. in the previous stage, is excluded.
+        The memory of streaming tools is not measured.
+
+        """
+        state = {'read': 0., 'img': None}
+
+        def source():
+            for img in imgs:
+                state['read'] += default_timer() - state['t_read']
+                state['img'] = img
+                yield img
+                state['t_read'] = default_timer()
+
+        state['t_read'] = default_timer()
+        results = func(source(), **kwargs)
+        while True:
+            state['read'] = 0.
+            t_start = state['t_read'] = default_timer()
+            try:
+                img_out = next(results)
+            except StopIteration:
+                return
+            elapsed = default_timer() - t_start - state['read']
+            self.record(tool, elapsed, state['img'], img_out)
+            yield img_out
+
+    def record(self, tool, elapsed, img_in=None, img_out=None, peak=None):
+        """Adds one call of `tool` lasting `elapsed` seconds."""
+        with self._lock:
+            self._record(tool, elapsed, img_in, img_out, peak)
+
+    def _record(self, tool, elapsed, img_in, img_out, peak):
+        record = self.records.get(tool)
+        if record is None:
+            record = self.records[tool] = {
+                'calls': 0, 'time': 0., 'peak_bytes': None,
+                'in_shape': None, 'in_dtype': None,
+                'out_shape': None, 'out_dtype': None}
+
+        record['calls'] += 1
+        record['time'] += elapsed
+        if peak is not None:
+            record['peak_bytes'] = max(peak, record['peak_bytes'] or 0)
+
+        for prefix, img in (('in', img_in), ('out', img_out)):
+            shape = getattr(img, 'shape', None)
+            if shape is not None:
+                record[prefix + '_shape'] = list(shape)
+                record[prefix + '_dtype'] = str(img.dtype)
+
+    def merge(self, other):
+        """Adds the records of another `ToolStats`, for instance collected in
+        a worker process."""
+        with self._lock:
+            self._merge(other)
+
+    def _merge(self, other):
+        for tool, other_record in other.records.items():
+            record = self.records.get(tool)
+            if record is None:
+                self.records[tool] = dict(other_record)
+                continue
+
+            record['calls'] += other_record['calls']
+            record['time'] += other_record['time']
+            if other_record['peak_bytes'] is not None:
+                record['peak_bytes'] = max(other_record['peak_bytes'],
+                                           record['peak_bytes'] or 0)
+            for key in ('in_shape', 'in_dtype', 'out_shape', 'out_dtype'):
+                if other_record[key] is not None:
+                    record[key] = other_record[key]
+
+    def as_rows(self):
+        """Returns one dictionary per tool, sorted by decreasing time."""
+        rows = []
+        with self._lock:
+            records = [(tool, dict(record))
+                       for tool, record in self.records.items()]
+        for tool, record in records:
+            row = dict(record, tool=tool,
+                       time_per_call=record['time'] / record['calls'])
+            rows.append(row)
+
+        return sorted(rows, key=lambda row: row['time'], reverse=True)
+
+    def to_json(self, path):
+        """Dumps the statistics into a JSON file."""
+        with open(path, 'w') as f:
+            json.dump(self.as_rows(), f, indent=2)
+
+    def to_csv(self, path):
+        """Dumps the statistics into a CSV file, one line per tool."""
+        with open(path, 'w') as f:
+            writer = csv.DictWriter(f, self.fields)
+            writer.writeheader()
+            for row in self.as_rows():
+                row = dict(row)
+                for key in ('in_shape', 'out_shape'):
+                    if row[key] is not None:
+                        row[key] = 'x'.join(str(n) for n in row[key])
+                writer.writerow(row)
+
+    def __str__(self):
+        lines = ['{:<24} {:>8} {:>10} {:>14} {:>12}'.format(
+            'tool', 'calls', 'time (s)', 'per call (ms)', 'peak (MB)')]
+        for row in self.as_rows():
+            peak = row['peak_bytes']
+            lines.append('{:<24} {:>8} {:>10.3f} {:>14.3f} {:>12}'.format(
+                row['tool'], row['calls'], row['time'],
+                1e3 * row['time_per_call'],
+                '-' if peak is None else '{:.1f}'.format(peak / 2 ** 20)))
+
+        return '\n'.join(lines)
@@ -0,0 +1,160 @@
+"""Tiled application of the tools (:mod:`tomokth.preprocess.tiling`)
+======================================================================
+Applies spatial tools tile by tile on large images, so that the temporary
+arrays of the tools have the size of a tile instead of the whole image.
+
+.. currentmodule:: tomokth.preprocess.tiling
+
+Provides
+--------
+tile_slices, apply_tiled
+
+"""
+
+from __future__ import division
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def tile_slices(shape, tile_size, halo):
+    """
+    Generates the tiles of an image of 2D shape `shape`, as pairs
+    `(interior, extended)` of tuples of slices in the image, and the slices
+    `local` of the interior within the extended tile.
+
+    Parameters
+    ----------
+    shape : tuple of integers
+        Shape (ny, nx) of the image
+    tile_size : integer or tuple of integers
+        Shape of the interior of the tiles
+    halo : tuple of integers
+        Width of the halo along y and x, clipped at the borders of the image
+
+    """
+    tile_size = np.broadcast_to(tile_size, (2,))
+    starts = [range(0, n, int(size)) for n, size in zip(shape, tile_size)]
+    for y_start in starts[0]:
+        for x_start in starts[1]:
+            interior, extended, local = [], [], []
+            for start, n, size, h in zip((y_start, x_start), shape,
+                                         tile_size, halo):
+                stop = min(start + int(size), n)
+                ext_start = max(start - h, 0)
+                ext_stop = min(stop + h, n)
+                interior.append(slice(start, stop))
+                extended.append(slice(ext_start, ext_stop))
+                local.append(slice(start - ext_start, stop - ext_start))
+            yield tuple(interior), tuple(extended), tuple(local)
+
+
+def _apply_chain(img, tools, stats, dtype):
+    for name, func, kwargs in tools:
+        if stats is None:
+            img = func(img, **kwargs)
+        else:
+            img = stats.measure(name, func, img, **kwargs)
+        if dtype is not None:
+            img = img.astype(dtype, copy=False)
+
+    return img
+
+
+def apply_tiled(img, tools, halos, tile_size, nb_threads=1, out=None,
+                stats=None, dtype=None):
+    """
+    Applies a sequence of tools on an image (or a stack of images, tiled
+    along the last two axes), tile by tile.
+
+    Consecutive tools with a halo are applied together on each tile, extended
+    by the sum of their halos, so that the interiors of the tiles are exactly
+    those of the whole image. Tools without a halo (`None`), which depend on
+    the whole image, are applied on the whole image between them.
+
+    Parameters
+    ----------
+    img : nd-array
+        Image, not modified
+    tools : list of tuples
+        Name, function and keyword arguments of each tool
+    halos : list
+        Halo (hy, hx) of each tool, or `None`
+    tile_size : integer or tuple of integers
+        Shape of the interior of the tiles
+    nb_threads : integer
+        Number of threads processing the tiles
+    out : nd-array, optional
+        Array in which the result is written
+    stats : ToolStats, optional
+        Statistics updated by each call of a tool, once per tile
+    dtype : numpy dtype, optional
+        Type to which the result of each tool is cast
+
+    """
+    # Splits the tools into runs of tiled tools and untiled tools
+    runs = []
+    for tool, halo in zip(tools, halos):
+        if halo is None:
+            runs.append((None, [tool]))
+        elif runs and runs[-1][0] is not None:
+            runs[-1][0].append(halo)
+            runs[-1][1].append(tool)
+        else:
+            runs.append(([halo], [tool]))
+
+    executor = None
+    if nb_threads > 1:
+        executor = ThreadPoolExecutor(nb_threads)
+
+    try:
+        for i, (run_halos, run_tools) in enumerate(runs):
+            dst = out if i == len(runs) - 1 else None
+            if run_halos is None:
+                img = _apply_chain(img, run_tools, stats, dtype)
+                if dst is not None:
+                    np.copyto(dst, img, casting='unsafe')
+                    img = dst
+                continue
+
+            halo = np.sum(run_halos, axis=0).astype(int)
+            img = _apply_run(img, run_tools, halo, tile_size, executor, dst,
+                             stats, dtype)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if out is not None and img is not out:
+        np.copyto(out, img, casting='unsafe')
+        img = out
+
+    return img
+
+
+def _apply_run(img, tools, halo, tile_size, executor, dst, stats, dtype):
+    """Applies a run of tools with a total halo `halo` tile by tile."""
+    tiles = list(tile_slices(img.shape[-2:], tile_size, halo))
+    ellipsis = (Ellipsis,)
+
+    def process(tile):
+        interior, extended, local = tile
+        result = _apply_chain(img[ellipsis + extended], tools, stats, dtype)
+        return interior, result[ellipsis + local]
+
+    # The first tile gives the dtype of the results
+    interior, result = process(tiles[0])
+    if dst is None:
+        dst = np.empty(img.shape, dtype=result.dtype)
+    dst[ellipsis + interior] = result
+
+    def process_and_store(tile):
+        interior, result = process(tile)
+        dst[ellipsis + interior] = result
+
+    if executor is None:
+        for tile in tiles[1:]:
+            process_and_store(tile)
+    else:
+        list(executor.map(process_and_store, tiles[1:]))
+
+    return dst
@@ -25,7 +25,11 @@ except ImportError:
     print('Warning: ImportError, to use fluidimage.preproc, '
           'first install scikit-image >= 0.12.3.')
 
-from .io import iterate_multiple_imgs, multiple_imgs_as_ndarray
+from .cache import PreprocCache
+from .stats import ToolStats
+from .tiling import apply_tiled
+from .io import (iterate_multiple_imgs, multiple_imgs_as_ndarray,
+                 stack_multiple_imgs, spatial_size)
 from ..util.util import logger
 
 
@@ -36,7 +40,10 @@ available_tools = ['sliding_median', 'sliding_minima', 'sliding_percentile',
                    'equalize_hist_adapt',
                    'gamma_correction', 'sharpen', 'rescale_intensity_tanh']
 
-__all__ = available_tools + ['PreprocTools']
+# Tools which need the whole series of images at once
+temporal_tools = ['temporal_median', 'temporal_minima', 'temporal_percentile']
+
+__all__ = available_tools + ['PreprocTools', 'CompiledTools']
 
 
 def imstats(img, hist_bins=256):
@@ -48,9 +55,162 @@ def imstats(img, hist_bins=256):
 #   SPATIAL FILTERS
 # ----------------------------------------------------
 
-@iterate_multiple_imgs
+def _float_dtype(img):
+    """Floating point dtype of the results of a tool: float32 images stay
+    float32, integer images are promoted to float64."""
+    return np.result_type(img.dtype, 1.)
+
+
+def _rescale_range(img, minimum, maximum, dtype):
+    """
+    Rescales the intensities of an image linearly from their range onto
+    (minimum, maximum), in a new array of type `dtype`. Equivalent to
+    `skimage.exposure.rescale_intensity(img, out_range=(minimum, maximum))`.
+
+    """
+    img_out = img.astype(dtype)
+    imin, imax = img_out.min(), img_out.max()
+    if imax != imin:
+        img_out -= imin
+        img_out /= imax - imin
+    img_out *= maximum - minimum
+    img_out += minimum
+    return img_out
+
+
+def _footprint(window_size):
+    """Rectangular footprint for a scalar or tuple window size."""
+    return np.ones(np.broadcast_to(window_size, (2,)), dtype=bool)
+
+
+def _upsample_axis(arr, nb_points, factor, offset, axis):
+    """
+    Linear interpolation along `axis` of an array sampled every `factor`
+    pixels starting at pixel `offset`, back onto `nb_points` pixels.
+
+    """
+    x = np.clip((np.arange(nb_points) - offset) / factor,
+                0, arr.shape[axis] - 1)
+    i0 = np.floor(x).astype(np.intp)
+    i1 = np.minimum(i0 + 1, arr.shape[axis] - 1)
+    shape = [1] * arr.ndim
+    shape[axis] = nb_points
+    frac = (x - i0).reshape(shape).astype(arr.dtype)
+    arr0 = np.take(arr, i0, axis=axis)
+    return arr0 + frac * (np.take(arr, i1, axis=axis) - arr0)
+
+
+def _frame_by_frame(background_func):
+    """Applies a background function of a 2D image on each image of a stack."""
+    def wrapper(img, *args, **kwargs):
+        if img.ndim == 2:
+            return background_func(img, *args, **kwargs)
+
+        return np.stack([background_func(frame, *args, **kwargs)
+                         for frame in img])
+
+    wrapper.__doc__ = background_func.__doc__
+    return wrapper
+
+
+def _subtract_filtered(img, weight, filter_func, *args, **kwargs):
+    """
+    Returns `img - weight * filter_func(img)`. The filter writes directly in
+    the output, preallocated in floating point or given as the keyword
+    argument `out`, so that a stack of images is processed in a single call
+    without intermediate arrays.
+
+    """
+    img_out = kwargs.pop('out', None)
+    if img_out is None:
+        img_out = np.empty(img.shape, dtype=np.result_type(img, float(weight)))
+    filter_func(img, *args, output=img_out, **kwargs)
+    img_out *= -weight
+    img_out += img
+    return img_out
+
+
+def _subtract_background(img, weight, background, out=None):
+    """Returns `img - weight * background`, written in `out` if provided."""
+    if out is None:
+        return img - weight * background.astype(_float_dtype(img), copy=False)
+
+    np.multiply(background, -weight, out=out)
+    out += img
+    return out
+
+
+@_frame_by_frame
+def _downsampled_background(img, filter_func, window_size, factor,
+                            block_minima=False, **kwargs):
+    """
+    Background computed by `filter_func` on the image decimated by `factor`
+    with a window `factor` times smaller, and interpolated back onto the
+    image. The image is decimated by taking one pixel out of `factor` along
+    each axis, or with `block_minima` the minimum of each block of
+    factor x factor pixels. Point sampling is preferred to block means for
+    the median and percentiles, which would be biased by the bright
+    particles spread over the blocks.
+
+    """
+    ny, nx = img.shape
+    if block_minima:
+        pad = (-ny % factor, -nx % factor)
+        img = np.pad(img, ((0, pad[0]), (0, pad[1])), mode='edge')
+        small = img.reshape(img.shape[0] // factor, factor,
+                            img.shape[1] // factor, factor).min(axis=(1, 3))
+        offset = (factor - 1) / 2.
+    else:
+        offset = factor // 2
+        small = img[offset::factor, offset::factor]
+
+    size = np.maximum(np.rint(np.asarray(window_size) / factor), 1).astype(int)
+    background = filter_func(small, size=tuple(np.broadcast_to(size, (2,))),
+                             **kwargs).astype(_float_dtype(img))
+    background = _upsample_axis(background, ny, factor, offset, axis=0)
+    return _upsample_axis(background, nx, factor, offset, axis=1)
+
+
+@_frame_by_frame
+def _rank_filter_background(img, rank_func, window_size, **kwargs):
+    """Histogram-based background from `skimage.filters.rank`."""
+    if img.dtype.kind == 'f':
+        # Floating point images holding integer intensities, for instance
+        # raw images converted by the dtype policy of PreprocTools
+        img_int = img.astype(np.uint16)
+        if np.array_equal(img_int, img):
+            img = img_int
+
+    if img.dtype not in (np.uint8, np.uint16):
+        raise ValueError(
+            "method='histogram' requires images of type uint8 or uint16.")
+
+    return rank_func(img, _footprint(window_size), **kwargs)
+
+
+# Number of bins above which the sliding histogram of skimage, whose cost
+# grows with the number of bins, is slower than the scipy rank filters
+_histogram_max_bins = 8192
+
+
+def _histogram_is_fast(img):
+    """Checks if the sliding histogram of `img` has few enough bins."""
+    if img.dtype == np.uint8 or img.size == 0:
+        return True
+
+    nb_bins = int(img.max()) + 1
+    if nb_bins <= _histogram_max_bins:
+        return True
+
+    logger.info("method='histogram' would use {} bins, using method='exact' "
+                "instead".format(nb_bins))
+    return False
+
+
+@stack_multiple_imgs
 def sliding_median(img=None, weight=1., window_size=30,
-                   boundary_condition='reflect'):
+                   boundary_condition='reflect', method='exact', downsample=4,
+                   out=None):
     '''
     Subtracts the median calculated within a sliding window from the centre of
     the window.
@@ -67,17 +227,52 @@ def sliding_median(img=None, weight=1., window_size=30,
         Specifying `window_size=3` is equivalent to `window_size=(3,3)`.
     boundary_condition : {'reflect', 'constant', 'nearest', 'mirror', 'wrap'}
         Mode of handling array borders.
+    method : {'exact', 'histogram', 'downsample'}
+        Computation of the median.
+        'exact': `scipy.ndimage.median_filter`, O(w^2 log w) per pixel.
+        'histogram': sliding histogram of `skimage.filters.rank.median`,
+        for uint8 or uint16 images only. Its cost per pixel grows with w and
+        with the number of bins, i.e. the maximum of the image, so that it
+        is fast for 8 to 12 bit data. Above 8192 bins, where it becomes
+        slower than 'exact', 'exact' is used instead. The result is exact
+        away from the borders; near the borders the window is truncated
+        instead of following `boundary_condition`.
+        'downsample': the median is computed on the image decimated by
+        keeping one pixel out of `downsample` along each axis, and linearly
+        interpolated back, which costs about `downsample**4` times less.
+        Only suited to smooth backgrounds:
+        variations of the background on scales smaller than
+        `downsample` pixels are lost.
+    downsample : integer
+        Decimation factor for `method='downsample'`
+    out : nd-array, optional
+        Array in which the result is written.
 
     '''
-    img_out = img - weight * nd.median_filter(img,
-                                              size=window_size,
-                                              mode=boundary_condition)
-    return img_out
-
-
-@iterate_multiple_imgs
+    if method == 'histogram' and not _histogram_is_fast(img):
+        method = 'exact'
+
+    if method == 'exact':
+        return _subtract_filtered(img, weight, nd.median_filter,
+                                  size=spatial_size(img, window_size),
+                                  mode=boundary_condition, out=out)
+    elif method == 'histogram':
+        background = _rank_filter_background(img, filters.rank.median,
+                                             window_size)
+    elif method == 'downsample':
+        background = _downsampled_background(img, nd.median_filter,
+                                             window_size, downsample,
+                                             mode=boundary_condition)
+    else:
+        raise ValueError('Unknown method ' + repr(method))
+
+    return _subtract_background(img, weight, background, out)
+
+
+@stack_multiple_imgs
 def sliding_percentile(img=None, percentile=10., weight=1., window_size=30,
-                       boundary_condition='reflect'):
+                       boundary_condition='reflect', method='exact',
+                       downsample=4, out=None):
     '''
     Flexible version of median filter. Low percentile values work well
     for dense images.
@@ -96,18 +291,44 @@ def sliding_percentile(img=None, percentile=10., weight=1., window_size=30,
         Specifies the shape of the window as follows (dt, dy, dx)
     boundary_condition : {'reflect', 'constant', 'nearest', 'mirror', 'wrap'}
         Mode of handling array borders.
+    method : {'exact', 'histogram', 'downsample'}
+        Computation of the percentile, with the same trade-offs as for
+        `sliding_median`. With 'histogram' (`skimage.filters.rank.percentile`)
+        the rank within the window may also differ by one from 'exact'.
+        'histogram' falls back to 'exact' above 8192 bins.
+    downsample : integer
+        Decimation factor for `method='downsample'`
+    out : nd-array, optional
+        Array in which the result is written.
 
     '''
-    img_out = img - weight * nd.percentile_filter(img,
-                                                  percentile,
-                                                  size=window_size,
-                                                  mode=boundary_condition)
-    return img_out
-
-
-@iterate_multiple_imgs
+    if method == 'histogram' and not _histogram_is_fast(img):
+        method = 'exact'
+
+    if method == 'exact':
+        return _subtract_filtered(img, weight, nd.percentile_filter,
+                                  percentile,
+                                  size=spatial_size(img, window_size),
+                                  mode=boundary_condition, out=out)
+    elif method == 'histogram':
+        background = _rank_filter_background(img, filters.rank.percentile,
+                                             window_size,
+                                             p0=percentile / 100.)
+    elif method == 'downsample':
+        background = _downsampled_background(img, nd.percentile_filter,
+                                             window_size, downsample,
+                                             percentile=percentile,
+                                             mode=boundary_condition)
+    else:
+        raise ValueError('Unknown method ' + repr(method))
+
+    return _subtract_background(img, weight, background, out)
+
+
+@stack_multiple_imgs
 def sliding_minima(img=None, weight=1., window_size=30,
-                   boundary_condition='reflect'):
+                   boundary_condition='reflect', method='exact', downsample=4,
+                   out=None):
     '''
     Subtracts the minimum calculated within a sliding window from the centre of
     the window.
@@ -124,12 +345,33 @@ def sliding_minima(img=None, weight=1., window_size=30,
         Specifying `window_size=3` is equivalent to `window_size=(3,3)`.
     boundary_condition : {'reflect', 'constant', 'nearest', 'mirror', 'wrap'}
         Mode of handling array borders.
+    method : {'exact', 'downsample'}
+        Computation of the minima.
+        'exact': `scipy.ndimage.minimum_filter`, which is separable and
+        already costs O(1) per pixel, independently of the window size.
+        'downsample': the minima of blocks of `downsample` x `downsample`
+        pixels are filtered and linearly interpolated back. The window is
+        rounded to whole blocks, so the background differs within about
+        `downsample` pixels of sharp changes of the minima.
+    downsample : integer
+        Decimation factor for `method='downsample'`
+    out : nd-array, optional
+        Array in which the result is written.
 
     '''
-    img_out = img - weight * nd.minimum_filter(img,
-                                               size=window_size,
-                                               mode=boundary_condition)
-    return img_out
+    if method == 'exact':
+        return _subtract_filtered(img, weight, nd.minimum_filter,
+                                  size=spatial_size(img, window_size),
+                                  mode=boundary_condition, out=out)
+    elif method == 'downsample':
+        background = _downsampled_background(img, nd.minimum_filter,
+                                             window_size, downsample,
+                                             block_minima=True,
+                                             mode=boundary_condition)
+    else:
+        raise ValueError('Unknown method ' + repr(method))
+
+    return _subtract_background(img, weight, background, out)
 
 
 # ----------------------------------------------------
@@ -150,7 +392,10 @@ def temporal_median(img=None, weight=1., window_shape=None):
         Fraction of median to be subtracted from each pixel.
         Value of `weight` should be in the interval (0.0,1.0).
     window_shape : tuple of integers
-        Specifies the shape of the window as follows (dt, dy, dx)
+        Specifies the shape of the window as follows (dt, dy, dx). By default
+        the whole series, which is then loaded in memory at once by
+        `PreprocBase`. With a finite window, `PreprocBase` streams the series
+        with the memory footprint of the window (see `iter_temporal_median`).
 
     '''
     time_axis = 0
@@ -190,7 +435,10 @@ def temporal_percentile(img=None, percentile=10., weight=1.,
         Fraction of median to be subtracted from each pixel.
         Value of `weight` should be in the interval (0.0,1.0).
     window_shape : tuple of integers
-        Specifies the shape of the window as follows (dt, dy, dx)
+        Specifies the shape of the window as follows (dt, dy, dx). By default
+        the whole series, which is then loaded in memory at once by
+        `PreprocBase`. With a finite window, `PreprocBase` streams the series
+        with the memory footprint of the window (see `iter_temporal_percentile`).
 
     '''
     time_axis = 0
@@ -214,7 +462,7 @@ def temporal_percentile(img=None, percentile=10., weight=1.,
 
 
 @multiple_imgs_as_ndarray
-def temporal_minima(img=None, weight=1.):
+def temporal_minima(img=None, weight=1., window_size=None):
     '''
     Subtracts the minima calculated in time,for each pixel.
 
@@ -225,6 +473,11 @@ def temporal_minima(img=None, weight=1.):
     weight : scalar
         Fraction of minima to be subtracted from each pixel.
         Value of `weight` should be in the interval (0.0,1.0).
+    window_size : integer
+        Number of images in the sliding window in time. By default, all
+        images of the series, which is then loaded in memory at once by
+        `PreprocBase`. With a finite window, `PreprocBase` streams the series
+        with the memory footprint of the window (see `iter_temporal_minima`).
 
     '''
     time_axis = 0
@@ -233,19 +486,210 @@ def temporal_minima(img=None, weight=1.):
         raise ValueError(
             'Need more than one image to apply temporal filtering.')
 
-    window_size = img.shape[time_axis]
+    if window_size is None:
+        window_size = nb_imgs
     img_out = img - weight * nd.minimum_filter1d(img,
                                                  size=window_size,
                                                  axis=time_axis)
     return img_out
 
 
+# ----------------------------------------------------
+#   STREAMING SPATIO-TEMPORAL FILTERS
+# ----------------------------------------------------
+
+def _reflect(index, nb_imgs=None):
+    """
+    Maps indices outside the series as the 'reflect' mode of scipy.ndimage.
+    While the series is being read (`nb_imgs` unknown), only the start of
+    the series is reflected.
+
+    """
+    if nb_imgs is None:
+        return np.where(index < 0, -index - 1, index)
+
+    index = np.mod(index, 2 * nb_imgs)
+    return np.where(index >= nb_imgs, 2 * nb_imgs - 1 - index, index)
+
+
+def _iter_rolling(imgs, window_shape, background, weight):
+    """
+    Streams over a series of images and yields each image minus `weight`
+    times its background, computed by `background(window)` from the
+    window of images centred on it.
+
+    Only `window_shape[0]` images are kept in a ring buffer. The window in
+    time is the one of scipy.ndimage filters, with the 'reflect' mode at the
+    ends of the series, so that the output is delayed by
+    `window_shape[0] - 1 - window_shape[0] // 2` images.
+
+    """
+    size = window_shape[0]
+    if size <= 1:
+        raise ValueError(
+            'Cannot perform temporal filtering, try spatial filtering.')
+
+    half = size // 2
+    lookahead = size - 1 - half
+    ring = None
+    nb_imgs = 0
+
+    def _output(t, nb_imgs=None):
+        index = _reflect(np.arange(t - half, t - half + size), nb_imgs)
+        window = ring[index % size]
+        return ring[t % size] - weight * background(window)
+
+    for img in imgs:
+        img = np.asarray(img)
+        if ring is None:
+            ring = np.empty((size,) + img.shape, dtype=img.dtype)
+        ring[nb_imgs % size] = img
+        nb_imgs += 1
+
+        t = nb_imgs - 1 - lookahead
+        if t >= 0:
+            yield _output(t)
+
+    if nb_imgs <= 1:
+        raise ValueError(
+            'Need more than one image to apply temporal filtering.')
+
+    for t in range(max(nb_imgs - lookahead, 0), nb_imgs):
+        yield _output(t, nb_imgs)
+
+
+def _rank_background(window_shape, rank):
+    """Background from the value of a given rank within the window."""
+    if all(n == 1 for n in window_shape[1:]):
+        def background(window):
+            return np.partition(window, rank, axis=0)[rank]
+    else:
+        def background(window):
+            return _centre_rank(window, rank, window_shape[1:])
+
+    return background
+
+
+def _centre_rank(window, rank, spatial_shape, max_elements=2 ** 24):
+    """
+    Value of rank `rank` within the neighbourhood of shape `spatial_shape`
+    of all the images of `window`, for the pixels of one image only. This is
+    the centre plane of `nd.rank_filter(window, rank, size=window.shape[:1]
+    + spatial_shape, mode='reflect')`, without filtering the other planes.
+    The neighbourhoods are gathered by blocks of rows of at most
+    `max_elements` values.
+
+    """
+    ny, nx = window.shape[1:]
+    dy, dx = spatial_shape
+    padded = np.pad(window, [(0, 0), (dy // 2, dy - 1 - dy // 2),
+                             (dx // 2, dx - 1 - dx // 2)], mode='symmetric')
+    # (ny, nx, t, dy, dx) view of the neighbourhood of each pixel
+    neighbourhoods = np.lib.stride_tricks.sliding_window_view(
+        padded, (dy, dx), axis=(1, 2)).transpose(1, 2, 0, 3, 4)
+    size = window.shape[0] * dy * dx
+    out = np.empty((ny, nx), dtype=window.dtype)
+    step = max(1, max_elements // (nx * size))
+    for start in range(0, ny, step):
+        block = neighbourhoods[start:start + step].reshape(-1, nx, size)
+        out[start:start + step] = np.partition(block, rank, axis=-1)[..., rank]
+
+    return out
+
+
+def _check_window_shape(window_shape):
+    if isinstance(window_shape, int):
+        window_shape = (window_shape, 1, 1)
+    elif not isinstance(window_shape, tuple):
+        raise ValueError('window_shape must be a tuple.')
+
+    return window_shape
+
+
+def iter_temporal_median(imgs, weight=1., window_shape=(10, 1, 1)):
+    '''
+    Streaming version of `temporal_median`, yielding the images one at a time
+    from any iterable over the series, with a memory footprint of
+    `window_shape[0]` images. The output is identical to `temporal_median`.
+
+    Parameters
+    ----------
+    imgs : iterable
+        Series of images, for instance `SerieOfArraysFromFiles.iter_arrays()`
+    weight : scalar
+        Fraction of median to be subtracted from each pixel.
+    window_shape : integer or tuple of integers
+        Specifies the shape of the window as follows (dt, dy, dx)
+
+    '''
+    window_shape = _check_window_shape(window_shape)
+    size = int(np.prod(window_shape))
+    return _iter_rolling(imgs, window_shape,
+                         _rank_background(window_shape, size // 2), weight)
+
+
+def iter_temporal_percentile(imgs, percentile=10., weight=1.,
+                             window_shape=(10, 1, 1)):
+    '''
+    Streaming version of `temporal_percentile`, yielding the images one at a
+    time from any iterable over the series, with a memory footprint of
+    `window_shape[0]` images. The output is identical to
+    `temporal_percentile`.
+
+    Parameters
+    ----------
+    imgs : iterable
+        Series of images, for instance `SerieOfArraysFromFiles.iter_arrays()`
+    percentile : scalar
+        Percentile to filter.
+    weight : scalar
+        Fraction of percentile to be subtracted from each pixel.
+    window_shape : integer or tuple of integers
+        Specifies the shape of the window as follows (dt, dy, dx)
+
+    '''
+    window_shape = _check_window_shape(window_shape)
+    size = int(np.prod(window_shape))
+    # Same rank as scipy.ndimage.percentile_filter
+    rank = min(int(percentile / 100. * size), size - 1)
+    return _iter_rolling(imgs, window_shape,
+                         _rank_background(window_shape, rank), weight)
+
+
+def iter_temporal_minima(imgs, weight=1., window_size=10):
+    '''
+    Streaming version of `temporal_minima`, yielding the images one at a time
+    from any iterable over the series, with a memory footprint of
+    `window_size` images. The output is identical to `temporal_minima`.
+
+    Parameters
+    ----------
+    imgs : iterable
+        Series of images, for instance `SerieOfArraysFromFiles.iter_arrays()`
+    weight : scalar
+        Fraction of minima to be subtracted from each pixel.
+    window_size : integer
+        Number of images in the sliding window in time.
+
+    '''
+    return _iter_rolling(imgs, (window_size,),
+                         lambda window: window.min(axis=0), weight)
+
+
+# Streaming equivalents of the temporal tools, and the argument which has to
+# be set for a finite window
+streaming_tools = {'temporal_median': (iter_temporal_median, 'window_shape'),
+                   'temporal_percentile': (iter_temporal_percentile,
+                                           'window_shape'),
+                   'temporal_minima': (iter_temporal_minima, 'window_size')}
+
+
 # ----------------------------------------------------
 #   BRIGHTNESS / CONTRAST TOOLS
 # ----------------------------------------------------
 
-@iterate_multiple_imgs
-def global_threshold(img=None, minima=0., maxima=65535.):
+@stack_multiple_imgs
+def global_threshold(img=None, minima=0., maxima=65535., out=None):
     '''
     Trims pixel intensities which are outside the interval (minima, maxima).
 
@@ -256,8 +700,13 @@ def global_threshold(img=None, minima=0., maxima=65535.):
 
     minima, maxima : float
         Sets the threshold
+    out : nd-array, optional
+        Array in which the result is written.
 
     '''
+    if out is not None:
+        return np.clip(img, minima, maxima, out=out)
+
     img_out = img.copy()
     img_out[img_out < minima] = minima
     img_out[img_out > maxima] = maxima
@@ -351,12 +800,13 @@ def equalize_hist_adapt(img=None, window_shape=(10, 10), nbins=256):
     .. [2] https://en.wikipedia.org/wiki/Histogram_equalization
 
     '''
+    dtype = _float_dtype(img)
     minimum = img.min()
     maximum = img.max()
-    img = rescale_intensity(img, 0, 1)
+    img = _rescale_range(img, 0, 1, dtype)
     img = exposure.equalize_adapthist(img, kernel_size=window_shape,
                                       nbins=nbins)
-    img_out = rescale_intensity(img, minimum, maximum)
+    img_out = _rescale_range(img, minimum, maximum, dtype)
     return img_out
 
 
@@ -380,11 +830,12 @@ def equalize_hist_local(img=None, radius=10):
 
     '''
     selem = morphology.disk(radius)
+    dtype = _float_dtype(img)
     minimum = img.min()
     maximum = img.max()
-    img = rescale_intensity(img, 0, 1)
+    img = _rescale_range(img, 0, 1, dtype)
     img = filters.rank.equalize(img, selem, mask=None)
-    img_out = rescale_intensity(img, minimum, maximum)
+    img_out = _rescale_range(img, minimum, maximum, dtype)
     return img_out
 
 
@@ -419,8 +870,8 @@ def gamma_correction(img=None, gamma=1., gain=1.):
     return img_out
 
 
-@iterate_multiple_imgs
-def sharpen(img=None, sigma1=3., sigma2=1., alpha=30.):
+@stack_multiple_imgs
+def sharpen(img=None, sigma1=3., sigma2=1., alpha=30., out=None):
     '''
     Sharpen image edges.
 
@@ -432,15 +883,252 @@ def sharpen(img=None, sigma1=3., sigma2=1., alpha=30.):
         Std deviation for two passes gaussian filters. sigma1 > sigma2
     alpha : float
         Factor by which the image will be sharpened
+    out : nd-array, optional
+        Array in which the result is written.
 
     '''
-    blurred = nd.gaussian_filter(img, sigma1)
-    filter_blurred = nd.gaussian_filter(blurred, sigma2)
-
-    img_out = blurred + alpha * (blurred - filter_blurred)
+    # Filters in floating point, in place of the dtype of the image
+    img_out = out
+    if img_out is None:
+        img_out = np.empty(img.shape, dtype=np.result_type(img, float(alpha)))
+    nd.gaussian_filter(img, spatial_size(img, sigma1, fill=0), output=img_out)
+    filter_blurred = nd.gaussian_filter(img_out,
+                                        spatial_size(img, sigma2, fill=0))
+
+    # blurred + alpha * (blurred - filter_blurred)
+    filter_blurred -= img_out
+    filter_blurred *= alpha
+    img_out -= filter_blurred
     return img_out
 
 
+# ----------------------------------------------------
+#   TILING
+# ----------------------------------------------------
+
+def _window_halo(kwargs):
+    if kwargs.get('method', 'exact') == 'downsample':
+        # The decimated pixels depend on the position of the tile
+        return None
+
+    if kwargs.get('boundary_condition') == 'wrap':
+        # A tile at the border would wrap around its own opposite edge, not
+        # around the opposite edge of the image
+        return None
+
+    return tuple(int(n) // 2
+                 for n in np.broadcast_to(kwargs['window_size'], (2,)))
+
+
+def _gaussian_radius(sigma):
+    """Radius of the kernel of `scipy.ndimage.gaussian_filter` (truncate=4)."""
+    return (4. * np.broadcast_to(sigma, (2,)) + 0.5).astype(int)
+
+
+def _sharpen_halo(kwargs):
+    return tuple(_gaussian_radius(kwargs['sigma1']) +
+                 _gaussian_radius(kwargs['sigma2']))
+
+
+def _pointwise_halo(kwargs):
+    return (0, 0)
+
+
+# Halo (hy, hx) needed around a tile by the local tools, as a function of
+# their parameters, for the tiles to match the whole image exactly. The other
+# tools depend on the whole image (global rescaling or histograms) and are
+# not tiled.
+tile_halos = {'sliding_median': _window_halo,
+              'sliding_minima': _window_halo,
+              'sliding_percentile': _window_halo,
+              'sharpen': _sharpen_halo,
+              'global_threshold': _pointwise_halo,
+              'gamma_correction': _pointwise_halo}
+
+
+def tool_halo(tool, kwargs):
+    """Returns the halo of a tool, or `None` if it cannot be tiled."""
+    halo = tile_halos.get(tool)
+    if halo is None:
+        return None
+
+    return halo(kwargs)
+
+
+# ----------------------------------------------------
+#   DTYPE POLICY
+# ----------------------------------------------------
+
+def output_dtype(output_dtype, native_dtype):
+    """Resolves the `output_dtype` parameter for raw images of type
+    `native_dtype`."""
+    if output_dtype == 'native':
+        return np.dtype(native_dtype)
+
+    return np.dtype(output_dtype)
+
+
+def cast_output(img, dtype, out=None):
+    """
+    Casts a preprocessed image to `dtype`. For integer types the intensities
+    are rounded and clipped to the range of the type. With `out`, the
+    floating point `img` is modified in place and the result is written in
+    `out`.
+
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'ui':
+        info = np.iinfo(dtype)
+        if out is None:
+            img = np.rint(img)
+        else:
+            np.rint(img, out=img)
+        np.clip(img, info.min, info.max, out=img)
+
+    if out is None:
+        return img.astype(dtype, copy=False)
+
+    np.copyto(out, img, casting='unsafe')
+    return out
+
+
+class CompiledTools(object):
+    """
+    Sequence of tools with their functions and keyword arguments resolved
+    once, to be applied on a long series of images of the same shape.
+
+    The tools accepting an `out` argument write their result in one of two
+    buffers of type `dtype`, used in turn (ping-pong), so that the
+    intermediate images are not allocated for each image. The other tools
+    return a new array, as usual. The final result is always held in one of
+    the buffers.
+
+    Parameters
+    ----------
+    tools : list of tuples
+        Name, function, keyword arguments and whether the function accepts
+        `out`, for each tool
+    dtype : numpy dtype
+        Data type of the buffers and of the results
+    cache : PreprocCache, optional
+        Cache of the results, looked up before applying the tools
+    stats : ToolStats, optional
+        Statistics updated by each call of a tool
+    tiling : tuple, optional
+        Tile size and number of threads. If given, the tools are applied
+        tile by tile (see `tomokth.preprocess.tiling.apply_tiled`), without
+        the ping-pong buffers.
+    output_dtype : str, optional
+        Type of the results, 'native' for the type of the input images
+        (see `cast_output`). By default the results are of type `dtype`.
+
+    """
+
+    def __init__(self, tools, dtype=np.float32, cache=None, stats=None,
+                 tiling=None, output_dtype=None):
+        self.tools = tools
+        self.dtype = np.dtype(dtype)
+        self.cache = cache
+        self.stats = stats
+        self.tiling = tiling
+        self.output_dtype = output_dtype
+        if tiling is not None:
+            self._halos = [tool_halo(name, kwargs)
+                           for name, func, kwargs, has_out in tools]
+        if cache is not None:
+            self._canonical = cache.canonicalize(
+                [(name, kwargs) for name, func, kwargs, has_out in tools],
+                self.dtype, output_dtype)
+        self._buffers = None
+        self._output = None
+
+    def _apply_buffered(self, img, buffers):
+        """Applies the tools, writing in the buffers where possible."""
+        for name, func, kwargs, has_out in self.tools:
+            logger.debug('Apply ' + name)
+            if has_out:
+                kwargs = dict(kwargs, out=(buffers[0] if img is not buffers[0]
+                                           else buffers[1]))
+
+            if self.stats is None:
+                img = func(img, **kwargs)
+            else:
+                img = self.stats.measure(name, func, img, **kwargs)
+
+            if img.dtype != self.dtype:
+                buf = buffers[0] if img is not buffers[0] else buffers[1]
+                np.copyto(buf, img, casting='unsafe')
+                img = buf
+
+        if not any(img is buf for buf in buffers):
+            np.copyto(buffers[0], img, casting='unsafe')
+            img = buffers[0]
+
+        return img
+
+    def _get_buffers(self, shape):
+        if self._buffers is None or self._buffers[0].shape != shape:
+            self._buffers = [np.empty(shape, dtype=self.dtype)
+                             for _ in range(2)]
+
+        return self._buffers
+
+    def __call__(self, img, copy=True):
+        """
+        Applies the tools on one image, or on a 3D stack of images.
+
+        Parameters
+        ----------
+        img : nd-array
+            Image to preprocess, not modified
+        copy : bool
+            If False, returns the buffer holding the result, which is
+            overwritten by the next call.
+
+        """
+        img = np.asarray(img)
+        buffers = self._get_buffers(img.shape)
+        key = None
+        if self.cache is not None:
+            key = self.cache.make_key(img, self._canonical)
+            img_out = self.cache.load(key)
+            if img_out is not None:
+                if copy or self.output_dtype is not None:
+                    return img_out
+                np.copyto(buffers[0], img_out)
+                return buffers[0]
+
+        native_dtype = img.dtype
+        if img.dtype != self.dtype:
+            np.copyto(buffers[1], img, casting='unsafe')
+            img = buffers[1]
+
+        if self.tiling is None:
+            img = self._apply_buffered(img, buffers)
+        else:
+            tile_size, nb_threads = self.tiling
+            img = apply_tiled(
+                img, [(name, func, kwargs)
+                      for name, func, kwargs, has_out in self.tools],
+                self._halos, tile_size, nb_threads, out=buffers[0],
+                stats=self.stats, dtype=self.dtype)
+
+        if self.output_dtype is not None:
+            dtype = output_dtype(self.output_dtype, native_dtype)
+            if self._output is None or self._output.shape != img.shape or \
+                    self._output.dtype != dtype:
+                self._output = np.empty(img.shape, dtype=dtype)
+            img = cast_output(img, dtype, out=self._output)
+
+        if key is not None:
+            self.cache.save(key, img)
+
+        if copy:
+            img = img.copy()
+
+        return img
+
+
 class PreprocTools(object):
     """Wrapper class for functions in the current module."""
 
@@ -455,7 +1143,20 @@ class PreprocTools(object):
         params.preproc._set_child('tools')
         params = params.preproc.tools
         params._set_attribs({'available_tools': available_tools,
-                             'sequence': None})
+                             'sequence': None,
+                             'dtype': 'float32',
+                             'output_dtype': None})
+        params._set_doc(
+            'sequence : list of str or None\n'
+            '        Order of application of the enabled tools\n'
+            'dtype : str or None\n'
+            '        Floating point type in which the images are processed.\n'
+            '        The input and the result of every tool are cast to it.\n'
+            '        If None, each tool keeps its own promotion rules.\n'
+            'output_dtype : str or None\n'
+            '        Type of the preprocessed images: None keeps `dtype`,\n'
+            '        \'native\' casts back to the type of the raw images.\n'
+            '        Integer types are rounded and clipped to their range.\n')
 
         for tool in available_tools:
             func = globals()[tool]
@@ -465,8 +1166,8 @@ class PreprocTools(object):
 
             # TODO: Replace with inspect.getfullargspec (Python >= 3).
             func_args = inspect.getcallargs(func)
-            for arg in func_args.keys():
-                if arg in ['img']:
+            for arg in list(func_args.keys()):
+                if arg in ['img', 'out']:
                     # Remove arguments which are not parameters
                     del(func_args[arg])
 
@@ -477,15 +1178,58 @@ class PreprocTools(object):
             params._set_child(tool, attribs=func_args)
 
             # Adds docstring to the parameter
-            if func.func_doc is not None:
+            if func.__doc__ is not None:
                 enable_doc = 'enable : bool\n' + \
                              '        Set as `True` to enable the tool'
-                params.__dict__[tool]._set_doc(func.func_doc + enable_doc)
+                params.__dict__[tool]._set_doc(func.__doc__ + enable_doc)
 
     def __init__(self, params):
         self.params = params.preproc.tools
+        self.cache = None
+        cache_params = getattr(params.preproc, 'cache', None)
+        if cache_params is not None and cache_params.path:
+            self.cache = PreprocCache(cache_params.path, cache_params.max_size)
+
+        self.stats = None
+        stats_params = getattr(params.preproc, 'stats', None)
+        if stats_params is not None and stats_params.enable:
+            self.stats = ToolStats(stats_params.memory)
+
+        self.tiling = None
+        tiling_params = getattr(params.preproc, 'tiling', None)
+        if tiling_params is not None and tiling_params.tile_size:
+            self.tiling = (tiling_params.tile_size, tiling_params.nb_threads)
+
+        dtype = getattr(self.params, 'dtype', None)
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.output_dtype = getattr(self.params, 'output_dtype', None)
+
+    def get_enabled_tools(self):
+        """Returns the names of the enabled tools, in order of application."""
+        sequence = self.params.sequence
+        if sequence is None:
+            sequence = self.params.available_tools
+
+        return [tool for tool in sequence if self.params.__dict__[tool].enable]
+
+    def get_stages(self):
+        """
+        Splits the enabled tools into stages of consecutive tools which are
+        applied image by image, and of temporal tools which are applied on
+        the whole series. Returns a list of `(is_temporal, sequence)`.
+
+        """
+        stages = []
+        for tool in self.get_enabled_tools():
+            temporal = tool in temporal_tools
+            if stages and stages[-1][0] == temporal:
+                stages[-1][1].append(tool)
+            else:
+                stages.append((temporal, [tool]))
 
-    def __call__(self, img):
+        return stages
+
+    def __call__(self, img, sequence=None, cast=True):
         """
         Apply all preprocessing tools for which `enable` is `True`.
         Return the preprocessed image (numpy array).
@@ -495,21 +1239,112 @@ class PreprocTools(object):
         img : array_like
             Single image as numpy array or multiple images as array-like object
 
+        sequence : list of str, optional
+            Enabled tools to apply, by default all of them.
+
+        cast : bool, optional
+            If False, the result is not cast to `output_dtype`, e.g. for an
+            intermediate stage whose input is not a raw image.
+
         """
-        sequence = self.params.sequence
         if sequence is None:
-            sequence = self.params.available_tools
+            sequence = self.get_enabled_tools()
+
+        out_dtype = self.output_dtype if cast else None
+        policy = self.dtype is not None and isinstance(img, np.ndarray)
+        key = None
+        if self.cache is not None and isinstance(img, np.ndarray):
+            key = self.cache.make_key(img, self.cache.canonicalize(
+                [(tool, self.get_kwargs(tool)) for tool in sequence],
+                self.dtype, out_dtype))
+            img_out = self.cache.load(key)
+            if img_out is not None:
+                return img_out
+
+        if policy:
+            native_dtype = img.dtype
+            img = img.astype(self.dtype, copy=False)
+
+        if self.tiling is not None and isinstance(img, np.ndarray):
+            tools = [(tool, globals()[tool], self.get_kwargs(tool))
+                     for tool in sequence]
+            tile_size, nb_threads = self.tiling
+            img = apply_tiled(img, tools,
+                              [tool_halo(tool, kwargs)
+                               for tool, func, kwargs in tools],
+                              tile_size, nb_threads, stats=self.stats,
+                              dtype=self.dtype)
+            sequence = []
 
         for tool in sequence:
-            tool_params = self.params.__dict__[tool]
-            if tool_params.enable:
-                logger.debug('Apply ' + tool)
-                kwargs = tool_params._make_dict()
-                for k in kwargs.keys():
-                    if k in ['_attribs', '_tag', '_tag_children', 'enable']:
-                        kwargs.pop(k)
+            logger.debug('Apply ' + tool)
+            func = globals()[tool]
+            if self.stats is None:
+                img = func(img, **self.get_kwargs(tool))
+            else:
+                img = self.stats.measure(tool, func, img,
+                                         **self.get_kwargs(tool))
+            if policy:
+                img = img.astype(self.dtype, copy=False)
 
-                cls = self.__class__
-                img = cls.__dict__[tool](img, **kwargs)
+        if policy and out_dtype is not None:
+            img = cast_output(img, output_dtype(out_dtype, native_dtype))
+
+        if key is not None:
+            self.cache.save(key, img)
 
         return img
+
+    def compile(self, sequence=None, dtype=None, cast=True):
+        """
+        Returns a `CompiledTools` applying the enabled tools (or `sequence`)
+        with the current parameters, without looking them up for each image.
+        The images are processed in `dtype`, by default the `dtype` of the
+        parameters, or float64 if it is None. If `cast` is False, the results
+        are not cast to `output_dtype`.
+
+        """
+        if dtype is None:
+            dtype = np.float64 if self.dtype is None else self.dtype
+
+        if sequence is None:
+            sequence = self.get_enabled_tools()
+
+        tools = []
+        for tool in sequence:
+            func = globals()[tool]
+            tools.append((tool, func, self.get_kwargs(tool),
+                          'out' in inspect.getcallargs(func)))
+
+        return CompiledTools(tools, dtype, self.cache, self.stats, self.tiling,
+                             self.output_dtype if cast else None)
+
+    def get_kwargs(self, tool):
+        """Returns the parameters of a tool as keyword arguments."""
+        tool_params = self.params.__dict__[tool]
+        return {k: tool_params.__dict__[k] for k in tool_params._key_attribs
+                if k != 'enable'}
+
+    def iter_temporal(self, imgs, sequence):
+        """
+        Chains the streaming versions of the temporal tools in `sequence`
+        over an iterable of images, and returns a generator of the filtered
+        images. Returns `None` if one of the tools has no finite window
+        (the default), in which case it needs the whole series at once.
+
+        """
+        for tool in sequence:
+            func, window_arg = streaming_tools[tool]
+            kwargs = self.get_kwargs(tool)
+            if kwargs.get(window_arg) is None:
+                logger.info('{} has no finite {}: the whole series is loaded '
+                            'in memory'.format(tool, window_arg))
+                return None
+
+            logger.debug('Stream ' + tool)
+            if self.stats is None:
+                imgs = func(imgs, **kwargs)
+            else:
+                imgs = self.stats.measure_stream(tool, func, imgs, **kwargs)
+
+        return imgs
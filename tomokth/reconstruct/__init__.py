@@ -0,0 +1,4 @@
+from .mart import MART
+from .smart import SMART
+from .mlos import mlos
+from .slab import SlabReconstruction
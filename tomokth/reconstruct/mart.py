@@ -0,0 +1,184 @@
+"""MART reconstruction (:mod:`tomokth.reconstruct.mart`)
+=======================================================================
+Multiplicative algebraic reconstruction technique, to reconstruct voxel
+intensities from preprocessed camera images.
+
+.. currentmodule:: tomokth.reconstruct.mart
+
+Provides
+--------
+.. autoclass:: MART
+   :members:
+   :private-members:
+
+"""
+
+from __future__ import division
+import numpy as np
+from fluiddyn.util.paramcontainer import ParamContainer
+
+from .mlos import mlos, compact_columns
+from ..util.util import logger
+
+
+class MART(object):
+    """
+    Reconstructs a volume from the images of several cameras, using the
+    sparse pixel-voxel weight matrices of each camera.
+
+    Parameters
+    ----------
+    weights : sequence of scipy.sparse matrices
+        Weight matrix of each camera, of shape (N_pix, N_vox), as returned by
+        `tomokth.operators.weights.build_weight_matrix`.
+
+    grid : VoxelGrid
+        Voxel grid of the volume
+
+    params : ParamContainer, optional
+        Parameters created by `MART.create_default_params`
+
+    """
+
+    @classmethod
+    def create_default_params(cls):
+        """Class method returning the default parameters."""
+        params = ParamContainer(tag='params')
+        params._set_child('reconstruct', attribs={'nb_iterations': 5,
+                                                  'relaxation': 1.,
+                                                  'init_value': 1.,
+                                                  'mlos': True})
+        params.reconstruct._set_doc(
+            'nb_iterations : int\n'
+            '        Number of MART iterations over all pixels\n'
+            'relaxation : float\n'
+            '        Relaxation factor (mu) of the multiplicative update, in (0, 1]\n'
+            'init_value : float\n'
+            '        Initial intensity of every voxel, if `mlos` is False\n'
+            'mlos : bool\n'
+            '        Start from the MLOS estimate, and drop the voxels where it\n'
+            '        is zero from the weight matrices before iterating\n')
+
+        return params
+
+    def __init__(self, weights, grid, params=None):
+        if params is None:
+            params = self.__class__.create_default_params()
+
+        self.params = params.reconstruct
+        self.weights = [w.tocsr() for w in weights]
+        self.grid = grid
+
+        for w in self.weights:
+            if w.shape[1] != grid.size:
+                raise ValueError(
+                    'Weight matrix does not match the size of the voxel grid.')
+
+    def _prepare_images(self, images):
+        """Returns the images of all cameras as flat float arrays."""
+        if len(images) != len(self.weights):
+            raise ValueError('Expected one image per camera.')
+
+        intensities = []
+        for img, w in zip(images, self.weights):
+            img = np.asarray(img, dtype=np.float32).ravel()
+            if img.size != w.shape[0]:
+                raise ValueError(
+                    'Image does not match the number of rows of the weight matrix.')
+            intensities.append(img)
+
+        return intensities
+
+    def _init_volume(self, volume):
+        """Returns the initial guess as a C-contiguous 3D array."""
+        if volume is None:
+            return np.full(self.grid.shape, self.params.init_value,
+                           dtype=np.float32)
+
+        if volume.shape != self.grid.shape or not volume.flags.c_contiguous:
+            raise ValueError('Initial volume must be a C-contiguous array '
+                             'of shape {}.'.format(self.grid.shape))
+
+        return volume
+
+    def _mask_dark(self, vol, img, w):
+        """A dark pixel sets all voxels along its line of sight to zero."""
+        dark = (img <= 0) & (np.diff(w.indptr) > 0)
+        if dark.any():
+            vol[w[dark].indices] = 0.
+
+        return dark
+
+    def __call__(self, images, volume=None):
+        """
+        Reconstructs the volume from one image per camera, for instance
+        from `PreprocBase.results`.
+
+        Parameters
+        ----------
+        images : sequence of array_like
+            One preprocessed image per camera, in the order of `weights`.
+            The flattened images are indexed as the rows of the weight matrix.
+
+        volume : nd-array, optional
+            Initial guess of shape (nz, ny, nx), updated in place. Defaults
+            to the MLOS estimate, or to `init_value` if `mlos` is False.
+
+        Returns
+        -------
+        volume : nd-array
+            Voxel intensities, of shape (nz, ny, nx)
+
+        """
+        intensities = self._prepare_images(images)
+
+        if not self.params.mlos:
+            volume = self._init_volume(volume)
+            self._solve(volume.reshape(-1), intensities, self.weights)
+            return volume
+
+        guess = mlos(self.weights, intensities)
+        if volume is None:
+            volume = guess.reshape(self.grid.shape)
+        else:
+            volume = self._init_volume(volume)
+
+        vol = volume.reshape(-1)
+        active = np.flatnonzero(guess)
+        vol[guess == 0] = 0.
+        logger.debug('MLOS: {} of {} voxels are not empty'.format(
+            active.size, guess.size))
+        if active.size == 0:
+            return volume
+
+        weights = [compact_columns(w, active) for w in self.weights]
+        vol_active = vol[active]
+        self._solve(vol_active, intensities, weights)
+        vol[active] = vol_active
+        return volume
+
+    def _solve(self, vol, intensities, weights):
+        """Iterates on the flat array of voxel intensities `vol`, in place."""
+        # Back-projections use the transposed matrices, computed once
+        transposed = [w.T.tocsr() for w in weights]
+        for it in range(self.params.nb_iterations):
+            logger.debug('MART iteration {}'.format(it))
+            for img, w, w_t in zip(intensities, weights, transposed):
+                self._update(vol, img, w, w_t)
+
+    def _update(self, vol, img, w, w_t):
+        """
+        One MART update with all pixels of a camera. The ratios of the
+        pixel intensities to the projections of the volume are computed for
+        all pixels at once (`w @ vol`), and each voxel is multiplied by the
+        product of the corrections `ratio ** (mu * weight)` of the pixels
+        seeing it, evaluated as `exp(mu * w.T @ log(ratio))`.
+
+        """
+        mu = self.params.relaxation
+        dark = self._mask_dark(vol, img, w)
+        proj = w.dot(vol)
+        lit = ~dark & (proj > 0)
+        log_ratio = np.zeros(img.shape, dtype=np.float64)
+        log_ratio[lit] = np.log(img[lit] / proj[lit])
+        vol *= np.exp(mu * w_t.dot(log_ratio))
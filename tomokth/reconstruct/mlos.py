@@ -0,0 +1,79 @@
+"""MLOS first guess (:mod:`tomokth.reconstruct.mlos`)
+=======================================================================
+Multiplicative line-of-sight estimate of the volume, used to initialize the
+iterative reconstruction and to discard the voxels which are certainly empty.
+
+.. currentmodule:: tomokth.reconstruct.mlos
+
+Provides
+--------
+mlos, compact_columns
+
+"""
+
+from __future__ import division
+import numpy as np
+from scipy import sparse
+
+
+def mlos(weights, intensities):
+    """
+    Returns the MLOS estimate of the voxel intensities. For each camera, the
+    intensity projected on a voxel is the weighted mean of the pixels whose
+    lines of sight cross it. These are multiplied over all cameras, and the
+    root of order `nb_cameras` of the product is taken so that the estimate
+    keeps the units of image intensity. A voxel is zero as soon as one camera
+    sees it only through dark or negative pixels, or does not see it at all.
+
+    Parameters
+    ----------
+    weights : sequence of scipy.sparse.csr_matrix
+        Weight matrix of each camera, of shape (N_pix, N_vox)
+
+    intensities : sequence of nd-array
+        Flattened image of each camera
+
+    Returns
+    -------
+    guess : nd-array
+        Flat array of N_vox voxel intensities
+
+    """
+    nb_vox = weights[0].shape[1]
+    guess = np.ones(nb_vox, dtype=np.float32)
+    for w, img in zip(weights, intensities):
+        norm = np.bincount(w.indices, weights=w.data, minlength=nb_vox)
+        proj = w.T.dot(img)
+        seen = norm > 0
+        # Negative intensities of preprocessed images are clipped for each
+        # camera, so that two negative projections do not give a bright voxel
+        guess[seen] *= np.maximum(proj[seen] / norm[seen], 0.)
+        guess[~seen] = 0.
+
+    return guess ** (1. / len(weights))
+
+
+def compact_columns(matrix, active):
+    """
+    Returns the CSR matrix restricted to the columns in `active`, numbered in
+    the order of `active`.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse.csr_matrix
+
+    active : nd-array
+        Sorted indices of the columns to keep
+
+    """
+    new_index = np.full(matrix.shape[1], -1, dtype=np.intp)
+    new_index[active] = np.arange(active.size)
+    indices = new_index[matrix.indices]
+    keep = indices >= 0
+
+    # Number of kept entries before each row start
+    cumsum = np.concatenate([[0], np.cumsum(keep)])
+    indptr = cumsum[matrix.indptr]
+
+    return sparse.csr_matrix((matrix.data[keep], indices[keep], indptr),
+                             shape=(matrix.shape[0], active.size))
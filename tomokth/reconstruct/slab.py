@@ -0,0 +1,268 @@
+"""Slab-decomposed reconstruction (:mod:`tomokth.reconstruct.slab`)
+=======================================================================
+Splits the voxel grid into slabs which are reconstructed independently in a
+pool of processes, so that the weight matrices of the whole volume never have
+to fit in the memory of a single process.
+
+.. currentmodule:: tomokth.reconstruct.slab
+
+Provides
+--------
+.. autoclass:: SlabReconstruction
+   :members:
+   :private-members:
+
+"""
+
+from __future__ import division
+from multiprocessing import cpu_count
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .mart import MART
+from .smart import SMART
+from ..operators.weights import VoxelGrid, build_weight_matrix
+from ..util.util import logger
+
+
+solvers = {'MART': MART, 'SMART': SMART}
+
+# Rough number of bytes held per non-zero weight while a slab is solved: the
+# COO triplets during construction, the CSR matrix and the row blocks of SMART
+_BYTES_PER_NNZ = 40
+
+
+def _subgrid(grid, start, stop):
+    """Voxel grid restricted to the rows [start, stop) along y."""
+    origin = grid.origin.copy()
+    origin[1] += start * grid.spacing[1]
+    return VoxelGrid((grid.shape[0], stop - start, grid.shape[2]),
+                     grid.spacing, origin)
+
+
+def _solve_slab(solver_name, params, grid, cameras, rpix, rvox, images,
+                interior):
+    """
+    Builds the weight matrices of a slab and reconstructs it. Runs in a worker
+    process. Returns the rows `interior` of the reconstructed slab.
+
+    """
+    weights = [build_weight_matrix(grid, vec_pix, vec_normal, rpix, rvox)
+               for vec_pix, vec_normal in cameras]
+    solver = solvers[solver_name](weights, grid, params)
+    volume = solver(images)
+    return volume[:, interior, :]
+
+
+class SlabReconstruction(object):
+    """
+    Reconstructs a volume slab by slab. The slabs are cut along y, across the
+    lines of sight: a slab along z would not contain whole lines of sight and
+    could not satisfy the projection of the images.
+
+    Each slab is extended by a halo of `halo_footprints` times the extent in
+    y of the footprint of a line of sight in the volume. The voxels of the
+    halo are reconstructed but discarded. An update of SMART only couples
+    voxels sharing a pixel, so with `nb_iterations + 1` footprints (the
+    default, one for the MLOS first guess) the slabs match the single-process
+    SMART solver exactly. MART updates the volume camera after camera and
+    only matches approximately. This halo is often wider than the volume at
+    realistic depths and angles: it is then capped at the volume, and if a
+    slab with its halo does not fit in `max_memory`, the halo is narrowed,
+    so that the slabs only approximate the single-process solver.
+
+    Parameters
+    ----------
+    cameras : sequence of tuples
+        Lines of sight `(vec_pix, vec_normal)` of each camera, as for
+        `tomokth.operators.weights.build_weight_matrix`.
+
+    grid : VoxelGrid
+        Voxel grid of the volume
+
+    rpix : float
+        Radius of a pixel
+
+    rvox : float
+        Radius of a voxel
+
+    params : ParamContainer, optional
+        Parameters created by `SlabReconstruction.create_default_params`
+
+    """
+
+    @classmethod
+    def create_default_params(cls):
+        """Class method returning the default parameters."""
+        params = SMART.create_default_params()
+        params.reconstruct.nb_threads = 1
+        params.reconstruct._set_child('slabs', attribs={
+            'solver': 'SMART',
+            'nb_workers': cpu_count(),
+            'max_memory': 1024,
+            'nb_slabs': None,
+            'halo_footprints': None})
+        params.reconstruct.slabs._set_doc(
+            'solver : {\'SMART\', \'MART\'}\n'
+            '        Solver applied on each slab\n'
+            'nb_workers : int\n'
+            '        Number of worker processes\n'
+            'max_memory : float\n'
+            '        Estimated peak memory of a worker, in MB, which sets the\n'
+            '        thickness of the slabs\n'
+            'nb_slabs : int or None\n'
+            '        Number of slabs, overriding `max_memory` if not None\n'
+            'halo_footprints : int or None\n'
+            '        Width of the halo in footprints of a line of sight.\n'
+            '        Defaults to `nb_iterations + 1`, capped at the extent of\n'
+            '        the volume. If the halo does not fit in `max_memory`, it\n'
+            '        is reduced with a warning, at the cost of accuracy near\n'
+            '        the boundaries of the slabs\n')
+
+        return params
+
+    def __init__(self, cameras, grid, rpix, rvox, params=None):
+        if params is None:
+            params = self.__class__.create_default_params()
+
+        self.params = params
+        self.grid = grid
+        self.rpix = rpix
+        self.rvox = rvox
+
+        self.cameras = []
+        for vec_pix, vec_normal in cameras:
+            vec_pix = np.atleast_2d(np.asarray(vec_pix, dtype=float))
+            vec_normal = np.broadcast_to(np.asarray(vec_normal, dtype=float),
+                                         vec_pix.shape)
+            self.cameras.append((vec_pix, vec_normal))
+
+        self.halo = self._compute_halo()
+        self.bounds = self._compute_bounds()
+
+    def _line_y_range(self, vec_pix, vec_normal):
+        """Range of y covered by the lines of sight across the depth of the grid."""
+        z = self.grid.z
+        y_start, y_end = [vec_pix[:, 1] + (z_end - vec_pix[:, 2]) /
+                          vec_normal[:, 2] * vec_normal[:, 1]
+                          for z_end in (z[0], z[-1])]
+        return np.minimum(y_start, y_end), np.maximum(y_start, y_end)
+
+    def _compute_halo(self):
+        """Width of the halo, in voxels along y."""
+        params = self.params.reconstruct
+        halo_footprints = params.slabs.halo_footprints
+        if halo_footprints is None:
+            halo_footprints = params.nb_iterations + 1
+
+        rmax = self.rpix + self.rvox
+        extent = max((y_max - y_min).max()
+                     for y_min, y_max in (self._line_y_range(*camera)
+                                          for camera in self.cameras))
+        footprint = int(np.ceil((extent + 2 * rmax) / self.grid.spacing[1]))
+        # A halo wider than the volume only adds rows outside of the grid
+        return min(halo_footprints * footprint, self.grid.shape[1])
+
+    def _estimate_bytes_per_row(self):
+        """Estimates the memory needed per row along y of a slab."""
+        ny = self.grid.shape[1]
+        start = max(ny // 2 - 2, 0)
+        stop = min(start + 4, ny)
+        grid = _subgrid(self.grid, start, stop)
+        nnz = 0
+        for vec_pix, vec_normal in self.cameras:
+            sel = self._select_pixels((vec_pix, vec_normal), start, stop)
+            nnz += build_weight_matrix(grid, vec_pix[sel], vec_normal[sel],
+                                       self.rpix, self.rvox).nnz
+        nb_vox_row = self.grid.shape[0] * self.grid.shape[2]
+        return (_BYTES_PER_NNZ * nnz + 16 * nb_vox_row * (stop - start)) / (
+            stop - start)
+
+    def _compute_bounds(self):
+        """Bounds along y of the interiors of the slabs."""
+        slabs = self.params.reconstruct.slabs
+        ny = self.grid.shape[1]
+        if slabs.nb_slabs is not None:
+            nb_slabs = slabs.nb_slabs
+        else:
+            rows = int(slabs.max_memory * 2 ** 20 //
+                       self._estimate_bytes_per_row())
+            if rows < 1:
+                raise ValueError('max_memory is too small for a single row.')
+            if rows >= ny:
+                nb_slabs = 1
+            else:
+                if rows - 2 * self.halo < 1:
+                    halo = (rows - 1) // 2
+                    logger.warning(
+                        'Halo reduced from {} to {} rows to fit max_memory: '
+                        'the slabs only approximate the single-process '
+                        'solver.'.format(self.halo, halo))
+                    self.halo = halo
+                nb_slabs = int(np.ceil(ny / (rows - 2 * self.halo)))
+
+        nb_slabs = max(1, min(nb_slabs, ny))
+        return np.linspace(0, ny, nb_slabs + 1).astype(int)
+
+    def _select_pixels(self, camera, start, stop):
+        """
+        Boolean mask of the lines of sight of a camera which may come within
+        `rpix + rvox` of the voxels in the rows [start, stop). Pixels which
+        turn out not to touch the slab only add empty rows.
+
+        """
+        y_min, y_max = self._line_y_range(*camera)
+        y = self.grid.y
+        margin = self.rpix + self.rvox + self.grid.spacing[1]
+        return (y_max > y[start] - margin) & (y_min < y[stop - 1] + margin)
+
+    def __call__(self, images):
+        """
+        Reconstructs the volume from one image per camera.
+
+        Parameters
+        ----------
+        images : sequence of array_like
+            One preprocessed image per camera, in the order of `cameras`.
+
+        Returns
+        -------
+        volume : nd-array
+            Voxel intensities, of shape (nz, ny, nx)
+
+        """
+        if len(images) != len(self.cameras):
+            raise ValueError('Expected one image per camera.')
+
+        images = [np.asarray(img, dtype=np.float32).ravel() for img in images]
+        volume = np.empty(self.grid.shape, dtype=np.float32)
+        ny = self.grid.shape[1]
+        slabs = self.params.reconstruct.slabs
+        logger.info('Reconstruction in {} slabs with a halo of {} rows'.format(
+            len(self.bounds) - 1, self.halo))
+
+        with ProcessPoolExecutor(slabs.nb_workers) as executor:
+            futures = []
+            for start, stop in zip(self.bounds[:-1], self.bounds[1:]):
+                sub_start = max(start - self.halo, 0)
+                sub_stop = min(stop + self.halo, ny)
+
+                cameras = []
+                sub_images = []
+                for camera, img in zip(self.cameras, images):
+                    vec_pix, vec_normal = camera
+                    sel = self._select_pixels(camera, sub_start, sub_stop)
+                    cameras.append((vec_pix[sel], vec_normal[sel]))
+                    sub_images.append(img[sel])
+
+                interior = slice(start - sub_start, stop - sub_start)
+                futures.append((start, stop, executor.submit(
+                    _solve_slab, slabs.solver, self.params,
+                    _subgrid(self.grid, sub_start, sub_stop), cameras,
+                    self.rpix, self.rvox, sub_images, interior)))
+
+            for start, stop, future in futures:
+                volume[:, start:stop, :] = future.result()
+
+        return volume
@@ -0,0 +1,167 @@
+"""SMART reconstruction (:mod:`tomokth.reconstruct.smart`)
+=======================================================================
+Simultaneous multiplicative algebraic reconstruction technique. All pixels of
+all cameras are updated at once, and the sparse matrix-vector products are
+split into row blocks processed by a pool of threads.
+
+.. currentmodule:: tomokth.reconstruct.smart
+
+Provides
+--------
+.. autoclass:: SMART
+   :members:
+   :private-members:
+
+"""
+
+from __future__ import division
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .mart import MART
+from ..util.util import logger
+
+
+def _balanced_bounds(counts, nb_blocks):
+    """Bounds of `nb_blocks` contiguous blocks with similar sums of `counts`."""
+    cumsum = np.concatenate([[0], np.cumsum(counts)])
+    bounds = np.searchsorted(cumsum, np.linspace(0, cumsum[-1], nb_blocks + 1))
+    bounds[0], bounds[-1] = 0, len(counts)
+    return np.unique(bounds)
+
+
+class _RowBlocks(object):
+    """
+    CSR matrix split into blocks of rows, so that the products with each
+    block can run in separate threads (scipy.sparse releases the GIL).
+
+    """
+
+    def __init__(self, matrix, bounds):
+        matrix = matrix.tocsr()
+        self.shape = matrix.shape
+        self.slices = [slice(start, stop)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+        self.blocks = [matrix[sl] for sl in self.slices]
+
+    def dot(self, vec, pool, out=None):
+        """Multithreaded matrix-vector product."""
+        if out is None:
+            out = np.empty(self.shape[0], dtype=np.result_type(
+                self.blocks[0].dtype, vec.dtype))
+
+        def _dot(k):
+            out[self.slices[k]] = self.blocks[k].dot(vec)
+
+        list(pool.map(_dot, range(len(self.blocks))))
+        return out
+
+
+class SMART(MART):
+    r"""
+    Reconstructs a volume from the images of several cameras, updating all
+    voxels simultaneously at each iteration:
+
+    .. math::
+        E_j \leftarrow E_j \exp \left( \frac{\mu}{\sum_i W_{ij}}
+            \sum_i W_{ij} \log \frac{I_i}{\sum_k W_{ik} E_k} \right)
+
+    where the sums over i run over the pixels of all cameras. The weight
+    matrices are stored twice, split in blocks of pixels for the projection
+    and transposed in blocks of voxels for the back-projection.
+
+    Parameters
+    ----------
+    weights : sequence of scipy.sparse matrices
+        Weight matrix of each camera, of shape (N_pix, N_vox)
+
+    grid : VoxelGrid
+        Voxel grid of the volume
+
+    params : ParamContainer, optional
+        Parameters created by `SMART.create_default_params`
+
+    """
+
+    @classmethod
+    def create_default_params(cls):
+        """Class method returning the default parameters."""
+        params = super(SMART, cls).create_default_params()
+        params.reconstruct._set_attribs({'nb_threads': cpu_count(),
+                                         'nb_blocks_per_thread': 4})
+        params.reconstruct._set_doc(
+            params.reconstruct._doc +
+            'nb_threads : int\n'
+            '        Number of threads for the sparse matrix-vector products\n'
+            'nb_blocks_per_thread : int\n'
+            '        Number of row blocks per thread, for load balancing\n')
+
+        return params
+
+    def __init__(self, weights, grid, params=None):
+        super(SMART, self).__init__(weights, grid, params)
+        self._blocks = None
+
+    def _split_blocks(self, weights):
+        """
+        Splits the weight matrices in blocks of pixels for the projection and
+        in blocks of voxels for the back-projection.
+
+        """
+        nb_blocks = self.params.nb_threads * self.params.nb_blocks_per_thread
+        nb_vox = weights[0].shape[1]
+        proj = [_RowBlocks(w, _balanced_bounds(np.diff(w.indptr), nb_blocks))
+                for w in weights]
+
+        # Voxel blocks are shared by the transposed matrices of all cameras
+        counts = sum(np.bincount(w.indices, minlength=nb_vox)
+                     for w in weights)
+        bounds = _balanced_bounds(counts, nb_blocks)
+        backproj = [_RowBlocks(w.T, bounds) for w in weights]
+        norm = sum(np.asarray(w.sum(axis=0)).ravel() for w in weights)
+        return proj, backproj, norm
+
+    def _solve(self, vol, intensities, weights):
+        """Iterates on the flat array of voxel intensities `vol`, in place."""
+        if weights is self.weights:
+            if self._blocks is None:
+                self._blocks = self._split_blocks(weights)
+            blocks = self._blocks
+        else:
+            blocks = self._split_blocks(weights)
+
+        for img, w in zip(intensities, weights):
+            self._mask_dark(vol, img, w)
+
+        with ThreadPoolExecutor(self.params.nb_threads) as pool:
+            for it in range(self.params.nb_iterations):
+                logger.debug('SMART iteration {}'.format(it))
+                self._iterate(vol, intensities, blocks, pool)
+
+    def _iterate(self, vol, intensities, blocks, pool):
+        """One simultaneous update of all voxels."""
+        mu = self.params.relaxation
+        proj_blocks, backproj_blocks, norm_vox = blocks
+        vox_slices = backproj_blocks[0].slices
+
+        log_ratios = []
+        for img, proj in zip(intensities, proj_blocks):
+            proj_img = proj.dot(vol, pool)
+            lit = (img > 0) & (proj_img > 0)
+            log_ratio = np.zeros(img.shape, dtype=np.float32)
+            log_ratio[lit] = np.log(img[lit] / proj_img[lit])
+            log_ratios.append(log_ratio)
+
+        def _update(k):
+            sl = vox_slices[k]
+            corr = sum(backproj.blocks[k].dot(log_ratio)
+                       for backproj, log_ratio in zip(backproj_blocks,
+                                                      log_ratios))
+            norm = norm_vox[sl]
+            seen = norm > 0
+            vol_block = vol[sl]
+            vol_block[seen] *= np.exp(mu * corr[seen] / norm[seen])
+
+        list(pool.map(_update, range(len(vox_slices))))
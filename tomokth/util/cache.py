@@ -0,0 +1,141 @@
+"""On-disk LRU caches (:mod:`tomokth.util.cache`)
+================================================
+
+.. currentmodule:: tomokth.util.cache
+
+Provides
+--------
+DirectoryCache
+
+"""
+
+from __future__ import division
+import os
+import shutil
+
+from .util import logger
+
+
+class DirectoryCache(object):
+    """
+    Base class of the caches storing one entry per key in a directory, either
+    a file or a directory of files. The least recently used entries, by
+    modification time, are evicted once the cache is larger than `max_size`.
+    The size of the cache is tracked across saves, so that the directory is
+    only listed when the budget is exceeded.
+
+    Subclasses define the path of the entry of a key (`_entry`), the key of a
+    file in the cache directory (`_key`), and write new entries in a
+    temporary path which is moved in place with `_store`.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the cache, created if needed.
+
+    max_size : float
+        Size budget of the cache in MB.
+
+    """
+
+    #: Description of an entry, for the log messages
+    _description = 'entry'
+
+    def __init__(self, path, max_size=4096):
+        self.path = os.path.abspath(os.path.expandvars(path))
+        self.max_size = max_size
+        # Running total of the size of the cache, scanned on the first save
+        self._size = None
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def _entry(self, key):
+        """Returns the path of the entry of `key`."""
+        raise NotImplementedError
+
+    def _key(self, name):
+        """Returns the key of the file `name` of the cache directory, or
+        `None` if it is not an entry."""
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        return os.path.exists(self._entry(key))
+
+    @staticmethod
+    def _entry_size(entry):
+        if os.path.isdir(entry):
+            return sum(os.path.getsize(os.path.join(entry, name))
+                       for name in os.listdir(entry))
+
+        return os.path.getsize(entry)
+
+    @staticmethod
+    def _remove(entry):
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        else:
+            os.remove(entry)
+
+    def _store(self, key, tmp):
+        """Moves the new entry written in `tmp` in place of the entry of
+        `key`, and evicts old entries if the budget is exceeded."""
+        if self._size is None:
+            self._size = self.size()
+
+        entry = self._entry(key)
+        try:
+            self._size -= self._entry_size(entry)
+            if os.path.isdir(entry):
+                # A file is replaced atomically by the rename, not a directory
+                shutil.rmtree(entry)
+        except OSError:
+            pass
+        os.rename(tmp, entry)
+        self._size += self._entry_size(entry)
+        # Only lists the directory when the budget is exceeded
+        if self._size > self.max_size * 2 ** 20:
+            self.evict(keep=key)
+
+    def _entries(self):
+        """Returns (access time, size in bytes, key) of all entries."""
+        entries = []
+        for name in os.listdir(self.path):
+            key = None if name.startswith('.') else self._key(name)
+            if key is None:
+                continue
+
+            entry = self._entry(key)
+            try:
+                entries.append((os.path.getmtime(entry),
+                                self._entry_size(entry), key))
+            except OSError:
+                # Evicted concurrently by another process
+                continue
+
+        return entries
+
+    def size(self):
+        """Total size of the cache in bytes."""
+        return sum(size for atime, size, key in self._entries())
+
+    def evict(self, keep=None):
+        """Removes the least recently used entries until within budget."""
+        entries = sorted(self._entries())
+        total = sum(size for atime, size, key in entries)
+        budget = self.max_size * 2 ** 20
+        for atime, size, key in entries:
+            if total <= budget:
+                break
+
+            if key == keep:
+                continue
+
+            logger.debug('Evicting {} {} from cache'.format(
+                self._description, key))
+            try:
+                self._remove(self._entry(key))
+            except OSError:
+                pass
+            total -= size
+
+        self._size = total